@@ -0,0 +1,106 @@
+"""Saves images and raw dumps without blocking the tracer."""
+
+# pylint: disable=consider-using-f-string
+
+import atexit
+import concurrent.futures
+import threading
+import traceback
+
+# Number of threads encoding and writing artifacts, 0 writes synchronously.
+DEFAULT_WORKERS = 2
+
+# Maximum number of artifacts waiting to be written before the tracer is blocked.
+DEFAULT_MAX_PENDING = 64
+
+
+def save_image(img, no_alpha_path, alpha_path):
+    """Saves a PIL.Image to the given path(s)"""
+    if alpha_path:
+        img.save(alpha_path)
+    if no_alpha_path:
+        img.convert("RGB").save(no_alpha_path)
+
+
+def write_file(path, contents):
+    """Writes the given bytes to `path`."""
+    with open(path, "wb") as dumpfile:
+        dumpfile.write(contents)
+
+
+class ArtifactWriter:
+    """Writes artifacts to disk on a pool of background threads.
+
+    At most `max_pending` artifacts may be queued, further submissions block until
+    a worker has finished one. Pillow and zlib release the GIL while encoding, so
+    threads are sufficient and avoid pickling images for a process pool. Pending
+    artifacts are written before the process exits.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+        self.error_count = 0
+
+        self._executor = None
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="ArtifactWriter"
+            )
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._pending = set()
+
+        atexit.register(self.close)
+
+    @property
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def save_image(self, img, no_alpha_path, alpha_path):
+        """Queues a PIL.Image to be saved to the given path(s)"""
+        if not img:
+            return
+        self._submit(
+            no_alpha_path or alpha_path, save_image, img, no_alpha_path, alpha_path
+        )
+
+    def write(self, path, contents):
+        """Queues `contents` to be written to `path`."""
+        self._submit(path, write_file, path, contents)
+
+    def drain(self):
+        """Blocks until every queued artifact has been written."""
+        with self._lock:
+            pending = list(self._pending)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        """Writes the queued artifacts and stops the workers."""
+        if self._executor:
+            self.drain()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _submit(self, name, func, *args):
+        if not self._executor:
+            self._run(name, func, *args)
+            return
+
+        self._slots.acquire()
+        future = self._executor.submit(self._run, name, func, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _run(self, name, func, *args):
+        try:
+            func(*args)
+        except Exception:  # pylint: disable=broad-except
+            self.error_count += 1
+            print("Failed to write %s" % name)
+            traceback.print_exc()
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
@@ -0,0 +1,85 @@
+"""Provides a log file that is kept open with a large write buffer."""
+
+# pylint: disable=consider-using-with
+
+import atexit
+import threading
+import time
+
+# Size of the write buffer in bytes.
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Maximum number of seconds that written text may stay in the buffer.
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class BufferedLogFile:
+    """Keeps a log file open with a large write buffer.
+
+    The buffer is flushed once `flush_interval` seconds have passed since the
+    previous flush. This is checked on every write or, if `background_flush` is
+    set, by a daemon thread so that an idle log does not hold back output. The file
+    is flushed and closed at exit.
+    """
+
+    def __init__(
+        self,
+        path,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        flush_interval=DEFAULT_FLUSH_INTERVAL,
+        background_flush=False,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf8", buffering=buffer_size)
+        self._last_flush = time.monotonic()
+
+        self._stop_flushing = threading.Event()
+        self._flush_thread = None
+        if background_flush:
+            self._flush_thread = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flush_thread.start()
+
+        atexit.register(self.close)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, text):
+        """Appends the given string to the buffer."""
+        with self._lock:
+            self._file.write(text)
+            if (
+                not self._flush_thread
+                and time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self._flush()
+
+    def flush(self):
+        """Writes any buffered text to the file."""
+        with self._lock:
+            if not self._file.closed:
+                self._flush()
+
+    def close(self):
+        """Flushes and closes the file, further writes raise ValueError."""
+        self._stop_flushing.set()
+        if self._flush_thread:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+        with self._lock:
+            self._file.close()
+
+    def _flush(self):
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,47 @@
+"""Manages the checksum_memory.asm patch."""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=too-few-public-methods
+
+import struct
+import zlib
+from Xbox import Xbox
+import XboxHelper
+
+
+def reference_checksum(data: bytes) -> int:
+    """Returns the checksum that checksum_memory.asm computes for the given data."""
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+class _ChecksumMemory:
+    """Manages the checksum_memory.asm patch."""
+
+    def __init__(self, verbose=True):
+        self.checksum_memory_addr = 0
+        self.verbose = verbose
+
+    def _install_checksum(self, xbox: Xbox):
+        with open("checksum_memory", "rb") as patch_file:
+            data = patch_file.read()
+
+        self.checksum_memory_addr = XboxHelper.load_binary(xbox, data)
+        if self.verbose:
+            print("checksum_memory installed at 0x%08X" % self.checksum_memory_addr)
+
+    def call(self, xbox: Xbox, address: int, length: int) -> int:
+        """Calls the checksum routine with the given arguments."""
+        if not self.checksum_memory_addr:
+            self._install_checksum(xbox)
+
+        return xbox.call(
+            self.checksum_memory_addr, struct.pack("<LL", address, length)
+        )["eax"]
+
+
+_instance = _ChecksumMemory()
+
+
+def checksum_memory(xbox: Xbox, address: int, length: int) -> int:
+    """Returns the CRC32 of `length` bytes at `address` without transferring them."""
+    return _instance.call(xbox, address, length)
@@ -0,0 +1,128 @@
+"""Selects the pushbuffer commands that are logged and dumped."""
+
+# pylint: disable=consider-using-f-string
+
+NV097 = 0x97
+NV097_SET_BEGIN_END = 0x17FC
+
+# Number of distinct methods, all methods are 4 byte aligned.
+_METHOD_COUNT = 0x2000 // 4
+
+FILTER_KEYS = ["method", "class", "draw", "address"]
+
+
+def _parse_ranges(values):
+    """Parses "A-B,C,..." into a list of inclusive (first, last) ranges."""
+    ret = []
+    for value in values.split(","):
+        first, separator, last = value.partition("-")
+        first = int(first, 0)
+        last = int(last, 0) if separator else first
+        if last < first:
+            raise ValueError("Invalid range %s" % value)
+        ret.append((first, last))
+    return ret
+
+
+def _method_words(method_info, target):
+    """Returns the data words the command writes to the `target` method."""
+    method = method_info["method"]
+    data = method_info["data"]
+    if method_info["nonincreasing"]:
+        return data if method == target else []
+    index = (target - method) // 4
+    if method <= target and index < len(data):
+        return [data[index]]
+    return []
+
+
+def _in_ranges(value, ranges):
+    for first, last in ranges:
+        if first <= value <= last:
+            return True
+    return False
+
+
+class CommandFilter:
+    """Matches commands against a precompiled filter expression.
+
+    The expression is a whitespace separated list of `key=ranges` terms, where
+    ranges is a comma separated list of values or inclusive ranges, e.g.
+    "class=0x97 method=0x1800-0x1A00,0x17FC draw=10-20". A command matches if it
+    satisfies every term; giving the same key again adds more ranges to it.
+
+      method:  any method written by the command
+      class:   graphics class of the command's subchannel
+      draw:    index of the draw within the frame, counting ENDs; the commands
+               setting up a draw share its index
+      address: address of the command in the pushbuffer
+
+    `matches` must be called for every command of a frame, in order, and
+    `on_flip` at the end of each frame.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        terms = {}
+        for term in expression.split():
+            key, separator, values = term.partition("=")
+            if not separator or key not in FILTER_KEYS:
+                raise ValueError(
+                    "Invalid filter term %s, expected one of %s followed by =ranges"
+                    % (term, ", ".join(FILTER_KEYS))
+                )
+            terms.setdefault(key, []).extend(_parse_ranges(values))
+
+        self.methods = None
+        if "method" in terms:
+            table = bytearray(_METHOD_COUNT)
+            for first, last in terms["method"]:
+                for method in range(first, min(last, 0x1FFF) + 1, 4):
+                    table[method // 4] = 1
+            self.methods = bytes(table)
+
+        self.classes = None
+        if "class" in terms:
+            self.classes = frozenset(
+                graphics_class
+                for first, last in terms["class"]
+                for graphics_class in range(first, last + 1)
+            )
+
+        self.draws = terms.get("draw")
+        self.addresses = terms.get("address")
+
+        self.draw_index = 0
+
+    def __str__(self):
+        return self.expression
+
+    def matches(self, method_info):
+        """Returns True if the command should be logged and its hooks run."""
+        nv_obj = method_info["object"]
+        method = method_info["method"]
+        data = method_info["data"]
+
+        draw_index = self.draw_index
+        if nv_obj == NV097:
+            for value in _method_words(method_info, NV097_SET_BEGIN_END):
+                if not value:
+                    self.draw_index += 1
+
+        if self.classes is not None and nv_obj not in self.classes:
+            return False
+        if self.addresses is not None and not _in_ranges(
+            method_info["address"], self.addresses
+        ):
+            return False
+        if self.draws is not None and not _in_ranges(draw_index, self.draws):
+            return False
+        if self.methods is not None:
+            first = method // 4
+            if method_info["nonincreasing"] or not data:
+                return bool(self.methods[first])
+            return self.methods.find(1, first, first + len(data)) >= 0
+        return True
+
+    def on_flip(self):
+        self.draw_index = 0
@@ -0,0 +1,142 @@
+"""Tracks whether texture stages and the color surface changed since their last dump."""
+
+import NV097State
+
+NV097_SET_BEGIN_END = 0x17FC
+NV097_CLEAR_SURFACE = 0x1D94
+
+# Re-dump a texture stage only when its binding changes.
+CONTENT_POLICY_BINDING = "binding"
+
+# Additionally re-dump a texture stage when its texture is used as a render target.
+CONTENT_POLICY_RENDER_TARGET = "render-target"
+
+CONTENT_POLICIES = [CONTENT_POLICY_BINDING, CONTENT_POLICY_RENDER_TARGET]
+
+DEFAULT_CONTENT_POLICY = CONTENT_POLICY_RENDER_TARGET
+
+# Texture stage methods (relative to stage 0) that make up the binding of a stage.
+_TEXTURE_BINDING_METHODS = {
+    NV097State.NV097_SET_TEXTURE_OFFSET,
+    NV097State.NV097_SET_TEXTURE_FORMAT,
+    NV097State.NV097_SET_TEXTURE_CONTROL0,
+    NV097State.NV097_SET_TEXTURE_CONTROL1,
+}
+
+# Methods that configure the color and zeta surfaces.
+_SURFACE_SETUP_METHODS = {
+    NV097State.NV097_SET_CONTEXT_DMA_COLOR,
+    NV097State.NV097_SET_CONTEXT_DMA_ZETA,
+    NV097State.NV097_SET_SURFACE_CLIP_HORIZONTAL,
+    NV097State.NV097_SET_SURFACE_CLIP_VERTICAL,
+    NV097State.NV097_SET_SURFACE_FORMAT,
+    NV097State.NV097_SET_SURFACE_PITCH,
+    NV097State.NV097_SET_SURFACE_COLOR_OFFSET,
+    NV097State.NV097_SET_SURFACE_ZETA_OFFSET,
+}
+
+
+class DumpDirtyTracker:
+    """Decides from the method stream whether a dump would repeat the previous one.
+
+    A texture stage is dirty if one of its offset, format or control methods set a
+    different value than at its last dump. A draw (any method between BEGIN and END)
+    or CLEAR_SURFACE dirties the color surface and, under the render-target policy,
+    every texture stage whose offset matches the color or zeta offset. Textures
+    modified by the CPU are not detected here, the tracer checksums the textures of
+    clean stages against the dump cache to catch them.
+    Everything is dirty until it has been dumped once.
+    """
+
+    def __init__(self, content_policy=DEFAULT_CONTENT_POLICY):
+        self.content_policy = content_policy
+
+        # Maps {method: value} per texture stage as set by the method stream, and the
+        # state of each stage at its last dump (None if it was never dumped).
+        self.texture_bindings = [{} for _ in range(4)]
+        self.dumped_texture_bindings = [None] * 4
+        self.texture_contents_dirty = [False] * 4
+
+        self.surface_setup = {}
+        self.dumped_surface_setup = None
+        self.surface_contents_dirty = True
+
+        self.in_draw = False
+        self.draw_recorded = False
+
+    def record_method(self, method_info):
+        """Updates the dirty state for every data word of a parsed command."""
+        if method_info["object"] != NV097State.NV097:
+            return
+
+        method = method_info["method"]
+        for data in method_info["data"]:
+            self._apply(method, data)
+            if not method_info["nonincreasing"]:
+                method += 4
+
+    def is_texture_dirty(self, stage):
+        return (
+            self.texture_contents_dirty[stage]
+            or self.texture_bindings[stage] != self.dumped_texture_bindings[stage]
+        )
+
+    def on_texture_dumped(self, stage):
+        self.dumped_texture_bindings[stage] = dict(self.texture_bindings[stage])
+        self.texture_contents_dirty[stage] = False
+
+    def is_surface_dirty(self):
+        return self.surface_contents_dirty or self.surface_setup != (
+            self.dumped_surface_setup
+        )
+
+    def on_surface_dumped(self):
+        self.dumped_surface_setup = dict(self.surface_setup)
+        self.surface_contents_dirty = False
+
+    def _apply(self, method, data):
+        if method == NV097_SET_BEGIN_END:
+            self.in_draw = data != 0
+            self.draw_recorded = False
+            return
+
+        if self.in_draw:
+            # Only vertex data may be sent between BEGIN and END.
+            if not self.draw_recorded:
+                self.draw_recorded = True
+                self._on_render()
+            return
+
+        if method == NV097_CLEAR_SURFACE:
+            self._on_render()
+        elif method in _SURFACE_SETUP_METHODS:
+            self.surface_setup[method] = data
+        elif (
+            NV097State.NV097_SET_TEXTURE_OFFSET
+            <= method
+            < (
+                NV097State.NV097_SET_TEXTURE_OFFSET
+                + 4 * NV097State.NV097_TEXTURE_STAGE_STRIDE
+            )
+        ):
+            stage, method = divmod(
+                method - NV097State.NV097_SET_TEXTURE_OFFSET,
+                NV097State.NV097_TEXTURE_STAGE_STRIDE,
+            )
+            method += NV097State.NV097_SET_TEXTURE_OFFSET
+            if method in _TEXTURE_BINDING_METHODS:
+                self.texture_bindings[stage][method] = data
+
+    def _on_render(self):
+        self.surface_contents_dirty = True
+        if self.content_policy != CONTENT_POLICY_RENDER_TARGET:
+            return
+
+        targets = {
+            self.surface_setup.get(NV097State.NV097_SET_SURFACE_COLOR_OFFSET),
+            self.surface_setup.get(NV097State.NV097_SET_SURFACE_ZETA_OFFSET),
+        }
+        targets.discard(None)
+        for stage, binding in enumerate(self.texture_bindings):
+            if binding.get(NV097State.NV097_SET_TEXTURE_OFFSET) in targets:
+                self.texture_contents_dirty[stage] = True
@@ -0,0 +1,88 @@
+"""Decides which draws and surface events are dumped during long captures."""
+
+# pylint: disable=consider-using-f-string
+
+import time
+
+SAMPLING_POLICIES = ["every:N", "frame", "rate:X"]
+
+
+class DumpSampler:
+    """Selects the dump events whose textures and surfaces are dumped.
+
+    An event is a draw (its BEGIN and END), a CLEAR_SURFACE or a semaphore release.
+    The policy is one of
+
+      every:N  dump every Nth event
+      frame    dump the first event of each frame, and the surface at its flip
+      rate:X   dump at most X events per second
+
+    Skipped events are still logged, only their dumps are omitted.
+    """
+
+    def __init__(self, policy, clock=time.monotonic):
+        self.policy = policy
+        self.clock = clock
+
+        self.interval = 0
+        self.min_period = 0.0
+        self.per_frame = False
+
+        name, _separator, value = policy.partition(":")
+        try:
+            if name == "every":
+                self.interval = int(value)
+                valid = self.interval > 0
+            elif name == "rate":
+                self.min_period = 1.0 / float(value)
+                valid = self.min_period > 0
+            else:
+                valid = name == "frame" and not value
+                self.per_frame = valid
+        except (ValueError, ZeroDivisionError):
+            valid = False
+        if not valid:
+            raise ValueError(
+                "Invalid sampling policy %s, expected one of %s"
+                % (policy, ", ".join(SAMPLING_POLICIES))
+            )
+
+        self.event_count = 0
+        self.frame_event_count = 0
+        self.last_dump_time = None
+
+        self.skipped_count = 0
+
+    def __str__(self):
+        return self.policy
+
+    def should_dump(self):
+        """Called once per event, returns True if the event should be dumped."""
+        index = self.event_count
+        self.event_count += 1
+        frame_index = self.frame_event_count
+        self.frame_event_count += 1
+
+        if self.interval:
+            ret = index % self.interval == 0
+        elif self.per_frame:
+            ret = frame_index == 0
+        else:
+            now = self.clock()
+            ret = (
+                self.last_dump_time is None
+                or now - self.last_dump_time >= self.min_period
+            )
+            if ret:
+                self.last_dump_time = now
+
+        if not ret:
+            self.skipped_count += 1
+        return ret
+
+    def should_dump_at_flip(self):
+        """Returns True if the surface should be dumped at the end of the frame."""
+        return self.per_frame and self.frame_event_count > 1
+
+    def on_flip(self):
+        self.frame_event_count = 0
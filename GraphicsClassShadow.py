@@ -0,0 +1,99 @@
+"""Tracks the graphics class bound to each subchannel without reading PGRAPH."""
+
+# pylint: disable=consider-using-f-string
+
+import XboxHelper
+
+# Default number of commands between comparisons of the shadow against PGRAPH.
+DEFAULT_VALIDATION_INTERVAL = 1000
+
+# Method binding an object handle to a subchannel.
+NV_SET_OBJECT = 0x0000
+
+
+class GraphicsClassShadow:
+    """Maintains a local copy of the graphics class bound to each subchannel.
+
+    The shadow is seeded from PGRAPH's per-subchannel context cache and updated by
+    decoding SET_OBJECT as commands are parsed, looking up each newly seen handle
+    in RAMHT once. Because parsing runs ahead of the hardware, comparisons against
+    PGRAPH are only meaningful once the FIFO has caught up with the parser; callers
+    report those points through `on_synchronized`.
+    """
+
+    def __init__(
+        self,
+        xbox_helper: XboxHelper.XboxHelper,
+        validation_interval=DEFAULT_VALIDATION_INTERVAL,
+        log=print,
+    ):
+        self.xbox_helper = xbox_helper
+        self.validation_interval = validation_interval
+        self.log = log
+
+        # Maps {subchannel: graphics class}, None until seeded from PGRAPH.
+        self.classes = None
+
+        # Maps {object handle: graphics class} for every handle looked up in RAMHT.
+        self.handle_classes = {}
+
+        self.commands_since_validation = 0
+        self.mismatch_count = 0
+
+    def get(self, subchannel):
+        """Returns the graphics class bound to `subchannel`."""
+        self.commands_since_validation += 1
+        if self.classes is None:
+            self.classes = self.xbox_helper.fetch_subchannel_classes()
+
+        graphics_class = self.classes.get(subchannel)
+        if graphics_class is None:
+            # The last bound handle could not be resolved, fall back to PGRAPH.
+            return self.xbox_helper.fetch_graphics_class()
+        return graphics_class
+
+    def on_set_object(self, subchannel, handle):
+        """Updates the shadow for a SET_OBJECT command."""
+        if self.classes is None:
+            self.classes = self.xbox_helper.fetch_subchannel_classes()
+
+        graphics_class = self.handle_classes.get(handle)
+        if graphics_class is None:
+            graphics_class = self.xbox_helper.lookup_object_class(handle)
+            if graphics_class is None:
+                self.log(
+                    "Warning: Object handle 0x%08X not found in RAMHT, class of subchannel %d is unknown"
+                    % (handle, subchannel)
+                )
+                self.classes.pop(subchannel, None)
+                return
+            self.handle_classes[handle] = graphics_class
+
+        self.classes[subchannel] = graphics_class
+
+    def on_synchronized(self):
+        """Compares the shadow against PGRAPH if the validation interval has passed.
+
+        Must only be called while the hardware has processed every parsed command.
+        """
+        if (
+            not self.validation_interval
+            or self.commands_since_validation < self.validation_interval
+        ):
+            return
+
+        self.validate()
+
+    def validate(self):
+        """Compares the shadow against PGRAPH, adopting the hardware state."""
+        self.commands_since_validation = 0
+        actual = self.xbox_helper.fetch_subchannel_classes()
+        if self.classes is not None:
+            for subchannel, graphics_class in sorted(self.classes.items()):
+                if actual[subchannel] != graphics_class:
+                    self.mismatch_count += 1
+                    self.log(
+                        "Warning: Shadowed class 0x%02X of subchannel %d does not match PGRAPH (0x%02X)"
+                        % (graphics_class, subchannel, actual[subchannel])
+                    )
+        self.classes = actual
@@ -6,37 +6,43 @@
 
 import atexit
 
+from BufferedLogFile import BufferedLogFile
+
 
 class HTMLLog:
     """Manages the HTML log file."""
 
-    def __init__(self, path):
+    def __init__(self, path, background_flush=False):
         self.path = path
+        self.logfile = BufferedLogFile(path, background_flush=background_flush)
 
-        with open(path, "w", encoding="utf8") as logfile:
-            logfile.write(
-                "<html><head>"
-                "<style>"
-                "body { font-family: sans-serif; background:#333; color: #ccc } "
-                "img { border: 1px solid #FFF; } "
-                "td, tr, table { background: #444; padding: 10px; border:1px solid #888; border-collapse: collapse; }"
-                "</style></head><body><table>\n"
-            )
+        self.logfile.write(
+            "<html><head>"
+            "<style>"
+            "body { font-family: sans-serif; background:#333; color: #ccc } "
+            "img { border: 1px solid #FFF; } "
+            "td, tr, table { background: #444; padding: 10px; border:1px solid #888; border-collapse: collapse; }"
+            "</style></head><body><table>\n"
+        )
 
         self.log(["<b>#</b>", "<b>Opcode / Method</b>", "..."])
         atexit.register(self._close_tags)
 
     def _close_tags(self):
-        with open(self.path, "a", encoding="utf8") as logfile:
-            logfile.write("</table></body></html>")
+        if self.logfile.closed:
+            return
+        self.logfile.write("</table></body></html>")
+        self.logfile.close()
 
     def log(self, values):
         """Append the given values to the HTML log."""
-        with open(self.path, "a", encoding="utf8") as logfile:
-            logfile.write("<tr>")
-            for val in values:
-                logfile.write("<td>%s</td>" % val)
-            logfile.write("</tr>\n")
+        self.logfile.write(
+            "<tr>%s</tr>\n" % "".join("<td>%s</td>" % val for val in values)
+        )
+
+    def flush(self):
+        """Writes any buffered rows to the file."""
+        self.logfile.flush()
 
     def print_log(self, message):
         """Print the given string and append it to the HTML log."""
@@ -0,0 +1,238 @@
+"""Tracks the NV097 (Kelvin) state needed for dumps by decoding the method stream."""
+
+# pylint: disable=consider-using-f-string
+
+import Texture
+import XboxHelper
+
+# Graphics class whose methods are decoded.
+NV097 = 0x97
+
+NV097_SET_CONTEXT_DMA_COLOR = 0x0194
+NV097_SET_CONTEXT_DMA_ZETA = 0x0198
+NV097_SET_SURFACE_CLIP_HORIZONTAL = 0x0200
+NV097_SET_SURFACE_CLIP_VERTICAL = 0x0204
+NV097_SET_SURFACE_FORMAT = 0x0208
+NV097_SET_SURFACE_PITCH = 0x020C
+NV097_SET_SURFACE_COLOR_OFFSET = 0x0210
+NV097_SET_SURFACE_ZETA_OFFSET = 0x0214
+NV097_SET_TEXTURE_OFFSET = 0x1B00
+NV097_SET_TEXTURE_FORMAT = 0x1B04
+NV097_SET_TEXTURE_CONTROL0 = 0x1B0C
+NV097_SET_TEXTURE_CONTROL1 = 0x1B10
+
+# Distance between the methods of consecutive texture stages.
+NV097_TEXTURE_STAGE_STRIDE = 64
+
+# Registers describing the 4 texture stages, read as a single batch.
+TEXTURE_STAGE_REGISTERS = [
+    base + stage * 4
+    for stage in range(4)
+    for base in (
+        XboxHelper.PGRAPH_TEXCTL0_0,
+        XboxHelper.PGRAPH_TEXOFFSET0,
+        XboxHelper.PGRAPH_TEXCTL1_0,
+        XboxHelper.PGRAPH_TEXFMT0,
+    )
+]
+
+# Fields of the draw format register holding the color format.
+_DRAW_FORMAT_COLOR_MASK = 0x0000F000
+
+# Fields of the surface type register holding the surface type and anti-aliasing.
+_SURFACE_TYPE_MASK = 0x00000033
+
+# Maps the color format of NV097_SET_SURFACE_FORMAT to the PGRAPH draw format.
+_SURFACE_COLOR_FORMATS = {
+    0x1: 0x3,  # X1R5G5B5_Z1R5G5B5
+    0x2: 0x3,  # X1R5G5B5_O1R5G5B5
+    0x3: 0x5,  # R5G6B5
+    0x4: 0x7,  # X8R8G8B8_Z8R8G8B8
+    0x5: 0x7,  # X8R8G8B8_O8R8G8B8
+    0x6: 0x8,  # X1A7R8G8B8_Z1A7R8G8B8
+    0x7: 0x8,  # X1A7R8G8B8_O1A7R8G8B8
+    0x8: 0xC,  # A8R8G8B8
+}
+
+# Registers whose value is only partially shadowed, mapped to the shadowed bits.
+_PARTIAL_REGISTERS = {
+    Texture.PGRAPH_DRAW_FORMAT: _DRAW_FORMAT_COLOR_MASK,
+    Texture.PGRAPH_SURFACE_TYPE: _SURFACE_TYPE_MASK,
+}
+
+# Registers that are not set by any decoded method and are always read from PGRAPH.
+_UNSHADOWED_REGISTERS = {Texture.PGRAPH_SWIZZLE_UNK, Texture.PGRAPH_SWIZZLE_UNK2}
+
+
+class NV097State:
+    """Maintains a local copy of the surface and texture stage registers.
+
+    Every NV097 method is decoded into the PGRAPH registers it sets, so that the
+    registers needed to dump surfaces and textures are known without reading them.
+    Registers are seeded from PGRAPH when first needed. A register whose new value
+    cannot be derived from its method (e.g., an unknown DMA handle) is dropped and
+    read again the next time it is requested, which callers must only do while the
+    hardware has processed every recorded command. In `verify` mode every request
+    is also read from PGRAPH, mismatches are logged and the hardware state adopted.
+    """
+
+    def __init__(self, xbox_helper: XboxHelper.XboxHelper, verify=False, log=print):
+        self.xbox_helper = xbox_helper
+        self.verify = verify
+        self.log = log
+
+        # Maps {register address: value} for every register with a known value.
+        self.registers = {}
+        self.seeded = False
+
+        # Maps {DMA object handle: base address} for every handle looked up in RAMHT.
+        self.dma_addresses = {}
+
+        self.mismatch_count = 0
+
+    def record_method(self, method_info):
+        """Updates the shadow for every data word of a parsed command."""
+        if method_info["object"] != NV097:
+            return
+
+        method = method_info["method"]
+        for data in method_info["data"]:
+            self._apply(method, data)
+            if not method_info["nonincreasing"]:
+                method += 4
+
+    def read_registers(self, addresses):
+        """Returns {address: value} for the given registers."""
+        if not self.seeded:
+            self._seed()
+
+        missing = [
+            address
+            for address in addresses
+            if address not in self.registers or address in _UNSHADOWED_REGISTERS
+        ]
+        if missing:
+            self.registers.update(self.xbox_helper.read_registers(missing))
+
+        if self.verify:
+            self._verify(addresses)
+
+        return {address: self.registers[address] for address in addresses}
+
+    def read_texture_parameters(self) -> Texture.TextureParameters:
+        """Returns the shadowed equivalent of Texture.read_texture_parameters."""
+        return Texture.texture_parameters_from_registers(
+            self.read_registers(Texture.SURFACE_REGISTERS)
+        )
+
+    def read_texture_stage_registers(self):
+        """Returns {address: value} for the TEXTURE_STAGE_REGISTERS."""
+        return self.read_registers(TEXTURE_STAGE_REGISTERS)
+
+    def _seed(self):
+        self.seeded = True
+        addresses = [
+            address
+            for address in Texture.SURFACE_REGISTERS + TEXTURE_STAGE_REGISTERS
+            if address not in self.registers and address not in _UNSHADOWED_REGISTERS
+        ]
+        self.registers.update(self.xbox_helper.read_registers(addresses))
+
+    def _set(self, address, value, mask=0xFFFFFFFF):
+        if mask == 0xFFFFFFFF:
+            self.registers[address] = value
+            return
+
+        if not self.seeded:
+            self._seed()
+        if address in self.registers:
+            self.registers[address] = (self.registers[address] & ~mask) | (value & mask)
+
+    def _invalidate(self, address):
+        self.registers.pop(address, None)
+
+    def _apply(self, method, data):
+        if (
+            NV097_SET_TEXTURE_OFFSET
+            <= method
+            < (NV097_SET_TEXTURE_OFFSET + 4 * NV097_TEXTURE_STAGE_STRIDE)
+        ):
+            stage, method = divmod(
+                method - NV097_SET_TEXTURE_OFFSET, NV097_TEXTURE_STAGE_STRIDE
+            )
+            self._apply_texture_method(stage, NV097_SET_TEXTURE_OFFSET + method, data)
+            return
+
+        if method == NV097_SET_SURFACE_PITCH:
+            self._set(Texture.PGRAPH_COLOR_PITCH, data & 0xFFFF)
+            self._set(Texture.PGRAPH_ZETA_PITCH, data >> 16)
+        elif method == NV097_SET_SURFACE_COLOR_OFFSET:
+            self._set(Texture.PGRAPH_COLOR_OFFSET, data)
+        elif method == NV097_SET_SURFACE_ZETA_OFFSET:
+            self._set(Texture.PGRAPH_ZETA_OFFSET, data)
+        elif method == NV097_SET_SURFACE_CLIP_HORIZONTAL:
+            self._set(Texture.PGRAPH_SURFACE_CLIP_X, data)
+        elif method == NV097_SET_SURFACE_CLIP_VERTICAL:
+            self._set(Texture.PGRAPH_SURFACE_CLIP_Y, data)
+        elif method == NV097_SET_SURFACE_FORMAT:
+            self._apply_surface_format(data)
+        elif method == NV097_SET_CONTEXT_DMA_COLOR:
+            self._apply_context_dma(Texture.PGRAPH_COLOR_BASE, data)
+        elif method == NV097_SET_CONTEXT_DMA_ZETA:
+            self._apply_context_dma(Texture.PGRAPH_ZETA_BASE, data)
+
+    def _apply_texture_method(self, stage, method, data):
+        reg_offset = stage * 4
+        if method == NV097_SET_TEXTURE_OFFSET:
+            self._set(XboxHelper.PGRAPH_TEXOFFSET0 + reg_offset, data)
+        elif method == NV097_SET_TEXTURE_FORMAT:
+            self._set(XboxHelper.PGRAPH_TEXFMT0 + reg_offset, data)
+        elif method == NV097_SET_TEXTURE_CONTROL0:
+            self._set(XboxHelper.PGRAPH_TEXCTL0_0 + reg_offset, data)
+        elif method == NV097_SET_TEXTURE_CONTROL1:
+            self._set(XboxHelper.PGRAPH_TEXCTL1_0 + reg_offset, data)
+
+    def _apply_surface_format(self, data):
+        color_format = _SURFACE_COLOR_FORMATS.get(data & 0xF)
+        if color_format is None:
+            self._invalidate(Texture.PGRAPH_DRAW_FORMAT)
+        else:
+            self._set(
+                Texture.PGRAPH_DRAW_FORMAT, color_format << 12, _DRAW_FORMAT_COLOR_MASK
+            )
+
+        surface_type = (data >> 8) & 0x3
+        anti_aliasing = (data >> 12) & 0x3
+        self._set(
+            Texture.PGRAPH_SURFACE_TYPE,
+            surface_type | (anti_aliasing << 4),
+            _SURFACE_TYPE_MASK,
+        )
+
+    def _apply_context_dma(self, address, handle):
+        base = self.dma_addresses.get(handle)
+        if base is None:
+            base = self.xbox_helper.lookup_dma_object_address(handle)
+            if base is None:
+                self.log(
+                    "Warning: DMA object handle 0x%08X not found in RAMHT, register 0x%08X will be read from PGRAPH"
+                    % (handle, address)
+                )
+                self._invalidate(address)
+                return
+            self.dma_addresses[handle] = base
+
+        self._set(address, base)
+
+    def _verify(self, addresses):
+        actual = self.xbox_helper.read_registers(addresses)
+        for address in addresses:
+            mask = _PARTIAL_REGISTERS.get(address, 0xFFFFFFFF)
+            expected = self.registers[address]
+            if (actual[address] ^ expected) & mask:
+                self.mismatch_count += 1
+                self.log(
+                    "Warning: Shadowed register 0x%08X value 0x%08X does not match PGRAPH (0x%08X)"
+                    % (address, expected & mask, actual[address] & mask)
+                )
+            self.registers[address] = actual[address]
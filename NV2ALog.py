@@ -3,49 +3,54 @@
 # pylint: disable=invalid-name
 # pylint: disable=consider-using-f-string
 
+from BufferedLogFile import BufferedLogFile
+
 Nv2aLogMethodDetails = False
 
 
 class NV2ALog:
     """Manages the nv2a log file."""
 
-    def __init__(self, path):
+    def __init__(self, path, background_flush=False):
         self.path = path
+        self.logfile = BufferedLogFile(path, background_flush=background_flush)
 
-        with open(self.path, "w", encoding="utf8") as logfile:
-            logfile.write("pgraph method log from nv2a-trace.py\n\n")
+        self.logfile.write("pgraph method log from nv2a-trace.py\n\n")
 
     def log(self, message):
         """Append the given string to the nv2a log."""
-        with open(self.path, "a", encoding="utf8") as logfile:
-            logfile.write(message)
+        self.logfile.write(message)
+
+    def flush(self):
+        """Writes any buffered messages to the file."""
+        self.logfile.flush()
 
     def log_method(self, method_info, data, pre_info, post_info):
         """Append a line describing the given pgraph call to the nv2a log."""
-        with open(self.path, "a", encoding="utf8") as logfile:
-            if data is not None:
-                data_str = "0x%X" % data
-            else:
-                data_str = "<NO_DATA>"
-
-            logfile.write(
-                "nv2a_pgraph_method %d: 0x%x -> 0x%x %s\n"
-                % (
-                    method_info["subchannel"],
-                    method_info["object"],
-                    method_info["method"],
-                    data_str,
-                )
+        logfile = self.logfile
+        if data is not None:
+            data_str = "0x%X" % data
+        else:
+            data_str = "<NO_DATA>"
+
+        logfile.write(
+            "nv2a_pgraph_method %d: 0x%x -> 0x%x %s\n"
+            % (
+                method_info["subchannel"],
+                method_info["object"],
+                method_info["method"],
+                data_str,
             )
-
-            if Nv2aLogMethodDetails:
-                logfile.write("Method info:\n")
-                logfile.write("Address: 0x%X\n" % method_info["address"])
-                logfile.write("Method: 0x%X\n" % method_info["method"])
-                logfile.write("Nonincreasing: %d\n" % method_info["nonincreasing"])
-                logfile.write("Subchannel: 0x%X\n" % method_info["subchannel"])
-                logfile.write("data:\n")
-                logfile.write(str(data))
-                logfile.write("\n\n")
-                logfile.write("pre_info: %s\n" % pre_info)
-                logfile.write("post_info: %s\n" % post_info)
+        )
+
+        if Nv2aLogMethodDetails:
+            logfile.write("Method info:\n")
+            logfile.write("Address: 0x%X\n" % method_info["address"])
+            logfile.write("Method: 0x%X\n" % method_info["method"])
+            logfile.write("Nonincreasing: %d\n" % method_info["nonincreasing"])
+            logfile.write("Subchannel: 0x%X\n" % method_info["subchannel"])
+            logfile.write("data:\n")
+            logfile.write(str(data))
+            logfile.write("\n\n")
+            logfile.write("pre_info: %s\n" % pre_info)
+            logfile.write("post_info: %s\n" % post_info)
@@ -0,0 +1,379 @@
+"""Pipelined asyncio transport to a debug server, and a local stand-in server.
+
+Requests are sent without waiting for the responses of previous ones, up to the
+pipeline depth, and the server answers them in order. Independent reads (e.g.,
+register lists or RDI words) therefore cost a single round-trip instead of one
+each. Every request starts with a 9 byte header (op, address, length):
+
+  READ_U32   responds with the 32-bit value at `address`
+  WRITE_U32  writes `length` to `address`
+  READ       responds with `length` bytes at `address`
+  WRITE      writes the `length` payload bytes to `address`
+  CALL       calls `address` with the `length` payload bytes as the stack and
+             responds with eax
+  ALLOCATE   allocates `address` bytes of contiguous memory, responds with its
+             address
+  FREE       frees the contiguous memory at `address`
+
+Every response starts with a 5 byte header (status, length) followed by `length`
+bytes, which are the error message if status is not 0. All values are little
+endian.
+
+The stand-in server serves the protocol from any Xbox wrapper, usually a
+SimulatedXbox, and can delay its responses to model the latency of a debug link.
+"""
+
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import atexit
+import collections
+import struct
+import threading
+
+OP_READ_U32 = 1
+OP_WRITE_U32 = 2
+OP_READ = 3
+OP_WRITE = 4
+OP_CALL = 5
+OP_ALLOCATE = 6
+OP_FREE = 7
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# Maximum number of requests awaiting a response.
+DEFAULT_DEPTH = 64
+
+_REQUEST = struct.Struct("<BLL")
+_RESPONSE = struct.Struct("<BL")
+_U32 = struct.Struct("<L")
+
+# Ops whose request carries `length` payload bytes.
+_PAYLOAD_OPS = {OP_WRITE, OP_CALL}
+
+
+class TransportError(Exception):
+    """Raised for failed requests and lost connections."""
+
+
+def _unpack_u32(data):
+    return _U32.unpack(data)[0]
+
+
+class AsyncXboxClient:
+    """Sends pipelined requests over an asyncio stream.
+
+    Requests are sent in the order they are made, responses resolve the futures of
+    the requests in the same order.
+    """
+
+    def __init__(self, reader, writer, depth=DEFAULT_DEPTH):
+        self._reader = reader
+        self._writer = writer
+        self.depth = depth
+
+        # Requests waiting for a free pipeline slot, as (data, future).
+        self._queued = collections.deque()
+
+        # Futures of the sent requests awaiting a response.
+        self._in_flight = collections.deque()
+
+        self._error = None
+        self._reader_task = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def connect(cls, host, port, depth=DEFAULT_DEPTH):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, depth)
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._reader_task.cancel()
+
+    def _request(self, op, address, length, payload=b""):
+        """Queues a request, returns a future resolving to its response."""
+        future = asyncio.get_running_loop().create_future()
+        if self._error:
+            future.set_exception(TransportError(self._error))
+            return future
+        self._queued.append((_REQUEST.pack(op, address, length) + payload, future))
+        self._send()
+        return future
+
+    def _send(self):
+        while self._queued and len(self._in_flight) < self.depth:
+            data, future = self._queued.popleft()
+            self._writer.write(data)
+            self._in_flight.append(future)
+
+    async def _read_responses(self):
+        try:
+            while True:
+                status, length = _RESPONSE.unpack(
+                    await self._reader.readexactly(_RESPONSE.size)
+                )
+                data = await self._reader.readexactly(length)
+                future = self._in_flight.popleft()
+                if status != STATUS_OK:
+                    future.set_exception(TransportError(data.decode("utf8")))
+                else:
+                    future.set_result(data)
+                self._send()
+        except (asyncio.IncompleteReadError, ConnectionError) as err:
+            self._error = "Connection lost: %s" % err
+            for future in list(self._in_flight) + [
+                future for _data, future in self._queued
+            ]:
+                if not future.done():
+                    future.set_exception(TransportError(self._error))
+            self._in_flight.clear()
+            self._queued.clear()
+
+    async def read_u32(self, address):
+        return _unpack_u32(await self._request(OP_READ_U32, address, 4))
+
+    async def read_u32_many(self, addresses):
+        futures = [self._request(OP_READ_U32, address, 4) for address in addresses]
+        return [_unpack_u32(data) for data in await asyncio.gather(*futures)]
+
+    async def write_u32(self, address, value):
+        await self._request(OP_WRITE_U32, address, value)
+
+    async def read(self, address, length):
+        return await self._request(OP_READ, address, length)
+
+    async def read_many(self, ranges):
+        futures = [
+            self._request(OP_READ, address, length) for address, length in ranges
+        ]
+        return await asyncio.gather(*futures)
+
+    async def write(self, address, data):
+        await self._request(OP_WRITE, address, len(data), bytes(data))
+
+    async def call(self, address, stack):
+        data = await self._request(OP_CALL, address, len(stack), bytes(stack))
+        return {"eax": _unpack_u32(data)}
+
+    async def allocate(self, size):
+        return _unpack_u32(await self._request(OP_ALLOCATE, size, 0))
+
+    async def free(self, address):
+        await self._request(OP_FREE, address, 0)
+
+
+class _PipelinedKernel:
+    """Implements the subset of xboxpy.ke used by nv2a-trace."""
+
+    def __init__(self, xbox):
+        self._xbox = xbox
+
+    def MmAllocateContiguousMemory(self, size):  # pylint: disable=invalid-name
+        return self._xbox.run(self._xbox.client.allocate(size))
+
+    def MmFreeContiguousMemory(self, address):  # pylint: disable=invalid-name
+        self._xbox.run(self._xbox.client.free(address))
+
+
+class PipelinedXbox:
+    """Blocking Xbox wrapper on top of an AsyncXboxClient.
+
+    The client runs on an event loop in a background thread. Every method of the
+    Xbox wrapper interface waits for its response, `read_u32_many` and `read_many`
+    keep up to `depth` of their requests in flight at once.
+    """
+
+    pipelined = True
+
+    def __init__(self, host, port, depth=DEFAULT_DEPTH):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = self.run(AsyncXboxClient.connect(host, port, depth))
+        self.ke = _PipelinedKernel(self)
+        atexit.register(self.close)
+
+    def run(self, coroutine):
+        """Runs a coroutine on the client's event loop and returns its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        self.run(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def read_u32(self, address):
+        return self.run(self.client.read_u32(address))
+
+    def read_u32_many(self, addresses):
+        return self.run(self.client.read_u32_many(addresses))
+
+    def write_u32(self, address, value):
+        self.run(self.client.write_u32(address, value))
+
+    def read(self, address, length):
+        return self.run(self.client.read(address, length))
+
+    def read_many(self, ranges):
+        return self.run(self.client.read_many(ranges))
+
+    def write(self, address, data):
+        self.run(self.client.write(address, data))
+
+    def call(self, address, stack):
+        return self.run(self.client.call(address, stack))
+
+
+class StandInServer:
+    """Serves the pipelined protocol from an Xbox wrapper, e.g., a SimulatedXbox.
+
+    Requests are executed in the order they arrive, each response is sent
+    `latency` seconds after its request was received.
+    """
+
+    def __init__(self, xbox, latency=0.0):
+        self.xbox = xbox
+        self.latency = latency
+        self.request_count = 0
+        self._server = None
+        self._loop = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Starts listening, returns the port."""
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        """Serves from an event loop in a background thread, returns the port."""
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(
+            self.start(host, port), self._loop
+        ).result()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _execute(self, op, address, length, payload):
+        """Performs a request, returns the response payload."""
+        xbox = self.xbox
+        if op == OP_READ_U32:
+            return _U32.pack(xbox.read_u32(address))
+        if op == OP_WRITE_U32:
+            xbox.write_u32(address, length)
+            return b""
+        if op == OP_READ:
+            return bytes(xbox.read(address, length))
+        if op == OP_WRITE:
+            xbox.write(address, payload)
+            return b""
+        if op == OP_CALL:
+            return _U32.pack(xbox.call(address, payload)["eax"] & 0xFFFFFFFF)
+        if op == OP_ALLOCATE:
+            return _U32.pack(xbox.ke.MmAllocateContiguousMemory(address))
+        if op == OP_FREE:
+            xbox.ke.MmFreeContiguousMemory(address)
+            return b""
+        raise TransportError("Unknown op %d" % op)
+
+    async def _handle_client(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        responses = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send_responses(responses, writer))
+        try:
+            while True:
+                header = await reader.readexactly(_REQUEST.size)
+                op, address, length = _REQUEST.unpack(header)
+                payload = b""
+                if op in _PAYLOAD_OPS:
+                    payload = await reader.readexactly(length)
+
+                self.request_count += 1
+                try:
+                    data = self._execute(op, address, length, payload)
+                    status = STATUS_OK
+                except Exception as err:  # pylint: disable=broad-except
+                    data = str(err).encode("utf8")
+                    status = STATUS_ERROR
+                responses.put_nowait(
+                    (
+                        loop.time() + self.latency,
+                        _RESPONSE.pack(status, len(data)) + data,
+                    )
+                )
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            responses.put_nowait(None)
+            await sender
+            writer.close()
+
+    @staticmethod
+    async def _send_responses(responses, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await responses.get()
+            if item is None:
+                break
+            deadline, response = item
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(response)
+            if responses.empty():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    break
+
+
+if __name__ == "__main__":
+
+    def _main():
+        # pylint: disable=import-outside-toplevel
+        import argparse
+
+        from SimulatedXbox import SimulatedXbox
+
+        parser = argparse.ArgumentParser(
+            description="Serve a simulated Xbox over the pipelined protocol."
+        )
+        parser.add_argument("--host", default="127.0.0.1", help="Address to bind.")
+        parser.add_argument("--port", type=int, default=8731, help="Port to bind.")
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Round-trip latency to inject in seconds.",
+        )
+        parser.add_argument(
+            "--image",
+            metavar="path",
+            help="Raw memory image loaded at physical address 0 of the simulated RAM.",
+        )
+        args = parser.parse_args()
+
+        xbox = SimulatedXbox()
+        if args.image:
+            with open(args.image, "rb") as image_file:
+                image = image_file.read(len(xbox.ram))
+            xbox.ram[: len(image)] = image
+
+        async def serve():
+            server = StandInServer(xbox, args.latency)
+            port = await server.start(args.host, args.port)
+            print("Serving on %s:%d" % (args.host, port))
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+
+    _main()
@@ -0,0 +1,70 @@
+"""Manages the read_pgraph_rdi.asm patch."""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=too-few-public-methods
+
+import struct
+
+from Xbox import Xbox
+import XboxHelper
+
+
+class _ReadPGRAPHRDI:
+    """Manages the read_pgraph_rdi.asm patch."""
+
+    # Initial size of the buffer receiving the RDI data, in words. This fits the
+    # largest range read by the tracer (the vertex program constants), so the buffer
+    # is normally allocated only once.
+    DEFAULT_BUFFER_WORDS = 192 * 4
+
+    def __init__(self, verbose=True):
+        self.method_addr = None
+        self.buffer_addr = None
+        self.buffer_words = 0
+        self.verbose = verbose
+
+    def _install_reader(self, xbox: Xbox):
+        if self.method_addr is not None:
+            return
+
+        with open("read_pgraph_rdi", "rb") as patch_file:
+            data = patch_file.read()
+
+        self.method_addr = XboxHelper.load_binary(xbox, data)
+        if self.verbose:
+            print("read_pgraph_rdi installed at 0x%08X" % self.method_addr)
+
+    def _reserve_buffer(self, xbox: Xbox, count: int):
+        if count <= self.buffer_words:
+            return
+
+        if self.buffer_addr is not None:
+            XboxHelper.free_allocation(xbox, self.buffer_addr)
+
+        # The RDI index may not be re-set in the middle of a read without changing
+        # the result, so the buffer must be large enough for the entire read.
+        words = max(count, self.DEFAULT_BUFFER_WORDS)
+        self.buffer_addr = XboxHelper.allocate(xbox, words * 4)
+        self.buffer_words = words
+
+    def call(self, xbox: Xbox, offset: int, count: int) -> bytes:
+        """Calls the reader with the given arguments and returns the words read."""
+        if not count:
+            return b""
+
+        self._install_reader(xbox)
+        self._reserve_buffer(xbox, count)
+
+        xbox.call(
+            self.method_addr,
+            struct.pack("<LLL", offset, count, self.buffer_addr),
+        )
+        return xbox.read(self.buffer_addr, count * 4)
+
+
+_instance = _ReadPGRAPHRDI()
+
+
+def read_pgraph_rdi(xbox: Xbox, offset: int, count: int) -> bytes:
+    """Returns `count` little endian words read from PGRAPH RDI at `offset`."""
+    return _instance.call(xbox, offset, count)
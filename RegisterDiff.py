@@ -0,0 +1,163 @@
+"""Finds the registers that differ between two dumps of a register block."""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=too-few-public-methods
+
+from collections import namedtuple
+
+import numpy as np
+
+# Offset of PGRAPH in the MMIO space.
+PGRAPH_BASE = 0x00400000
+
+# Size of a PGRAPH dump.
+PGRAPH_SIZE = 0x2000
+
+# PGRAPH registers that are ignored when comparing dumps (e.g., status and FIFO state).
+# This list was created from a CLEAR_COLOR, CLEAR
+PGRAPH_VOLATILE_REGISTERS = [
+    0x0040000C,  # 0xF3DF0479 → 0xF3DE04F9
+    0x0040002C,  # 0xF3DF37FF → 0xF3DE37FF
+    0x0040010C,  # 0x03DF0000 → 0x020000F1
+    0x0040012C,  # 0x13DF379F → 0x131A37FF
+    0x00400704,  # 0x00001D9C → 0x00001D94
+    0x00400708,  # 0x01DF0000 → 0x000000F1
+    0x0040070C,  # 0x01DF0000 → 0x000000F1
+    0x0040072C,  # 0x01DF2700 → 0x000027F1
+    0x00400740,  # 0x01DF37DD → 0x01DF37FF
+    0x00400744,  # 0x18111D9C → 0x18111D94
+    0x00400748,  # 0x01DF0011 → 0x000000F1
+    0x0040074C,  # 0x01DF0097 → 0x000000F7
+    0x00400750,  # 0x00DF005C → 0x00DF0064
+    0x00400760,  # 0x000000CC → 0x000000FF
+    0x00400764,  # 0x08001D9C → 0x08001D94
+    0x00400768,  # 0x01DF0000 → 0x000000F1
+    0x0040076C,  # 0x01DF0000 → 0x000000F1
+    0x00400788,  # 0x01DF110A → 0x000011FB
+    0x004007A0,  # 0x00200100 → 0x00201D70
+    0x004007A4,  # 0x00200100 → 0x00201D70
+    0x004007A8,  # 0x00200100 → 0x00201D70
+    0x004007AC,  # 0x00200100 → 0x00201D70
+    0x004007B0,  # 0x00200100 → 0x00201D70
+    0x004007B4,  # 0x00200100 → 0x00201D70
+    0x004007B8,  # 0x00200100 → 0x00201D70
+    0x004007BC,  # 0x00200100 → 0x00201D70
+    0x004007C0,  # 0x00000000 → 0x000006C9
+    0x004007C4,  # 0x00000000 → 0x000006C9
+    0x004007C8,  # 0x00000000 → 0x000006C9
+    0x004007CC,  # 0x00000000 → 0x000006C9
+    0x004007D0,  # 0x00000000 → 0x000006C9
+    0x004007D4,  # 0x00000000 → 0x000006C9
+    0x004007D8,  # 0x00000000 → 0x000006C9
+    0x004007DC,  # 0x00000000 → 0x000006C9
+    0x004007E0,  # 0x00000000 → 0x000006C9
+    0x004007E4,  # 0x00000000 → 0x000006C9
+    0x004007E8,  # 0x00000000 → 0x000006C9
+    0x004007EC,  # 0x00000000 → 0x000006C9
+    0x004007F0,  # 0x00000000 → 0x000006C9
+    0x004007F4,  # 0x00000000 → 0x000006C9
+    0x004007F8,  # 0x00000000 → 0x000006C9
+    0x004007FC,  # 0x00000000 → 0x000006C9
+    0x00400D6C,  # 0x00000000 → 0xFF000000
+    0x0040110C,  # 0x03DF0000 → 0x020000F1
+    0x0040112C,  # 0x13DF379F → 0x131A37FF
+    0x00401704,  # 0x00001D9C → 0x00001D94
+    0x00401708,  # 0x01DF0000 → 0x000000F1
+    0x0040170C,  # 0x01DF0000 → 0x000000F1
+    0x0040172C,  # 0x01DF2700 → 0x000027F1
+    0x00401740,  # 0x01DF37FD → 0x01DF37FF
+    0x00401744,  # 0x18111D9C → 0x18111D94
+    0x00401748,  # 0x01DF0011 → 0x000000F1
+    0x0040174C,  # 0x01DF0097 → 0x000000F7
+    0x00401750,  # 0x00DF0064 → 0x00DF006C
+    0x00401760,  # 0x000000CC → 0x000000FF
+    0x00401764,  # 0x08001D9C → 0x08001D94
+    0x00401768,  # 0x01DF0000 → 0x000000F1
+    0x0040176C,  # 0x01DF0000 → 0x000000F1
+    0x00401788,  # 0x01DF110A → 0x000011FB
+    0x004017A0,  # 0x00200100 → 0x00201D70
+    0x004017A4,  # 0x00200100 → 0x00201D70
+    0x004017A8,  # 0x00200100 → 0x00201D70
+    0x004017AC,  # 0x00200100 → 0x00201D70
+    0x004017B0,  # 0x00200100 → 0x00201D70
+    0x004017B4,  # 0x00200100 → 0x00201D70
+    0x004017B8,  # 0x00200100 → 0x00201D70
+    0x004017BC,  # 0x00200100 → 0x00201D70
+    0x004017C0,  # 0x00000000 → 0x000006C9
+    0x004017C4,  # 0x00000000 → 0x000006C9
+    0x004017C8,  # 0x00000000 → 0x000006C9
+    0x004017CC,  # 0x00000000 → 0x000006C9
+    0x004017D0,  # 0x00000000 → 0x000006C9
+    0x004017D4,  # 0x00000000 → 0x000006C9
+    0x004017D8,  # 0x00000000 → 0x000006C9
+    0x004017DC,  # 0x00000000 → 0x000006C9
+    0x004017E0,  # 0x00000000 → 0x000006C9
+    0x004017E4,  # 0x00000000 → 0x000006C9
+    0x004017E8,  # 0x00000000 → 0x000006C9
+    0x004017EC,  # 0x00000000 → 0x000006C9
+    0x004017F0,  # 0x00000000 → 0x000006C9
+    0x004017F4,  # 0x00000000 → 0x000006C9
+    0x004017F8,  # 0x00000000 → 0x000006C9
+    0x004017FC,  # 0x00000000 → 0x000006C9
+    # 0x0040186C, # 0x00000000 → 0xFF000000 # CLEAR COLOR
+    0x0040196C,  # 0x00000000 → 0xFF000000
+    0x00401C6C,  # 0x00000000 → 0xFF000000
+    0x00401D6C,  # 0x00000000 → 0xFF000000
+]
+
+# `addresses`, `old_values` and `new_values` are equally sized uint32 arrays.
+RegisterChanges = namedtuple(
+    "RegisterChanges", ["addresses", "old_values", "new_values"]
+)
+
+
+class RegisterDiff:
+    """Compares dumps of the register block at `base` of `size` bytes.
+
+    Addresses in `ignored` are never reported.
+    """
+
+    def __init__(self, base, size, ignored=()):
+        self.base = base
+        self.size = size
+
+        self.mask = np.ones(size // 4, dtype=bool)
+        indices = (np.asarray(ignored, dtype=np.int64) - base) // 4
+        self.mask[indices[(indices >= 0) & (indices < self.mask.size)]] = False
+
+    def compare(self, before: bytes, after: bytes) -> RegisterChanges:
+        """Returns the registers whose value differs between the two dumps."""
+        old_words = np.frombuffer(before, dtype="<u4", count=self.mask.size)
+        new_words = np.frombuffer(after, dtype="<u4", count=self.mask.size)
+        changed = np.flatnonzero((old_words != new_words) & self.mask)
+        return RegisterChanges(
+            self.base + changed.astype(np.uint32) * 4,
+            old_words[changed],
+            new_words[changed],
+        )
+
+
+class MethodDiffHook:
+    """Reports the register changes caused by a method.
+
+    `pre` and `post` are meant to be installed with Tracer.add_method_hooks, `dump`
+    returns the current contents of the register block and `report` is called with
+    the RegisterChanges once the method has been processed.
+    """
+
+    def __init__(self, dump, diff: RegisterDiff, report):
+        self.dump = dump
+        self.diff = diff
+        self.report = report
+        self.before = None
+
+    def pre(self, _data, *_args):
+        self.before = self.dump()
+        return []
+
+    def post(self, _data, *_args):
+        if self.before is None:
+            return []
+        changes = self.diff.compare(self.before, self.dump())
+        self.before = None
+        return self.report(changes) or []
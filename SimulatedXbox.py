@@ -0,0 +1,380 @@
+"""Provides an in-process stand-in for an Xbox, used for benchmarking."""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=invalid-name
+# pylint: disable=too-few-public-methods
+
+from collections import Counter
+import struct
+import time
+
+import ChecksumMemory
+import XboxHelper
+
+# Size of the simulated main memory.
+DEFAULT_RAM_SIZE = 64 * 1024 * 1024
+
+# Size of the MMIO window starting at XboxHelper.NV2A_MMIO_BASE.
+MMIO_SIZE = 0x1000000
+
+# Number of method / data pairs that fit into CACHE1.
+CACHE1_SIZE = 127
+
+# Results of the kick_fifo and step_fifo patches.
+STATE_OK = 0x1337C0DE
+STATE_BUSY = 0x32555359
+STATE_INVALID_READ_PUSH_ADDR = 0xBAD0000
+
+# Bits of NV_PFIFO_CACHE1_DMA_PUSH.
+_DMA_PUSH_ACCESS = 0x00000001
+_DMA_PUSH_BUFFER_NOT_EMPTY = 0x00000100
+
+# Registers whose modification may let the pusher or the puller make progress.
+_PFIFO_CONTROL_REGISTERS = {
+    XboxHelper.DMA_PUSH_ADDR,
+    XboxHelper.CACHE_PUSH_STATE,
+    XboxHelper.CACHE_PULL_STATE,
+    XboxHelper.PGRAPH_STATE,
+}
+
+
+class _SimulatedKernel:
+    """Implements the subset of xboxpy.ke used by nv2a-trace."""
+
+    def __init__(self, xbox):
+        self.xbox = xbox
+        # Allocations are handed out from the top of memory downwards.
+        self.next_allocation = len(xbox.ram)
+
+    def MmAllocateContiguousMemory(self, size):
+        self.xbox.count_round_trip("ke")
+        self.next_allocation -= (size + 0xFFF) & ~0xFFF
+        return self.next_allocation
+
+    def MmFreeContiguousMemory(self, _address):
+        self.xbox.count_round_trip("ke")
+
+
+def _load_patches(names):
+    """Returns a dict mapping the contents of each of the given patches to its name."""
+    ret = {}
+    for name in names:
+        with open(name, "rb") as patch_file:
+            ret[patch_file.read()] = name
+    return ret
+
+
+class SimulatedXbox:
+    """Implements the Xbox wrapper interface on top of a local memory image.
+
+    Contiguous (0x80000000) and AGP (0xF0000000) addresses alias the simulated
+    RAM, MMIO reads and writes go to a sparse register file. Every operation counts
+    as one round-trip and may be delayed by `latency` seconds to model the debug
+    link.
+
+    Patches uploaded via XboxHelper.load_binary are recognized by their contents
+    and `call`s to them are serviced by an equivalent Python implementation.
+
+    PFIFO is modelled at the level the tracer observes it: while DMA_PUSH access is
+    enabled the pusher moves the pushbuffer words between DMA_GET and DMA_PUT into
+    CACHE1, one method / data pair per entry, and while the PGRAPH FIFO is enabled
+    the puller executes every entry in CACHE1. Executed methods are appended to
+    `executed_methods` as (subchannel, method, data) if it is not None and passed to
+    the matching `method_handlers` callback, which may emulate their side effects.
+    PGRAPH is always idle.
+    """
+
+    # Patches that may be called on the simulated xbox.
+    SIMULATED_PATCHES = [
+        "checksum_memory",
+        "exchange_u32",
+        "kick_fifo",
+        "read_pgraph_rdi",
+        "read_registers",
+        "step_fifo",
+    ]
+
+    NV10_PGRAPH_RDI_INDEX = 0xFD400750
+    NV10_PGRAPH_RDI_DATA = 0xFD400754
+
+    def __init__(self, ram_size=DEFAULT_RAM_SIZE, latency=0.0):
+        self.ram = bytearray(ram_size)
+        self.registers = {}
+        # Maps {RDI index: value}, DATA reads return the value at INDEX and advance it.
+        self.rdi = {}
+        self.rdi_index = 0
+        self.latency = latency
+        self.round_trips = Counter()
+        self.bytes_read = 0
+        self.ke = _SimulatedKernel(self)
+        self._patch_contents = _load_patches(self.SIMULATED_PATCHES)
+        self._routines = {}
+
+        self.cache1 = []
+        self.executed_method_count = 0
+        self.executed_methods = None
+
+        # Maps {method: callback(subchannel, data)} called for executed methods.
+        self.method_handlers = {}
+        self._dma_method = 0
+        self._dma_subchannel = 0
+        self._dma_method_count = 0
+        self._dma_non_increasing = False
+        self.registers[XboxHelper.CACHE_PULL_STATE] = 1
+
+    def reset_pfifo(self, dma_pull_addr, dma_push_addr=None):
+        """Empties CACHE1 and sets DMA_GET and DMA_PUT, pausing the pusher.
+
+        DMA_PUT defaults to `dma_pull_addr`, hiding the pushbuffer from the pusher as
+        the tracer expects on startup. The PGRAPH FIFO is enabled.
+        """
+        self.cache1 = []
+        self._dma_method_count = 0
+        self.registers[XboxHelper.DMA_PULL_ADDR] = dma_pull_addr
+        self.registers[XboxHelper.DMA_PUSH_ADDR] = (
+            dma_pull_addr if dma_push_addr is None else dma_push_addr
+        )
+        self.registers[XboxHelper.CACHE_PUSH_STATE] = 0
+        self.registers[XboxHelper.PGRAPH_STATE] = 1
+        self._update_pfifo()
+
+    def count_round_trip(self, operation):
+        self.round_trips[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def total_round_trips(self):
+        return sum(self.round_trips.values())
+
+    def reset_statistics(self):
+        self.round_trips.clear()
+        self.bytes_read = 0
+
+    @staticmethod
+    def _is_mmio(address):
+        return (
+            XboxHelper.NV2A_MMIO_BASE <= address < XboxHelper.NV2A_MMIO_BASE + MMIO_SIZE
+        )
+
+    def _ram_offset(self, address, length):
+        offset = address & 0x0FFFFFFF
+        if offset + length > len(self.ram):
+            raise Exception(
+                "Access to 0x%08X (%d bytes) is outside of RAM" % (address, length)
+            )
+        return offset
+
+    def read_mmio(self, address):
+        """Returns the value of an MMIO register without counting a round-trip."""
+        if address == self.NV10_PGRAPH_RDI_DATA:
+            value = self.rdi.get(self.rdi_index, 0)
+            self.rdi_index += 1
+            return value
+        return self.registers.get(address, 0)
+
+    def write_mmio(self, address, value):
+        """Sets the value of an MMIO register without counting a round-trip."""
+        if address == self.NV10_PGRAPH_RDI_INDEX:
+            self.rdi_index = value
+        self.registers[address] = value & 0xFFFFFFFF
+        if address in _PFIFO_CONTROL_REGISTERS:
+            self._update_pfifo()
+
+    def _update_pfifo(self):
+        """Runs the pusher and the puller until neither can make progress."""
+        registers = self.registers
+        while True:
+            progress = False
+            if registers.get(XboxHelper.CACHE_PUSH_STATE, 0) & _DMA_PUSH_ACCESS:
+                progress = self._run_pusher()
+            if (
+                registers.get(XboxHelper.PGRAPH_STATE, 0) & 1
+                and registers.get(XboxHelper.CACHE_PULL_STATE, 0) & 1
+                and self.cache1
+            ):
+                self._run_puller()
+                progress = True
+            if not progress:
+                break
+
+        get = registers.get(XboxHelper.DMA_PULL_ADDR, 0)
+        put = registers.get(XboxHelper.DMA_PUSH_ADDR, 0)
+        push_state = registers.get(XboxHelper.CACHE_PUSH_STATE, 0)
+        if get != put:
+            push_state |= _DMA_PUSH_BUFFER_NOT_EMPTY
+        else:
+            push_state &= ~_DMA_PUSH_BUFFER_NOT_EMPTY
+        registers[XboxHelper.CACHE_PUSH_STATE] = push_state
+        registers[XboxHelper.DMA_STATE] = (
+            int(self._dma_non_increasing)
+            | (self._dma_method << 2)
+            | (self._dma_subchannel << 13)
+            | (self._dma_method_count << 18)
+        )
+        registers[XboxHelper.CACHE_PUSH_ADDR] = (len(self.cache1) * 8) & 0x3FF
+        registers[XboxHelper.CACHE_PULL_ADDR] = 0
+
+    def _run_pusher(self):
+        """Moves pushbuffer words into CACHE1, returns True if any were consumed."""
+        registers = self.registers
+        get = registers.get(XboxHelper.DMA_PULL_ADDR, 0)
+        put = registers.get(XboxHelper.DMA_PUSH_ADDR, 0)
+        start = get
+        while get != put and len(self.cache1) < CACHE1_SIZE:
+            word = struct.unpack_from("<L", self.ram, self._ram_offset(get, 4))[0]
+            get += 4
+            if self._dma_method_count:
+                self.cache1.append((self._dma_subchannel, self._dma_method, word))
+                self._dma_method_count -= 1
+                if not self._dma_non_increasing:
+                    self._dma_method += 4
+                continue
+
+            if (word & 0xE0000003) == 0x20000000:
+                get = word & 0x1FFFFFFC
+            elif (word & 3) == 1:
+                get = word & 0xFFFFFFFC
+            elif (word & 0xE0030003) in (0, 0x40000000):
+                self._dma_method = word & 0x1FFF
+                self._dma_subchannel = (word >> 13) & 7
+                self._dma_method_count = (word >> 18) & 0x7FF
+                self._dma_non_increasing = (word & 0xE0030003) == 0x40000000
+            else:
+                raise Exception(
+                    "Unsupported pushbuffer word 0x%08X at 0x%08X" % (word, get - 4)
+                )
+        registers[XboxHelper.DMA_PULL_ADDR] = get
+        return get != start
+
+    def _run_puller(self):
+        if self.executed_methods is not None:
+            self.executed_methods.extend(self.cache1)
+        self.executed_method_count += len(self.cache1)
+        if self.method_handlers:
+            for subchannel, method, data in self.cache1:
+                handler = self.method_handlers.get(method)
+                if handler:
+                    handler(subchannel, data)
+        self.cache1 = []
+
+    def peek_u32(self, address):
+        """Returns the 32-bit value at `address` without counting a round-trip."""
+        if self._is_mmio(address):
+            return self.read_mmio(address)
+        return struct.unpack_from("<L", self.ram, self._ram_offset(address, 4))[0]
+
+    def poke_u32(self, address, value):
+        """Sets the 32-bit value at `address` without counting a round-trip."""
+        if self._is_mmio(address):
+            self.write_mmio(address, value)
+            return
+        struct.pack_into("<L", self.ram, self._ram_offset(address, 4), value)
+
+    def read_u32(self, address):
+        self.count_round_trip("read_u32")
+        self.bytes_read += 4
+        return self.peek_u32(address)
+
+    def write_u32(self, address, value):
+        self.count_round_trip("write_u32")
+        self.poke_u32(address, value)
+
+    def read(self, address, length):
+        self.count_round_trip("read")
+        self.bytes_read += length
+        if self._is_mmio(address):
+            return b"".join(
+                struct.pack("<L", self.read_mmio(address + i))
+                for i in range(0, length, 4)
+            )
+        offset = self._ram_offset(address, length)
+        return bytes(self.ram[offset : offset + length])
+
+    def write(self, address, data):
+        self.count_round_trip("write")
+        if self._is_mmio(address):
+            for i in range(0, len(data), 4):
+                self.write_mmio(address + i, struct.unpack_from("<L", data, i)[0])
+            return
+        offset = self._ram_offset(address, len(data))
+        self.ram[offset : offset + len(data)] = data
+
+        patch = self._patch_contents.get(bytes(data))
+        if patch:
+            self._routines[address] = getattr(self, "_call_" + patch)
+        else:
+            self._routines.pop(address, None)
+
+    def call(self, address, stack):
+        self.count_round_trip("call")
+        routine = self._routines.get(address)
+        if not routine:
+            raise Exception("No simulated routine at 0x%08X" % address)
+        args = struct.unpack("<%dL" % (len(stack) // 4), stack)
+        return {"eax": routine(*args) & 0xFFFFFFFF}
+
+    def _call_exchange_u32(self, value, address):
+        ret = self.peek_u32(address)
+        self.poke_u32(address, value)
+        return ret
+
+    def _kick(self):
+        """Performs the kick shared by kick_fifo.asm and step_fifo.asm."""
+        state = self.read_mmio(XboxHelper.CACHE_PUSH_STATE)
+        self.write_mmio(XboxHelper.CACHE_PUSH_STATE, state | _DMA_PUSH_ACCESS)
+        state = self.read_mmio(XboxHelper.CACHE_PUSH_STATE)
+        self.write_mmio(XboxHelper.CACHE_PUSH_STATE, state & ~_DMA_PUSH_ACCESS)
+        if state & _DMA_PUSH_BUFFER_NOT_EMPTY:
+            return STATE_BUSY
+        return STATE_OK
+
+    def _call_kick_fifo(self, expected_push):
+        if self.read_mmio(XboxHelper.DMA_PUSH_ADDR) != expected_push:
+            return STATE_INVALID_READ_PUSH_ADDR
+        return self._kick()
+
+    def _call_step_fifo(self, target, expected_push, result, max_iterations):
+        state = STATE_BUSY
+        for _ in range(max(max_iterations, 1)):
+            state = self.read_mmio(XboxHelper.PGRAPH_STATE)
+            self.write_mmio(XboxHelper.PGRAPH_STATE, state & ~1)
+
+            replaced = self._call_exchange_u32(target, XboxHelper.DMA_PUSH_ADDR)
+            self.poke_u32(result + 8, replaced)
+            if replaced != expected_push:
+                state = self.read_mmio(XboxHelper.PGRAPH_STATE)
+                self.write_mmio(XboxHelper.PGRAPH_STATE, state | 1)
+                state = STATE_INVALID_READ_PUSH_ADDR
+                break
+            expected_push = target
+
+            self._kick()
+
+            state = self.read_mmio(XboxHelper.PGRAPH_STATE)
+            self.write_mmio(XboxHelper.PGRAPH_STATE, state | 1)
+
+            state = STATE_OK
+            if self.read_mmio(XboxHelper.DMA_PULL_ADDR) == target:
+                break
+            state = STATE_BUSY
+
+        self.poke_u32(result, self.read_mmio(XboxHelper.DMA_PULL_ADDR))
+        self.poke_u32(result + 4, self.read_mmio(XboxHelper.DMA_PUSH_ADDR))
+        return state
+
+    def _call_checksum_memory(self, address, length):
+        offset = self._ram_offset(address, length)
+        return ChecksumMemory.reference_checksum(self.ram[offset : offset + length])
+
+    def _call_read_pgraph_rdi(self, offset, count, buffer):
+        self.write_mmio(self.NV10_PGRAPH_RDI_INDEX, offset)
+        for i in range(count):
+            self.poke_u32(buffer + i * 4, self.read_mmio(self.NV10_PGRAPH_RDI_DATA))
+        return count
+
+    def _call_read_registers(self, address_list, count, values):
+        for i in range(count):
+            register = self.peek_u32(address_list + i * 4)
+            self.poke_u32(values + i * 4, self.peek_u32(register))
+        return count
@@ -0,0 +1,97 @@
+"""Manages the step_fifo.asm patch."""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=too-few-public-methods
+
+from collections import namedtuple
+import struct
+
+from Xbox import Xbox
+import XboxHelper
+
+# Default number of CACHE sized chunks the stepper runs before giving up.
+DEFAULT_MAX_ITERATIONS = 32
+
+StepResult = namedtuple(
+    "StepResult", ["state", "dma_pull_addr", "dma_push_addr", "replaced_push_addr"]
+)
+
+
+class _StepFIFO:
+    """Manages the step_fifo.asm patch.
+
+    The states match the ones reported by kick_fifo.asm.
+    """
+
+    # GET reached the target.
+    STATE_OK = 0x1337C0DE
+
+    # GET did not reach the target within the iteration limit, or PGRAPH did not
+    # become idle.
+    STATE_BUSY = 0x32555359
+
+    # xbox.DMA_PUSH_ADDR != `expected_push` when it was exchanged with the target.
+    # The target has been written regardless.
+    STATE_INVALID_READ_PUSH_ADDR = 0xBAD0000
+
+    # xbox.DMA_PUSH_ADDR changed during the course of a kick
+    STATE_INVALID_PUSH_MODIFIED_IN_CALL = 0xBADBAD
+
+    def __init__(self, verbose=True):
+        self.method_addr = None
+        self.result_addr = None
+        self.verbose = verbose
+
+    def _install_stepper(self, xbox):
+        if self.method_addr is not None:
+            return
+
+        with open("step_fifo", "rb") as patch_file:
+            data = patch_file.read()
+
+        self.method_addr = XboxHelper.load_binary(xbox, data)
+        self.result_addr = XboxHelper.load_binary(xbox, bytes(12))
+        if self.verbose:
+            print("step_fifo installed at 0x%08X" % self.method_addr)
+
+    def call(
+        self,
+        xbox: Xbox,
+        target: int,
+        expected_push: int,
+        max_iterations=DEFAULT_MAX_ITERATIONS,
+    ) -> StepResult:
+        """Calls the stepper with the given arguments."""
+        self._install_stepper(xbox)
+
+        eax = xbox.call(
+            self.method_addr,
+            struct.pack(
+                "<LLLL", target, expected_push, self.result_addr, max_iterations
+            ),
+        )["eax"]
+
+        # Success implies that both GET and PUT are at the target, so the result
+        # block only needs to be fetched when something went wrong.
+        if eax == self.STATE_OK:
+            return StepResult(eax, target, target, expected_push)
+
+        dma_pull_addr, dma_push_addr, replaced_push_addr = struct.unpack(
+            "<LLL", xbox.read(self.result_addr, 12)
+        )
+        return StepResult(eax, dma_pull_addr, dma_push_addr, replaced_push_addr)
+
+
+_stepper = _StepFIFO()
+
+STATE_OK = _StepFIFO.STATE_OK
+STATE_BUSY = _StepFIFO.STATE_BUSY
+STATE_INVALID_READ_PUSH_ADDR = _StepFIFO.STATE_INVALID_READ_PUSH_ADDR
+STATE_INVALID_PUSH_MODIFIED_IN_CALL = _StepFIFO.STATE_INVALID_PUSH_MODIFIED_IN_CALL
+
+
+def step(
+    xbox: Xbox, target: int, expected_push: int, max_iterations=DEFAULT_MAX_ITERATIONS
+) -> StepResult:
+    """Runs the PFIFO until DMA_PULL_ADDR reaches `target` in a single call."""
+    return _stepper.call(xbox, target, expected_push, max_iterations)
@@ -9,11 +9,12 @@
 # FIXME: Move to xboxpy.NV2A.PGRAPH.Texture
 
 from collections import namedtuple
+import functools
+import numpy as np
 from PIL import Image
 
 from Xbox import Xbox
 import XboxHelper
-from xboxpy import nv2a
 
 # Value that may be added to contiguous memory addresses to access as ADDR_AGPMEM, which
 # is guaranteed to be linear (and thus may be slower than tiled ADDR_FBMEM but can be
@@ -53,6 +54,158 @@ X1R5G5B5 = TextureDescription(16, (5, 5, 5), (10, 5, 0))
 A8R8G8B8 = TextureDescription(32, (8, 8, 8, 8), (16, 8, 0, 24))
 X8R8G8B8 = TextureDescription(32, (8, 8, 8), (16, 8, 0))
 
+# PGRAPH registers describing the render target.
+PGRAPH_COLOR_PITCH = 0xFD400858
+PGRAPH_ZETA_PITCH = 0xFD40085C
+PGRAPH_COLOR_OFFSET = 0xFD400828
+PGRAPH_ZETA_OFFSET = 0xFD40082C
+PGRAPH_COLOR_BASE = 0xFD400840
+PGRAPH_ZETA_BASE = 0xFD400844
+PGRAPH_SURFACE_CLIP_X = 0xFD4019B4
+PGRAPH_SURFACE_CLIP_Y = 0xFD4019B8
+PGRAPH_DRAW_FORMAT = 0xFD400804
+PGRAPH_SURFACE_TYPE = 0xFD400710
+PGRAPH_SWIZZLE_UNK = 0xFD400818
+PGRAPH_SWIZZLE_UNK2 = 0xFD40086C
+
+# Registers decoded by texture_parameters_from_registers, read as a single batch.
+SURFACE_REGISTERS = [
+    PGRAPH_COLOR_PITCH,
+    PGRAPH_ZETA_PITCH,
+    PGRAPH_COLOR_OFFSET,
+    PGRAPH_ZETA_OFFSET,
+    PGRAPH_COLOR_BASE,
+    PGRAPH_ZETA_BASE,
+    PGRAPH_SURFACE_CLIP_X,
+    PGRAPH_SURFACE_CLIP_Y,
+    PGRAPH_DRAW_FORMAT,
+    PGRAPH_SURFACE_TYPE,
+    PGRAPH_SWIZZLE_UNK,
+    PGRAPH_SWIZZLE_UNK2,
+]
+
+
+# Maps bits per pixel to the numpy type used to view a row of raw pixel data.
+_PIXEL_DTYPES = {
+    8: np.dtype(np.uint8),
+    16: np.dtype("<u2"),
+    32: np.dtype("<u4"),
+}
+
+
+# Maximum number of (width, height, depth) swizzle tables kept in memory.
+SWIZZLE_TABLE_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=None)
+def _get_channel_expansion_table(channel_size):
+    """Returns a lookup table expanding a channel_size bit value to 8 bits."""
+    max_value = (1 << channel_size) - 1
+    # Normalize through a float to match the historical per-pixel conversion.
+    return np.array(
+        [int(value / max_value * 0xFF) for value in range(max_value + 1)],
+        dtype=np.uint8,
+    )
+
+
+def _generate_swizzle_masks(width, height, depth):
+    """Returns the address bits used by the x, y and z coordinates of a swizzle."""
+    mask_x = 0
+    mask_y = 0
+    mask_z = 0
+    bit = 1
+    mask_bit = 1
+    done = False
+    while not done:
+        done = True
+        if bit < width:
+            mask_x |= mask_bit
+            mask_bit <<= 1
+            done = False
+        if bit < height:
+            mask_y |= mask_bit
+            mask_bit <<= 1
+            done = False
+        if bit < depth:
+            mask_z |= mask_bit
+            mask_bit <<= 1
+            done = False
+        bit <<= 1
+    assert mask_x ^ mask_y ^ mask_z == (mask_bit - 1)
+    return mask_x, mask_y, mask_z
+
+
+def _fill_swizzle_pattern(mask, count):
+    """Deposits the bits of every coordinate in range(count) into `mask`."""
+    values = np.arange(count, dtype=np.intp)
+    result = np.zeros(count, dtype=np.intp)
+    value_bit = 0
+    for mask_bit in range(mask.bit_length()):
+        if mask & (1 << mask_bit):
+            result |= ((values >> value_bit) & 1) << mask_bit
+            value_bit += 1
+    return result
+
+
+@functools.lru_cache(maxsize=SWIZZLE_TABLE_CACHE_SIZE)
+def _get_unswizzle_table(width, height, depth):
+    """Returns the swizzled pixel index of every (z, y, x) texel.
+
+    Tables only depend on the texture dimensions as they are applied to whole
+    pixels, so all formats of the same size share a single table.
+    """
+    mask_x, mask_y, mask_z = _generate_swizzle_masks(width, height, depth)
+    table = (
+        _fill_swizzle_pattern(mask_z, depth)[:, None, None]
+        | _fill_swizzle_pattern(mask_y, height)[None, :, None]
+        | _fill_swizzle_pattern(mask_x, width)[None, None, :]
+    )
+    table.flags.writeable = False
+    return table
+
+
+def unswizzle(data, bits_per_pixel, size):
+    """Unswizzles the given texture data into an array of pixels.
+
+    `size` is a (width, height) or (width, height, depth) tuple. The returned array
+    has the shape (depth, height, width).
+    """
+    width = size[0]
+    height = size[1]
+    depth = size[2] if len(size) > 2 else 1
+
+    pixel_dtype = _PIXEL_DTYPES.get(bits_per_pixel)
+    if pixel_dtype is None:
+        raise Exception("Unsupported bits_per_pixel %d" % bits_per_pixel)
+
+    table = _get_unswizzle_table(width, height, depth)
+    pixel_count = width * height * depth
+    bytes_per_pixel = pixel_dtype.itemsize
+    if len(data) < pixel_count * bytes_per_pixel:
+        # Treat anything past the end of the data as 0, like an uninitialized texel.
+        data = bytes(data) + bytes(pixel_count * bytes_per_pixel - len(data))
+
+    pixels = np.frombuffer(data, dtype=pixel_dtype, count=pixel_count)
+    return pixels[table]
+
+
+def _expand_channels(pixel_bits, channel_sizes, channel_offsets):
+    """Converts an array of packed pixels into a PIL.Image."""
+    if len(channel_sizes) not in (3, 4):
+        raise Exception("Unsupported channel_sizes %d" % len(channel_sizes))
+
+    height, width = pixel_bits.shape
+    pixels = np.zeros((height, width, len(channel_sizes)), dtype=np.uint8)
+    for index, (channel_offset, channel_size) in enumerate(
+        zip(channel_offsets, channel_sizes)
+    ):
+        if channel_size <= 0:
+            continue
+        channel_values = (pixel_bits >> channel_offset) & ((1 << channel_size) - 1)
+        pixels[:, :, index] = _get_channel_expansion_table(channel_size)[channel_values]
+
+    return Image.fromarray(pixels)
+
 
 def _decode_texture(
     data, size, pitch, swizzled, bits_per_pixel, channel_sizes, channel_offsets
@@ -60,59 +213,58 @@ def _decode_texture(
     """Convert the given texture data into a PIL.Image."""
 
     # Check argument sanity
-    assert len(size) == 2  # FIXME: Support 1D and 3D?
+    assert len(size) == 2  # FIXME: Support 1D?
     assert len(channel_offsets) == len(channel_sizes)
 
-    # Helper function to extract integer at bit offset with bit size
-    def get_bits(bits, offset, length):
-        mask = (1 << length) - 1
-        return (bits >> offset) & mask
-
     width = size[0]
     height = size[1]
 
-    if len(channel_sizes) == 3:
-        mode = "RGB"
-    elif len(channel_sizes) == 4:
-        mode = "RGBA"
-    else:
-        raise Exception("Unsupported channel_sizes %d" % len(channel_sizes))
-
-    img = Image.new(mode, (width, height))
-
     # TODO: Is unswizzling actually necessary if textures are read via AGP?
     # Need to set up a swizzled test case and verify behavior.
-
-    # FIXME: Unswizzle data on the fly instead
     if swizzled:
-        data = nv2a.Unswizzle(data, bits_per_pixel, (width, height), pitch)
-
-    pixels = img.load()  # create the pixel map
+        return _expand_channels(
+            unswizzle(data, bits_per_pixel, size)[0], channel_sizes, channel_offsets
+        )
 
     assert bits_per_pixel % 8 == 0
+    pixel_dtype = _PIXEL_DTYPES.get(bits_per_pixel)
+    if pixel_dtype is None:
+        raise Exception("Unsupported bits_per_pixel %d" % bits_per_pixel)
 
-    for y in range(height):
-        for x in range(width):
+    # Drop any padding between the end of a row and the pitch, then view each row as
+    # an array of whole pixels.
+    rows = np.frombuffer(data, dtype=np.uint8, count=pitch * height)
+    rows = rows.reshape(height, pitch)[:, : width * bits_per_pixel // 8]
+    pixel_bits = np.ascontiguousarray(rows).view(pixel_dtype)
 
-            pixel_offset = y * pitch + x * bits_per_pixel // 8
-            pixel_bytes = data[pixel_offset : pixel_offset + bits_per_pixel // 8]
-            pixel_bits = int.from_bytes(pixel_bytes, byteorder="little")
+    return _expand_channels(pixel_bits, channel_sizes, channel_offsets)
 
-            pixel_channels = ()
-            for channel_offset, channel_size in zip(channel_offsets, channel_sizes):
-                channel_value = get_bits(pixel_bits, channel_offset, channel_size)
 
-                # Normalize channel
-                if channel_size > 0:
-                    channel_value /= (1 << channel_size) - 1
-                    channel_value = int(channel_value * 0xFF)
-                else:
-                    channel_value = 0x00
-
-                pixel_channels += (channel_value,)
-            pixels[x, y] = pixel_channels
+def _decode_volume_texture(
+    data, size, swizzled, bits_per_pixel, channel_sizes, channel_offsets
+):
+    """Convert the given 3D texture data into a list of PIL.Image layers."""
+    width, height, depth = size
 
-    return img
+    if swizzled:
+        layers = unswizzle(data, bits_per_pixel, size)
+        return [
+            _expand_channels(layer, channel_sizes, channel_offsets) for layer in layers
+        ]
+
+    layer_size = width * height * bits_per_pixel // 8
+    return [
+        _decode_texture(
+            data[layer * layer_size : (layer + 1) * layer_size],
+            (width, height),
+            width * bits_per_pixel // 8,
+            False,
+            bits_per_pixel,
+            channel_sizes,
+            channel_offsets,
+        )
+        for layer in range(depth)
+    ]
 
 
 def surface_color_format_to_texture_format(fmt, swizzled):
@@ -160,27 +312,34 @@ def surface_zeta_format_to_texture_format(fmt, swizzled, is_float):
 
 def read_texture_parameters(xbox: Xbox) -> TextureParameters:
     """Reads the current texture state"""
-    color_pitch = xbox.read_u32(0xFD400858)
-    depth_pitch = xbox.read_u32(0xFD40085C)
+    return texture_parameters_from_registers(
+        XboxHelper.read_registers(xbox, SURFACE_REGISTERS)
+    )
 
-    color_offset = xbox.read_u32(0xFD400828)
-    depth_offset = xbox.read_u32(0xFD40082C)
 
-    color_base = xbox.read_u32(0xFD400840)
-    depth_base = xbox.read_u32(0xFD400844)
+def texture_parameters_from_registers(registers) -> TextureParameters:
+    """Decodes the texture state from {address: value} of the SURFACE_REGISTERS."""
+    color_pitch = registers[PGRAPH_COLOR_PITCH]
+    depth_pitch = registers[PGRAPH_ZETA_PITCH]
+
+    color_offset = registers[PGRAPH_COLOR_OFFSET]
+    depth_offset = registers[PGRAPH_ZETA_OFFSET]
+
+    color_base = registers[PGRAPH_COLOR_BASE]
+    depth_base = registers[PGRAPH_ZETA_BASE]
 
     # FIXME: Is this correct? pbkit uses _base, but D3D seems to use _offset?
     color_offset += color_base
     depth_offset += depth_base
 
-    surface_clip_x = xbox.read_u32(0xFD4019B4)
-    surface_clip_y = xbox.read_u32(0xFD4019B8)
+    surface_clip_x = registers[PGRAPH_SURFACE_CLIP_X]
+    surface_clip_y = registers[PGRAPH_SURFACE_CLIP_Y]
 
-    draw_format = xbox.read_u32(0xFD400804)
-    surface_type = xbox.read_u32(0xFD400710)
-    swizzle_unk = xbox.read_u32(0xFD400818)
+    draw_format = registers[PGRAPH_DRAW_FORMAT]
+    surface_type = registers[PGRAPH_SURFACE_TYPE]
+    swizzle_unk = registers[PGRAPH_SWIZZLE_UNK]
 
-    swizzle_unk2 = xbox.read_u32(0xFD40086C)
+    swizzle_unk2 = registers[PGRAPH_SWIZZLE_UNK2]
 
     clip_x = (surface_clip_x >> 0) & 0xFFFF
     clip_y = (surface_clip_y >> 0) & 0xFFFF
@@ -234,26 +393,33 @@ def read_texture_parameters(xbox: Xbox) -> TextureParameters:
     )
 
 
+# Maps texture formats that are decoded by _decode_texture to (swizzled, description).
+_DECODED_TEXTURE_FORMATS = {
+    0x0: (True, Y8),
+    0x1: (True, AY8),
+    0x2: (True, A1R5G5B5),
+    0x3: (True, X1R5G5B5),
+    0x4: (True, A4R4G4B4),
+    0x5: (True, R5G6B5),
+    0x6: (True, A8R8G8B8),
+    0x7: (True, X8R8G8B8),
+    0x10: (False, A1R5G5B5),
+    0x11: (False, R5G6B5),
+    0x12: (False, A8R8G8B8),
+    0x19: (True, A8),
+    0x1A: (True, A8Y8),
+    0x1C: (False, X1R5G5B5),
+    0x1D: (False, A4R4G4B4),
+    0x1E: (False, X8R8G8B8),
+}
+
+
 def dump_texture(xbox, offset, pitch, fmt_color, width, height):
     """Convert the texture at the given offset into a PIL.Image."""
     img = None
 
-    if fmt_color == 0x0:
-        tex_info = (True, Y8)
-    elif fmt_color == 0x1:
-        tex_info = (True, AY8)
-    elif fmt_color == 0x2:
-        tex_info = (True, A1R5G5B5)
-    elif fmt_color == 0x3:
-        tex_info = (True, X1R5G5B5)
-    elif fmt_color == 0x4:
-        tex_info = (True, A4R4G4B4)
-    elif fmt_color == 0x5:
-        tex_info = (True, R5G6B5)
-    elif fmt_color == 0x6:
-        tex_info = (True, A8R8G8B8)
-    elif fmt_color == 0x7:
-        tex_info = (True, X8R8G8B8)
+    if fmt_color in _DECODED_TEXTURE_FORMATS:
+        tex_info = _DECODED_TEXTURE_FORMATS[fmt_color]
     elif fmt_color == 0xB:
         img = Image.new(
             "RGB", (width, height), (255, 0, 255, 255)
@@ -267,22 +433,6 @@ def dump_texture(xbox, offset, pitch, fmt_color, width, height):
     elif fmt_color == 0xF:  # DXT5
         data = xbox.read(AGP_MEMORY_BASE | offset, width * height * 1)
         img = Image.frombytes("RGBA", (width, height), data, "bcn", 3)  # DXT5
-    elif fmt_color == 0x10:
-        tex_info = (False, A1R5G5B5)
-    elif fmt_color == 0x11:
-        tex_info = (False, R5G6B5)
-    elif fmt_color == 0x12:
-        tex_info = (False, A8R8G8B8)
-    elif fmt_color == 0x19:
-        tex_info = (True, A8)
-    elif fmt_color == 0x1A:
-        tex_info = (True, A8Y8)
-    elif fmt_color == 0x1C:
-        tex_info = (False, X1R5G5B5)
-    elif fmt_color == 0x1D:
-        tex_info = (False, A4R4G4B4)
-    elif fmt_color == 0x1E:
-        tex_info = (False, X8R8G8B8)
     elif fmt_color == 0x2E:
         img = Image.new(
             "RGB", (width, height), (255, 0, 255, 255)
@@ -324,3 +474,44 @@ def dump_texture(xbox, offset, pitch, fmt_color, width, height):
         )
 
     return img
+
+
+def dump_volume_texture(xbox, offset, fmt_color, width, height, depth):
+    """Convert the 3D texture at the given offset into a list of PIL.Image layers."""
+    tex_info = _DECODED_TEXTURE_FORMATS.get(fmt_color)
+    if not tex_info:
+        # FIXME: Support compressed and placeholder volume formats.
+        img = dump_texture(xbox, offset, 0, fmt_color, width, height)
+        return [img] * depth
+
+    swizzled, (bits_per_pixel, channel_sizes, channel_offsets) = tex_info
+    data = xbox.read(
+        AGP_MEMORY_BASE | offset, width * height * depth * bits_per_pixel // 8
+    )
+    return _decode_volume_texture(
+        data,
+        (width, height, depth),
+        swizzled,
+        bits_per_pixel,
+        channel_sizes,
+        channel_offsets,
+    )
+
+
+def get_texture_data_size(fmt_color, pitch, width, height, depth=1):
+    """Returns the number of bytes dumped for the given texture, 0 if none are read."""
+    if fmt_color in _DECODED_TEXTURE_FORMATS:
+        bits_per_pixel = _DECODED_TEXTURE_FORMATS[fmt_color][1].bpp
+        if depth > 1:
+            return width * height * depth * bits_per_pixel // 8
+        if pitch == 0:
+            pitch = width * bits_per_pixel // 8
+        return pitch * height
+
+    if fmt_color == 0xC:  # DXT1
+        return width * height // 2
+
+    if fmt_color in [0xE, 0xF]:  # DXT3, DXT5
+        return width * height
+
+    return 0
@@ -10,35 +10,147 @@
 # pylint: disable=too-many-function-args
 
 from collections import defaultdict
+import contextlib
 import os
 import struct
 import time
 import traceback
 
 from AbortFlag import AbortFlag
+import ArtifactWriter
+import ChecksumMemory
+import DumpDirtyTracker
+import DumpSampler
 import ExchangeU32
+import GraphicsClassShadow
 from HTMLLog import HTMLLog
 import KickFIFO
 from NV2ALog import NV2ALog
+import NV097State
+import ReadPGRAPHRDI
+import RegisterDiff
+import StepFIFO
 import Texture
+import TraceFile
+from Xbox import CachedXbox
+from Xbox import InstrumentedXbox
 from Xbox import Xbox
+from Xbox import find_wrapper
 import XboxHelper
 
+# Name of the binary trace file in the output directory.
+TRACE_FILE_NAME = "trace.nv2a"
+
+# Default number of bytes of pushbuffer fetched by a single read.
+DEFAULT_PUSH_BUFFER_WINDOW_SIZE = 0x4000
+
+
+# Number of bytes that may always be queued before the FIFO is run.
+MIN_FLUSH_DISTANCE = 200
+
+# Default upper bound for the number of bytes queued before the FIFO is run.
+DEFAULT_MAX_FLUSH_DISTANCE = 0x1000
+
+# Used in place of a profile site while profiling is disabled.
+_NO_PROFILE_SITE = contextlib.nullcontext()
+
+_PGRAPH_DIFF = RegisterDiff.RegisterDiff(
+    RegisterDiff.PGRAPH_BASE,
+    RegisterDiff.PGRAPH_SIZE,
+    RegisterDiff.PGRAPH_VOLATILE_REGISTERS,
+)
+
+
+# Method marking the end of a frame.
+NV097_FLIP_STALL = 0x0130
+
 
 class MaxFlipExceeded(Exception):
     """Exception to indicate the maximum number of buffer flips has been reached."""
 
 
+class FrameRanges:
+    """Set of frames to capture, given as inclusive (first, last) ranges.
+
+    A last frame of None leaves the range open. Without any ranges every frame is
+    captured.
+    """
+
+    def __init__(self, ranges=None):
+        self.ranges = sorted(ranges or [])
+
+    def __bool__(self):
+        return bool(self.ranges)
+
+    def contains(self, frame):
+        if not self.ranges:
+            return True
+        return any(
+            first <= frame and (last is None or frame <= last)
+            for first, last in self.ranges
+        )
+
+    def is_exhausted(self, frame):
+        """Returns True if no frame after `frame` is captured."""
+        return bool(self.ranges) and all(
+            last is not None and last <= frame for _first, last in self.ranges
+        )
+
+
+def parse_frame_ranges(text) -> FrameRanges:
+    """Parses a comma separated list of frame ranges (e.g., "10-20,500-", "7")."""
+    ranges = []
+    for item in text.split(","):
+        first, separator, last = item.strip().partition("-")
+        first = int(first)
+        if not separator:
+            last = first
+        elif last:
+            last = int(last)
+        else:
+            last = None
+        if last is not None and last < first:
+            raise ValueError("Invalid frame range %s" % item)
+        ranges.append((first, last))
+    return FrameRanges(ranges)
+
+
+class AdaptiveFlushPolicy:
+    """Decides how many unhooked command bytes may be queued before running the FIFO.
+
+    While the buffer is being processed D3D might fixup the buffer if GET is too far
+    away. The distance therefore starts out small, doubles whenever a flush leaves
+    the real PUT untouched and falls back to the minimum as soon as PUT moves.
+    """
+
+    def __init__(
+        self, min_distance=MIN_FLUSH_DISTANCE, max_distance=DEFAULT_MAX_FLUSH_DISTANCE
+    ):
+        self.min_distance = min_distance
+        self.max_distance = max(min_distance, max_distance)
+        self.distance = min_distance
+
+    def should_flush(self, bytes_queued):
+        return bytes_queued >= self.distance
+
+    def on_flush(self, put_moved):
+        if put_moved:
+            self.distance = self.min_distance
+        else:
+            self.distance = min(self.distance * 2, self.max_distance)
+
+
 def _dump_pgraph(xbox):
     """Returns the entire PGRAPH region."""
-    buffer = bytearray([])
-    buffer.extend(xbox.read(0xFD400000, 0x200))
-
     # 0xFD400200 hangs Xbox, I just skipped to 0x400.
     # Needs further testing which regions work.
+    head, tail = XboxHelper.read_many(
+        xbox, [(0xFD400000, 0x200), (0xFD400400, 0x2000 - 0x400)]
+    )
+    buffer = bytearray([])
+    buffer.extend(head)
     buffer.extend(bytes([0] * 0x200))
-
-    buffer.extend(xbox.read(0xFD400400, 0x2000 - 0x400))
+    buffer.extend(tail)
 
     # Return the PGRAPH dump
     assert len(buffer) == 0x2000
@@ -69,10 +181,8 @@ def _read_pgraph_rdi(xbox: Xbox, offset: int, count: int):
     # It is not safe and likely incorrect to do a bulk read so this must be done
     # individualy despite the interface communication overhead.
     xbox.write_u32(NV10_PGRAPH_RDI_INDEX, offset)
-    data = bytearray()
-    for _ in range(count):
-        word = xbox.read_u32(NV10_PGRAPH_RDI_DATA)
-        data += struct.pack("<L", word)
+    words = XboxHelper.read_u32_many(xbox, [NV10_PGRAPH_RDI_DATA] * count)
+    data = bytearray(struct.pack("<%dL" % count, *words))
 
     # FIXME: Restore original RDI?
     # Note: It may not be possible to restore the original index.
@@ -103,18 +213,65 @@ class Tracer:
         enable_surface_dumping=True,
         enable_raw_pixel_dumping=True,
         enable_rdi=True,
+        enable_rdi_stub=True,
+        enable_dump_cache=True,
+        push_buffer_window_size=DEFAULT_PUSH_BUFFER_WINDOW_SIZE,
+        max_flush_distance=DEFAULT_MAX_FLUSH_DISTANCE,
+        enable_fifo_stepper=True,
+        class_validation_interval=GraphicsClassShadow.DEFAULT_VALIDATION_INTERVAL,
+        background_log_flush=False,
+        artifact_workers=ArtifactWriter.DEFAULT_WORKERS,
+        enable_trace_file=True,
+        export_snapshot_files=False,
+        enable_state_shadow=True,
+        verify_state_shadow=False,
+        enable_dirty_tracking=True,
+        texture_content_policy=DumpDirtyTracker.DEFAULT_CONTENT_POLICY,
         verbose=False,
         max_frames=0,
+        capture_frames=None,
+        command_filter=None,
+        dump_sampler=None,
     ):
         self.xbox = xbox
         self.xbox_helper = xbox_helper
         self.abort_flag = abort_flag
+        self.profiler = find_wrapper(xbox, InstrumentedXbox)
+        self.read_cache = find_wrapper(xbox, CachedXbox)
         self.alpha_mode = alpha_mode
         self.output_dir = output_dir
-        self.html_log = HTMLLog(os.path.join(output_dir, "debug.html"))
-        self.nv2a_log = NV2ALog(os.path.join(output_dir, "nv2a_log.txt"))
+        self.html_log = HTMLLog(
+            os.path.join(output_dir, "debug.html"), background_log_flush
+        )
+        self.nv2a_log = NV2ALog(
+            os.path.join(output_dir, "nv2a_log.txt"), background_log_flush
+        )
+        self.artifact_writer = ArtifactWriter.ArtifactWriter(artifact_workers)
+        self.export_snapshot_files = export_snapshot_files
+        self.trace_file = None
+        if enable_trace_file:
+            self.trace_file = TraceFile.TraceWriter(
+                os.path.join(output_dir, TRACE_FILE_NAME)
+            )
         self.flip_stall_count = 0
         self.command_count = 0
+        self.artifact_count = 0
+        self.flush_count = 0
+        self.frame_flush_count = 0
+        self.flush_policy = AdaptiveFlushPolicy(max_distance=max_flush_distance)
+        self.graphics_classes = GraphicsClassShadow.GraphicsClassShadow(
+            xbox_helper, class_validation_interval, log=self.html_log.print_log
+        )
+        self.nv097_state = None
+        if enable_state_shadow:
+            self.nv097_state = NV097State.NV097State(
+                xbox_helper, verify_state_shadow, log=self.html_log.print_log
+            )
+        self.dirty_tracker = None
+        if enable_dirty_tracking:
+            self.dirty_tracker = DumpDirtyTracker.DumpDirtyTracker(
+                texture_content_policy
+            )
 
         self.real_dma_pull_addr = dma_pull_addr
         self.real_dma_push_addr = dma_push_addr
@@ -123,11 +280,47 @@ class Tracer:
         self.enable_surface_dumping = enable_surface_dumping
         self.enable_raw_pixel_dumping = enable_raw_pixel_dumping
         self.enable_rdi = enable_rdi
+        self.enable_rdi_stub = enable_rdi_stub
+        self.enable_dump_cache = enable_dump_cache
+        self.push_buffer_window_size = push_buffer_window_size
+        self.enable_fifo_stepper = enable_fifo_stepper
         self.verbose = verbose
         self.max_frames = max_frames
+        self.capture_frames = capture_frames or FrameRanges()
+
+        # Commands outside of the captured frames are only parsed for flips.
+        self.capturing = self.capture_frames.contains(0)
+        self.fast_forward_command_count = 0
+        self.fast_forward_duration = 0.0
+
+        # Commands rejected by the filter are handled like fast-forwarded ones.
+        self.command_filter = command_filter
+        self.filtered_command_count = 0
+
+        # Decides which draws are dumped, the textures dumped at BEGIN decide END.
+        self.dump_sampler = dump_sampler
+        self.dump_current_draw = True
 
         self.pgraph_dump = None
 
+        # Local copy of the pushbuffer starting at push_buffer_window_addr.
+        self.push_buffer_window_addr = 0
+        self.push_buffer_window = b""
+
+        # (offset, count) RDI reads for which the stub matched the per-word reads.
+        self.verified_rdi_reads = set()
+
+        # Maps {dump key: (checksum, html)} for the most recent dump of each resource.
+        self.dump_cache = {}
+
+        # HTML of the most recent dump of each texture stage and the color surface.
+        self.texture_stage_html = [""] * 4
+        self.surface_html = []
+
+        # (dump key, address, length) of the texture of each stage at its most recent
+        # dump, None if the stage was disabled.
+        self.texture_stage_memory = [None] * 4
+
         # Maps {object : {method: ([pre_call_hooks], [post_call_hooks])} }
         self.method_callbacks = defaultdict(dict)
         self._hook_methods()
@@ -140,9 +333,16 @@ class Tracer:
 
         while not self.abort_flag.should_abort:
             try:
-                dma_pull_addr, unprocessed_bytes = self.process_push_buffer_command(
-                    dma_pull_addr
-                )
+                fast_forwarding = not self.capturing
+                start = time.perf_counter()
+                if not fast_forwarding:
+                    dma_pull_addr, unprocessed_bytes = self.process_push_buffer_command(
+                        dma_pull_addr
+                    )
+                else:
+                    dma_pull_addr, unprocessed_bytes = (
+                        self.fast_forward_push_buffer_command(dma_pull_addr)
+                    )
                 bytes_queued += unprocessed_bytes
 
                 # time.sleep(0.5)
@@ -150,7 +350,7 @@ class Tracer:
                 # Avoid queuing up too many bytes: while the buffer is being processed,
                 # D3D might fixup the buffer if GET is still too far away.
                 is_empty = dma_pull_addr == self.real_dma_push_addr
-                if is_empty or bytes_queued >= 200:
+                if is_empty or self.flush_policy.should_flush(bytes_queued):
                     print(
                         "Flushing buffer until (0x%08X): real_put 0x%X; bytes_queued: %d"
                         % (dma_pull_addr, self.real_dma_push_addr, bytes_queued)
@@ -180,6 +380,11 @@ class Tracer:
                         self.xbox_helper.print_pb_state()
                         raise
 
+                    self.graphics_classes.on_synchronized()
+
+                if fast_forwarding:
+                    self.fast_forward_duration += time.perf_counter() - start
+
             except MaxFlipExceeded:
                 print("Max flip count reached")
                 self.abort_flag.abort()
@@ -187,11 +392,44 @@ class Tracer:
                 traceback.print_exc()
                 self.abort_flag.abort()
 
+        self.flush_logs()
+
+    def finish_artifacts(self):
+        """Blocks until all queued images and dumps have been written."""
+        pending = self.artifact_writer.pending_count
+        if pending:
+            print("Writing %d pending artifacts..." % pending)
+        self.artifact_writer.close()
+
+    def flush_logs(self):
+        """Writes any buffered log output to disk."""
+        self.html_log.flush()
+        self.nv2a_log.flush()
+        if self.trace_file:
+            self.trace_file.flush()
+
+    def close_trace_file(self):
+        """Finalizes the trace file, no further records may be written."""
+        if self.trace_file:
+            self.trace_file.close()
+
     def hook_method(self, obj, method, pre_hooks, post_hooks):
         """Registers pre- and post-run hooks for the given method."""
         print("Registering method hook for 0x%X::0x%04X" % (obj, method))
         self.method_callbacks[obj][method] = pre_hooks, post_hooks
 
+    def add_method_hooks(self, obj, method, pre_hooks, post_hooks):
+        """Adds pre- and post-run hooks to those already registered for the method."""
+        existing_pre_hooks, existing_post_hooks = self.method_callbacks[obj].get(
+            method, ([], [])
+        )
+        self.hook_method(
+            obj,
+            method,
+            existing_pre_hooks + pre_hooks,
+            existing_post_hooks + post_hooks,
+        )
+
     @property
     def recorded_flip_stall_count(self):
         return self.flip_stall_count
@@ -200,6 +438,28 @@ class Tracer:
     def recorded_command_count(self):
         return self.command_count
 
+    @property
+    def recorded_flush_count(self):
+        return self.flush_count
+
+    @property
+    def recorded_artifact_count(self):
+        return self.artifact_count
+
+    @property
+    def fast_forwarded_command_count(self):
+        return self.fast_forward_command_count
+
+    @property
+    def recorded_filtered_command_count(self):
+        return self.filtered_command_count
+
+    @property
+    def skipped_dump_count(self):
+        if self.dump_sampler is None:
+            return 0
+        return self.dump_sampler.skipped_count
+
     def _exchange_dma_push_address(self, target):
         """Sets the DMA_PUSH_ADDR to the given target, storing the old value.
 
@@ -215,16 +475,29 @@ class Tracer:
 
         # It must point where we pointed previously, otherwise something is broken
         if real != prev_target:
-            self.html_log.print_log(
-                "New real PUT (0x%08X -> 0x%08X) while changing hook 0x%08X -> 0x%08X"
-                % (prev_real, real, prev_target, target)
-            )
-            put_s1 = self.xbox.read_u32(XboxHelper.CACHE_PUSH_STATE)
-            if put_s1 & 1:
-                print("PUT was modified and pusher was already active!")
-                time.sleep(60.0)
-            self.real_dma_push_addr = real
-            # traceback.print_stack()
+            self._handle_new_real_dma_push_address(real, prev_real, prev_target, target)
+
+    def _handle_new_real_dma_push_address(self, real, prev_real, prev_target, target):
+        """Records a DMA_PUSH_ADDR that was modified by the Xbox while tracing."""
+        self.html_log.print_log(
+            "New real PUT (0x%08X -> 0x%08X) while changing hook 0x%08X -> 0x%08X"
+            % (prev_real, real, prev_target, target)
+        )
+        put_s1 = self.xbox.read_u32(XboxHelper.CACHE_PUSH_STATE)
+        if put_s1 & 1:
+            print("PUT was modified and pusher was already active!")
+            time.sleep(60.0)
+        self.real_dma_push_addr = real
+
+        # D3D may have patched the pushbuffer while adding commands.
+        self._invalidate_push_buffer_window()
+        # traceback.print_stack()
+
+    def _profile_site(self, name):
+        """Returns a context attributing the Xbox operations within it to `name`."""
+        if self.profiler is None:
+            return _NO_PROFILE_SITE
+        return self.profiler.profile_site(name)
 
     def _dbg_print(self, message):
         if not self.verbose:
@@ -233,7 +506,74 @@ class Tracer:
 
     def run_fifo(self, pull_addr_target):
         """Runs the PFIFO until the DMA_PULL_ADDR equals the given address."""
+        self.flush_count += 1
+        self.frame_flush_count += 1
+        real_dma_push_addr = self.real_dma_push_addr
+
+        with self._profile_site("run_fifo"):
+            self._run_fifo(pull_addr_target)
+
+        # The GPU may have written to any memory while the FIFO was running.
+        if self.read_cache is not None:
+            self.read_cache.invalidate()
+
+        self.flush_policy.on_flush(real_dma_push_addr != self.real_dma_push_addr)
+
+    def _run_fifo(self, pull_addr_target):
+        if self.enable_fifo_stepper and self._step_fifo(pull_addr_target):
+            return
+        self._run_fifo_loop(pull_addr_target)
+
+    def _step_fifo(self, pull_addr_target):
+        """Runs the PFIFO until the given address using the on-target stepper.
 
+        Returns False if the stepper timed out and the host has to take over.
+        """
+        if self.capturing:
+            self.html_log.log(
+                [
+                    "WARNING",
+                    "Stepping FIFO (GET: 0x%08X -- PUT: 0x%08X / 0x%08X)"
+                    % (
+                        self.real_dma_pull_addr,
+                        pull_addr_target,
+                        self.real_dma_push_addr,
+                    ),
+                ]
+            )
+
+        # A modified PUT is reported after the target has been written, so a retry
+        # is expected to succeed unless the Xbox keeps modifying PUT.
+        for _ in range(3):
+            prev_target = self.target_dma_push_addr
+            result = StepFIFO.step(self.xbox, pull_addr_target, prev_target)
+            self.target_dma_push_addr = pull_addr_target
+            self.real_dma_pull_addr = result.dma_pull_addr
+
+            if result.state == StepFIFO.STATE_OK:
+                return True
+
+            if result.state == StepFIFO.STATE_INVALID_PUSH_MODIFIED_IN_CALL:
+                raise Exception("DMA_PUSH_ADDR modified during step_fifo call")
+
+            if result.state != StepFIFO.STATE_INVALID_READ_PUSH_ADDR:
+                break
+
+            self._handle_new_real_dma_push_address(
+                result.replaced_push_addr,
+                self.real_dma_push_addr,
+                prev_target,
+                pull_addr_target,
+            )
+
+        print(
+            "Warning: FIFO stepper stopped at 0x%08X (state 0x%X), target is 0x%08X"
+            % (result.dma_pull_addr, result.state, pull_addr_target)
+        )
+        self.xbox_helper.resync_register_shadows()
+        return False
+
+    def _run_fifo_loop(self, pull_addr_target):
         # Mark the pushbuffer as empty by setting the push address to the target pull
         # address.
         self._exchange_dma_push_address(pull_addr_target)
@@ -242,13 +582,18 @@ class Tracer:
         # FIXME: we can avoid this read in some cases, as we should know where we are
         self.real_dma_pull_addr = self.xbox_helper.get_dma_pull_address()
 
-        self.html_log.log(
-            [
-                "WARNING",
-                "Running FIFO (GET: 0x%08X -- PUT: 0x%08X / 0x%08X)"
-                % (self.real_dma_pull_addr, pull_addr_target, self.real_dma_push_addr),
-            ]
-        )
+        if self.capturing:
+            self.html_log.log(
+                [
+                    "WARNING",
+                    "Running FIFO (GET: 0x%08X -- PUT: 0x%08X / 0x%08X)"
+                    % (
+                        self.real_dma_pull_addr,
+                        pull_addr_target,
+                        self.real_dma_push_addr,
+                    ),
+                ]
+            )
 
         # Loop while this command is being ran.
         # This is necessary because a whole command might not fit into CACHE.
@@ -267,6 +612,7 @@ class Tracer:
                         pull_addr_target,
                     )
                 )
+                self.xbox_helper.resync_register_shadows()
 
             self._dbg_print(
                 "At 0x%08X, target is 0x%08X (Real: 0x%08X)"
@@ -306,7 +652,8 @@ class Tracer:
 
             # Run the commands we have moved to CACHE, by enabling PGRAPH.
             self.xbox_helper.enable_pgraph_fifo()
-            time.sleep(0.01)
+            with self._profile_site("sleep"):
+                time.sleep(0.01)
 
             # Get the updated PB address.
             new_get_addr = self.xbox_helper.get_dma_pull_address()
@@ -319,19 +666,20 @@ class Tracer:
         # This is just to confirm that nothing was modified in the final chunk
         self._exchange_dma_push_address(pull_addr_target)
 
-    def _dump_texture(self, index):
+    def _dump_texture(self, index, registers):
         reg_offset = index * 4
         # Verify that the texture stage is enabled
-        control = self.xbox.read_u32(XboxHelper.PGRAPH_TEXCTL0_0 + reg_offset)
+        control = registers[XboxHelper.PGRAPH_TEXCTL0_0 + reg_offset]
         if not control & (1 << 30):
+            self.texture_stage_memory[index] = None
             return ""
 
-        offset = self.xbox.read_u32(XboxHelper.PGRAPH_TEXOFFSET0 + reg_offset)
+        offset = registers[XboxHelper.PGRAPH_TEXOFFSET0 + reg_offset]
         # FIXME: Use pitch from registers for linear formats.
         # FIXME: clean up associated fallback code in Texture.py
-        reg_pitch = self.xbox.read_u32(XboxHelper.PGRAPH_TEXCTL1_0 + reg_offset) >> 16
+        reg_pitch = registers[XboxHelper.PGRAPH_TEXCTL1_0 + reg_offset] >> 16
         pitch = 0
-        fmt = self.xbox.read_u32(XboxHelper.PGRAPH_TEXFMT0 + reg_offset)
+        fmt = registers[XboxHelper.PGRAPH_TEXFMT0 + reg_offset]
 
         fmt_color = (fmt >> 8) & 0x7F
         width_shift = (fmt >> 20) & 0xF
@@ -346,12 +694,13 @@ class Tracer:
             % (index, offset, width, height, depth, reg_pitch, fmt_color)
         )
 
-        def dump(img_tags, adjusted_offset, layer):
+        def dump(img, layer):
             if layer >= 0:
                 layer_name = "_L%d" % layer
             else:
                 layer_name = ""
 
+            img_tags = ""
             if self.alpha_mode != self.ALPHA_MODE_KEEP:
                 no_alpha_path = "command%d--tex_%d%scolor.png" % (
                     self.command_count,
@@ -378,81 +727,234 @@ class Tracer:
             else:
                 alpha_path = None
 
-            img = Texture.dump_texture(
-                self.xbox, adjusted_offset, pitch, fmt_color, width, height
-            )
-
             self._save_image(img, no_alpha_path, alpha_path)
 
             return img_tags
 
+        cache_key = ("texture", offset, fmt_color, width, height, depth)
+        self.texture_stage_memory[index] = (
+            cache_key,
+            Texture.AGP_MEMORY_BASE | offset,
+            Texture.get_texture_data_size(fmt_color, pitch, width, height, depth),
+        )
+        checksum, img_tags = self._check_dump_cache(*self.texture_stage_memory[index])
+        if img_tags is not None:
+            self._dbg_print("Texture %d unchanged, skipping dump" % index)
+            return img_tags
+
         img_tags = ""
         if depth == 1:
-            img_tags = dump(img_tags, offset, -1)
+            img = Texture.dump_texture(
+                self.xbox, offset, pitch, fmt_color, width, height
+            )
+            img_tags = dump(img, -1)
         else:
-            adjusted_offset = offset
-            for layer in range(depth):
-                img_tags += dump(img_tags, adjusted_offset, layer)
-                adjusted_offset += pitch * height
+            layers = Texture.dump_volume_texture(
+                self.xbox, offset, fmt_color, width, height, depth
+            )
+            for layer, img in enumerate(layers):
+                img_tags += dump(img, layer)
 
+        self._update_dump_cache(cache_key, checksum, img_tags)
         return img_tags
 
-    def dump_textures(self, _data, *_args):
+    def dump_textures(self, data, *args):
+        with self._profile_site("dump_textures"):
+            return self._dump_textures(data, *args)
+
+    def _dump_textures(self, _data, *_args):
         if not self.enable_texture_dumping:
             return []
 
         extra_html = []
 
+        stages = range(4)
+        if self.dirty_tracker:
+            stages = [
+                i
+                for i in stages
+                if self.dirty_tracker.is_texture_dirty(i)
+                or self._is_texture_modified(i)
+            ]
+
+        if not stages:
+            registers = None
+        elif self.nv097_state:
+            registers = self.nv097_state.read_texture_stage_registers()
+        else:
+            registers = self.xbox_helper.read_registers(
+                NV097State.TEXTURE_STAGE_REGISTERS
+            )
         for i in range(4):
-            tags = self._dump_texture(i)
+            if i in stages:
+                tags = self._dump_texture(i, registers)
+                self.texture_stage_html[i] = tags
+                if self.dirty_tracker:
+                    self.dirty_tracker.on_texture_dumped(i)
+            else:
+                self._dbg_print("Texture %d binding unchanged, skipping dump" % i)
+                tags = self.texture_stage_html[i]
             if tags:
                 extra_html += [tags]
 
         return extra_html
 
-    def dump_surfaces(self, _data, *_args):
+    def _is_texture_modified(self, index):
+        """Returns True if the texture of a clean stage changed since its last dump.
+
+        This catches textures modified by the CPU, which the dirty tracker cannot see
+        in the method stream. Without the dump cache they are not detected.
+        """
+        memory = self.texture_stage_memory[index]
+        if memory is None or not self.enable_dump_cache:
+            return False
+        _checksum, cached = self._check_dump_cache(*memory)
+        return cached is None
+
+    def dump_surfaces(self, data, *args):
+        with self._profile_site("dump_surfaces"):
+            return self._dump_surfaces(data, *args)
+
+    def _dump_surfaces(self, _data, *_args):
         if not self.enable_surface_dumping:
             return []
 
-        params = Texture.read_texture_parameters(self.xbox)
+        if self.dirty_tracker and not self.dirty_tracker.is_surface_dirty():
+            self._dbg_print("Nothing drawn since the last surface dump, skipping dump")
+            self._write_state_snapshots()
+            return self.surface_html
+
+        if self.nv097_state:
+            params = self.nv097_state.read_texture_parameters()
+        else:
+            params = Texture.read_texture_parameters(self.xbox)
 
         if not params.format_color:
             print("Warning: Invalid color format, skipping surface dump.")
             return []
 
         # Dump stuff we might care about
-        self._write("pgraph.bin", _dump_pgraph(self.xbox))
-        self._write("pfb.bin", _dump_pfb(self.xbox))
+        self._write_state_snapshots()
+        # The raw dump and the image of the color surface share one checksum.
+        color_length = params.color_pitch * params.height if params.color_offset else 0
+        color_checksum = self._checksum_memory(
+            Texture.AGP_MEMORY_BASE | params.color_offset, color_length
+        )
+
+        memory_html = []
         if params.color_offset and self.enable_raw_pixel_dumping:
-            self._write(
-                "mem-2.bin",
-                self.xbox.read(
-                    Texture.AGP_MEMORY_BASE | params.color_offset,
-                    params.color_pitch * params.height,
-                ),
+            memory_html += self._write_memory(
+                "mem-2.bin", params.color_offset, color_length, color_checksum
             )
         if params.depth_offset and self.enable_raw_pixel_dumping:
-            self._write(
-                "mem-3.bin",
-                self.xbox.read(
-                    Texture.AGP_MEMORY_BASE | params.depth_offset,
-                    params.depth_pitch * params.height,
-                ),
+            memory_html += self._write_memory(
+                "mem-3.bin", params.depth_offset, params.depth_pitch * params.height
             )
+
+        cache_key = (
+            "surface",
+            params.color_offset,
+            params.color_pitch,
+            params.format_color,
+            params.width,
+            params.height,
+        )
+        checksum, img_tags = self._check_dump_cache(
+            cache_key,
+            Texture.AGP_MEMORY_BASE | params.color_offset,
+            color_length,
+            color_checksum,
+        )
+        if img_tags is None:
+            img_tags = self._dump_color_surface(params)
+            self._update_dump_cache(cache_key, checksum, img_tags)
+        else:
+            self._dbg_print("Color surface unchanged, skipping dump")
+
+        extra_html = []
+        extra_html += [img_tags]
+        extra_html += [
+            "%d x %d [pitch = %d (0x%X)], at 0x%08X, format 0x%X, type: 0x%X, swizzle: 0x%08X, 0x%08X [used %d]"
+            % (
+                params.width,
+                params.height,
+                params.color_pitch,
+                params.color_pitch,
+                params.color_offset,
+                params.format_color,
+                params.surface_type,
+                params.swizzle_unk,
+                params.swizzle_unk2,
+                params.swizzled,
+            )
+        ]
+        self._dbg_print(extra_html[-1])
+        extra_html += memory_html
+
+        self.surface_html = extra_html
+        if self.dirty_tracker:
+            self.dirty_tracker.on_surface_dumped()
+        return extra_html
+
+    def _write_state_snapshots(self):
+        """Stores the PGRAPH, PFB and (optionally) RDI state alongside a surface dump."""
+        with self._profile_site("snapshots"):
+            self._write_state_snapshots_unprofiled()
+
+    def _write_state_snapshots_unprofiled(self):
+        self._write_snapshot(
+            "pgraph.bin", TraceFile.SNAPSHOT_PGRAPH, _dump_pgraph(self.xbox)
+        )
+        self._write_snapshot("pfb.bin", TraceFile.SNAPSHOT_PFB, _dump_pfb(self.xbox))
         if self.enable_rdi:
-            self._write(
+            self._write_snapshot(
                 "pgraph-rdi-vp-instructions.bin",
-                _read_pgraph_rdi(self.xbox, 0x100000, 136 * 4),
+                TraceFile.SNAPSHOT_RDI_VP_INSTRUCTIONS,
+                self._read_pgraph_rdi(0x100000, 136 * 4),
             )
-            self._write(
+            self._write_snapshot(
                 "pgraph-rdi-vp-constants0.bin",
-                _read_pgraph_rdi(self.xbox, 0x170000, 192 * 4),
+                TraceFile.SNAPSHOT_RDI_VP_CONSTANTS0,
+                self._read_pgraph_rdi(0x170000, 192 * 4),
             )
-            self._write(
+            self._write_snapshot(
                 "pgraph-rdi-vp-constants1.bin",
-                _read_pgraph_rdi(self.xbox, 0xCC0000, 192 * 4),
+                TraceFile.SNAPSHOT_RDI_VP_CONSTANTS1,
+                self._read_pgraph_rdi(0xCC0000, 192 * 4),
             )
 
+    def _read_pgraph_rdi(self, offset, count):
+        """Returns `count` words of PGRAPH RDI starting at `offset`.
+
+        The first read of each range is checked against the per-word reads, any
+        mismatch permanently disables the read_pgraph_rdi patch.
+        """
+        with self._profile_site("rdi"):
+            return self._read_pgraph_rdi_verified(offset, count)
+
+    def _read_pgraph_rdi_verified(self, offset, count):
+        if not self.enable_rdi_stub:
+            return _read_pgraph_rdi(self.xbox, offset, count)
+
+        data = ReadPGRAPHRDI.read_pgraph_rdi(self.xbox, offset, count)
+        key = (offset, count)
+        if key in self.verified_rdi_reads:
+            return data
+
+        expected = _read_pgraph_rdi(self.xbox, offset, count)
+        if data != expected:
+            print(
+                "Warning: read_pgraph_rdi mismatch at 0x%X (%d words), falling back to per-word reads."
+                % (offset, count)
+            )
+            self.enable_rdi_stub = False
+            return expected
+
+        self.verified_rdi_reads.add(key)
+        return data
+
+    def _dump_color_surface(self, params):
+        """Saves the current color surface and returns the HTML referencing it."""
         # FIXME: Respect anti-aliasing
         img_tags = ""
         if self.alpha_mode != self.ALPHA_MODE_KEEP:
@@ -473,27 +975,6 @@ class Tracer:
         else:
             alpha_path = None
 
-        path = "command%d--color.png" % (self.command_count)
-        extra_html = []
-
-        extra_html += [img_tags]
-        extra_html += [
-            "%d x %d [pitch = %d (0x%X)], at 0x%08X, format 0x%X, type: 0x%X, swizzle: 0x%08X, 0x%08X [used %d]"
-            % (
-                params.width,
-                params.height,
-                params.color_pitch,
-                params.color_pitch,
-                params.color_offset,
-                params.format_color,
-                params.surface_type,
-                params.swizzle_unk,
-                params.swizzle_unk2,
-                params.swizzled,
-            )
-        ]
-        self._dbg_print(extra_html[-1])
-
         try:
             if not params.color_offset:
                 raise Exception("Color offset is null")
@@ -516,23 +997,81 @@ class Tracer:
 
         self._save_image(img, no_alpha_path, alpha_path)
 
-        return extra_html
+        return img_tags
+
+    def _checksum_memory(self, address, length):
+        """Returns the checksum of memory for the dump cache, None if it is disabled."""
+        if not self.enable_dump_cache or not length:
+            return None
+
+        with self._profile_site("checksum"):
+            return ChecksumMemory.checksum_memory(self.xbox, address, length)
+
+    def _check_dump_cache(self, key, address, length, checksum=None):
+        """Checks whether the memory backing a dump changed since it was last dumped.
+
+        `checksum` may be passed if the memory was already checksummed. Returns a
+        tuple of the checksum of the memory and the result of the previous dump,
+        which is None if the dump must be redone.
+        """
+        if checksum is None:
+            checksum = self._checksum_memory(address, length)
+        if checksum is None:
+            return None, None
+
+        cached = self.dump_cache.get(key)
+        if cached is None or cached[0] != checksum:
+            return checksum, None
+        return checksum, cached[1]
+
+    def _update_dump_cache(self, key, checksum, result):
+        """Associates the result of a dump with the checksum of its memory."""
+        if checksum is None:
+            return
+        self.dump_cache[key] = checksum, result
+
+    def _write_memory(self, suffix, offset, length, checksum=None):
+        """Writes a raw dump of the given memory, returning any HTML to log."""
+        cache_key = ("memory", suffix, offset, length)
+        checksum, previous_path = self._check_dump_cache(
+            cache_key, Texture.AGP_MEMORY_BASE | offset, length, checksum
+        )
+        if previous_path is not None:
+            return [
+                '%s unchanged, see <a href="%s">%s</a>'
+                % (suffix, previous_path, previous_path)
+            ]
+
+        path = self._write(
+            suffix, self.xbox.read(Texture.AGP_MEMORY_BASE | offset, length)
+        )
+        self._update_dump_cache(cache_key, checksum, os.path.basename(path))
+        return []
 
     def _save_image(self, img, no_alpha_path, alpha_path):
-        """Saves a PIL.Image to the given path(s)"""
+        """Queues a PIL.Image to be saved to the given path(s)"""
         if not img:
             return
 
-        if alpha_path:
-            img.save(os.path.join(self.output_dir, alpha_path))
         if no_alpha_path:
-            img = img.convert("RGB")
-            img.save(os.path.join(self.output_dir, no_alpha_path))
+            self._record_artifact(no_alpha_path)
+            no_alpha_path = os.path.join(self.output_dir, no_alpha_path)
+        if alpha_path:
+            self._record_artifact(alpha_path)
+            alpha_path = os.path.join(self.output_dir, alpha_path)
+        with self._profile_site("save_image"):
+            self.artifact_writer.save_image(img, no_alpha_path, alpha_path)
+
+    def _record_artifact(self, path):
+        """Adds a reference to a file in the output directory to the trace file."""
+        self.artifact_count += 1
+        if self.trace_file:
+            self.trace_file.write_artifact(self.command_count, path)
 
     def _hook_methods(self):
         """Installs hooks for methods interpreted by this class."""
         NV097_CLEAR_SURFACE = 0x1D94
-        self.hook_method(0x97, NV097_CLEAR_SURFACE, [], [self.dump_surfaces])
+        self.hook_method(0x97, NV097_CLEAR_SURFACE, [], [self._handle_surface_event])
 
         NV097_SET_BEGIN_END = 0x17FC
         self.hook_method(
@@ -544,12 +1083,14 @@ class Tracer:
         #  methodHooks(0x1B00 + 64 * i, [],    [HandleSetTexture], i)
 
         # Add the list of commands which might trigger CPU actions
-        NV097_FLIP_STALL = 0x0130
         self.hook_method(0x97, NV097_FLIP_STALL, [], [self._handle_flip_stall])
 
         NV097_BACK_END_WRITE_SEMAPHORE_RELEASE = 0x1D70
         self.hook_method(
-            0x97, NV097_BACK_END_WRITE_SEMAPHORE_RELEASE, [], [self.dump_surfaces]
+            0x97,
+            NV097_BACK_END_WRITE_SEMAPHORE_RELEASE,
+            [],
+            [self._handle_surface_event],
         )
 
     def _handle_begin(self, data, *args):
@@ -560,6 +1101,10 @@ class Tracer:
 
         print("BEGIN %d" % self.command_count)
 
+        self.dump_current_draw = self._should_dump()
+        if not self.dump_current_draw:
+            return [self._skipped_dump_html()]
+
         extra_html = []
         extra_html += self.dump_textures(data, *args)
         return extra_html
@@ -570,10 +1115,24 @@ class Tracer:
         if data != 0:
             return []
 
+        if not self.dump_current_draw:
+            return [self._skipped_dump_html()]
+
         extra_html = []
         extra_html += self.dump_surfaces(data, *args)
         return extra_html
 
+    def _handle_surface_event(self, data, *args):
+        if not self._should_dump():
+            return [self._skipped_dump_html()]
+        return self.dump_surfaces(data, *args)
+
+    def _should_dump(self):
+        return self.dump_sampler is None or self.dump_sampler.should_dump()
+
+    def _skipped_dump_html(self):
+        return "<i>Dump skipped by sampling policy %s</i>" % self.dump_sampler
+
     def _begin_pgraph_recording(self, _data, *_args):
         self.pgraph_dump = _dump_pgraph(self.xbox)
         self.html_log.log(["", "", "", "", "Dumped PGRAPH for later"])
@@ -582,131 +1141,80 @@ class Tracer:
     def _end_pgraph_recording(self, _data, *_args):
         # Debug feature to understand PGRAPH
         if self.pgraph_dump is not None:
-            new_pgraph_dump = _dump_pgraph(self.xbox)
-
-            # This blacklist was created from a CLEAR_COLOR, CLEAR
-            blacklist = [
-                0x0040000C,  # 0xF3DF0479 → 0xF3DE04F9
-                0x0040002C,  # 0xF3DF37FF → 0xF3DE37FF
-                0x0040010C,  # 0x03DF0000 → 0x020000F1
-                0x0040012C,  # 0x13DF379F → 0x131A37FF
-                0x00400704,  # 0x00001D9C → 0x00001D94
-                0x00400708,  # 0x01DF0000 → 0x000000F1
-                0x0040070C,  # 0x01DF0000 → 0x000000F1
-                0x0040072C,  # 0x01DF2700 → 0x000027F1
-                0x00400740,  # 0x01DF37DD → 0x01DF37FF
-                0x00400744,  # 0x18111D9C → 0x18111D94
-                0x00400748,  # 0x01DF0011 → 0x000000F1
-                0x0040074C,  # 0x01DF0097 → 0x000000F7
-                0x00400750,  # 0x00DF005C → 0x00DF0064
-                0x00400760,  # 0x000000CC → 0x000000FF
-                0x00400764,  # 0x08001D9C → 0x08001D94
-                0x00400768,  # 0x01DF0000 → 0x000000F1
-                0x0040076C,  # 0x01DF0000 → 0x000000F1
-                0x00400788,  # 0x01DF110A → 0x000011FB
-                0x004007A0,  # 0x00200100 → 0x00201D70
-                0x004007A4,  # 0x00200100 → 0x00201D70
-                0x004007A8,  # 0x00200100 → 0x00201D70
-                0x004007AC,  # 0x00200100 → 0x00201D70
-                0x004007B0,  # 0x00200100 → 0x00201D70
-                0x004007B4,  # 0x00200100 → 0x00201D70
-                0x004007B8,  # 0x00200100 → 0x00201D70
-                0x004007BC,  # 0x00200100 → 0x00201D70
-                0x004007C0,  # 0x00000000 → 0x000006C9
-                0x004007C4,  # 0x00000000 → 0x000006C9
-                0x004007C8,  # 0x00000000 → 0x000006C9
-                0x004007CC,  # 0x00000000 → 0x000006C9
-                0x004007D0,  # 0x00000000 → 0x000006C9
-                0x004007D4,  # 0x00000000 → 0x000006C9
-                0x004007D8,  # 0x00000000 → 0x000006C9
-                0x004007DC,  # 0x00000000 → 0x000006C9
-                0x004007E0,  # 0x00000000 → 0x000006C9
-                0x004007E4,  # 0x00000000 → 0x000006C9
-                0x004007E8,  # 0x00000000 → 0x000006C9
-                0x004007EC,  # 0x00000000 → 0x000006C9
-                0x004007F0,  # 0x00000000 → 0x000006C9
-                0x004007F4,  # 0x00000000 → 0x000006C9
-                0x004007F8,  # 0x00000000 → 0x000006C9
-                0x004007FC,  # 0x00000000 → 0x000006C9
-                0x00400D6C,  # 0x00000000 → 0xFF000000
-                0x0040110C,  # 0x03DF0000 → 0x020000F1
-                0x0040112C,  # 0x13DF379F → 0x131A37FF
-                0x00401704,  # 0x00001D9C → 0x00001D94
-                0x00401708,  # 0x01DF0000 → 0x000000F1
-                0x0040170C,  # 0x01DF0000 → 0x000000F1
-                0x0040172C,  # 0x01DF2700 → 0x000027F1
-                0x00401740,  # 0x01DF37FD → 0x01DF37FF
-                0x00401744,  # 0x18111D9C → 0x18111D94
-                0x00401748,  # 0x01DF0011 → 0x000000F1
-                0x0040174C,  # 0x01DF0097 → 0x000000F7
-                0x00401750,  # 0x00DF0064 → 0x00DF006C
-                0x00401760,  # 0x000000CC → 0x000000FF
-                0x00401764,  # 0x08001D9C → 0x08001D94
-                0x00401768,  # 0x01DF0000 → 0x000000F1
-                0x0040176C,  # 0x01DF0000 → 0x000000F1
-                0x00401788,  # 0x01DF110A → 0x000011FB
-                0x004017A0,  # 0x00200100 → 0x00201D70
-                0x004017A4,  # 0x00200100 → 0x00201D70
-                0x004017A8,  # 0x00200100 → 0x00201D70
-                0x004017AC,  # 0x00200100 → 0x00201D70
-                0x004017B0,  # 0x00200100 → 0x00201D70
-                0x004017B4,  # 0x00200100 → 0x00201D70
-                0x004017B8,  # 0x00200100 → 0x00201D70
-                0x004017BC,  # 0x00200100 → 0x00201D70
-                0x004017C0,  # 0x00000000 → 0x000006C9
-                0x004017C4,  # 0x00000000 → 0x000006C9
-                0x004017C8,  # 0x00000000 → 0x000006C9
-                0x004017CC,  # 0x00000000 → 0x000006C9
-                0x004017D0,  # 0x00000000 → 0x000006C9
-                0x004017D4,  # 0x00000000 → 0x000006C9
-                0x004017D8,  # 0x00000000 → 0x000006C9
-                0x004017DC,  # 0x00000000 → 0x000006C9
-                0x004017E0,  # 0x00000000 → 0x000006C9
-                0x004017E4,  # 0x00000000 → 0x000006C9
-                0x004017E8,  # 0x00000000 → 0x000006C9
-                0x004017EC,  # 0x00000000 → 0x000006C9
-                0x004017F0,  # 0x00000000 → 0x000006C9
-                0x004017F4,  # 0x00000000 → 0x000006C9
-                0x004017F8,  # 0x00000000 → 0x000006C9
-                0x004017FC,  # 0x00000000 → 0x000006C9
-                # 0x0040186C, # 0x00000000 → 0xFF000000 # CLEAR COLOR
-                0x0040196C,  # 0x00000000 → 0xFF000000
-                0x00401C6C,  # 0x00000000 → 0xFF000000
-                0x00401D6C,  # 0x00000000 → 0xFF000000
-            ]
-
-            for i in range(len(self.pgraph_dump) // 4):
-                off = 0x00400000 + i * 4
-                if off in blacklist:
-                    continue
-                word = struct.unpack_from("<L", self.pgraph_dump, i * 4)[0]
-                new_word = struct.unpack_from("<L", new_pgraph_dump, i * 4)[0]
-                if new_word != word:
-                    self.html_log.log(
-                        [
-                            "",
-                            "",
-                            "",
-                            "",
-                            "Modified 0x%08X in PGRAPH: 0x%08X &rarr; 0x%08X"
-                            % (off, word, new_word),
-                        ]
-                    )
+            changes = _PGRAPH_DIFF.compare(self.pgraph_dump, _dump_pgraph(self.xbox))
+            self._log_register_changes("PGRAPH", changes)
 
             self.pgraph_dump = None
             self.html_log.log(["", "", "", "", "Finished PGRAPH comparison"])
 
         return []
 
-    def _handle_flip_stall(self, _data, *_args):
-        print("Flip (Stall)")
-        self.flip_stall_count += 1
+    def _log_register_changes(self, block_name, changes):
+        for address, old_value, new_value in zip(*changes):
+            self.html_log.log(
+                [
+                    "",
+                    "",
+                    "",
+                    "",
+                    "Modified 0x%08X in %s: 0x%08X &rarr; 0x%08X"
+                    % (address, block_name, old_value, new_value),
+                ]
+            )
+
+    def diff_pgraph_around(self, obj, method):
+        """Logs the PGRAPH registers modified by every call of the given method."""
+
+        def report(changes):
+            self._log_register_changes("PGRAPH", changes)
+
+        hook = RegisterDiff.MethodDiffHook(
+            lambda: _dump_pgraph(self.xbox), _PGRAPH_DIFF, report
+        )
+        self.add_method_hooks(obj, method, [hook.pre], [hook.post])
+        return hook
+
+    def _handle_flip_stall(self, data, *args):
+        print(
+            "Flip (Stall) - %d FIFO flushes, flush distance %d"
+            % (self.frame_flush_count, self.flush_policy.distance)
+        )
+        extra_html = []
+        if self.dump_sampler and self.dump_sampler.should_dump_at_flip():
+            extra_html += self.dump_surfaces(data, *args)
+        self._advance_frame()
+        return extra_html
 
-        self.nv2a_log.log("Flip (stall) %d\n\n" % self.flip_stall_count)
+    def _advance_frame(self):
+        was_capturing = self.capturing
+        self.flip_stall_count += 1
+        self.frame_flush_count = 0
+        if self.command_filter is not None:
+            self.command_filter.on_flip()
+        if self.dump_sampler is not None:
+            self.dump_sampler.on_flip()
+        self.capturing = self.capture_frames.contains(self.flip_stall_count)
+
+        if self.profiler is not None:
+            print(self.profiler.frame_summary())
+
+        if was_capturing or self.capturing:
+            self.nv2a_log.log("Flip (stall) %d\n\n" % self.flip_stall_count)
+        if self.trace_file:
+            # Fast-forwarded frames are written as empty frames so that every frame
+            # is in the seek index.
+            self.trace_file.write_flip(self.flip_stall_count, self.command_count)
 
         if self.max_frames and self.flip_stall_count >= self.max_frames:
             raise MaxFlipExceeded()
-        return []
+
+        if self.capturing and not was_capturing:
+            print("Capturing from frame %d" % self.flip_stall_count)
+        elif was_capturing and not self.capturing:
+            if self.capture_frames.is_exhausted(self.flip_stall_count):
+                print("Last captured frame reached")
+                raise MaxFlipExceeded()
+            print("Fast-forwarding from frame %d" % self.flip_stall_count)
 
     def _filter_pgraph_method(self, nv_obj, method):
         # Do callback for pre-method
@@ -739,11 +1247,43 @@ class Tracer:
                 + post_info
             )
 
-    def _parse_push_buffer_command(self, pull_addr):
-        # Retrieve command type from Xbox
-        word = self.xbox.read_u32(0x80000000 | pull_addr)
+    def _invalidate_push_buffer_window(self):
+        self.push_buffer_window_addr = 0
+        self.push_buffer_window = b""
+
+    def _read_push_buffer(self, addr, length):
+        """Returns `length` bytes of the pushbuffer at `addr`.
+
+        Reads are served from a window of prefetched pushbuffer data, which is
+        refilled whenever a read leaves it.
+        """
+        offset = addr - self.push_buffer_window_addr
+        if 0 <= offset and offset + length <= len(self.push_buffer_window):
+            return self.push_buffer_window[offset : offset + length]
+
+        if addr < self.real_dma_push_addr:
+            # Never read past PUT, the CPU may still be writing there.
+            window_size = min(
+                self.push_buffer_window_size, self.real_dma_push_addr - addr
+            )
+            window_size = max(window_size, length)
+        else:
+            # PUT is stale or behind GET in a wrapped pushbuffer, so where the
+            # pushbuffer ends is unknown and only the requested bytes are read.
+            window_size = length
+
+        with self._profile_site("pushbuffer"):
+            self.push_buffer_window = self.xbox.read(0x80000000 | addr, window_size)
+        self.push_buffer_window_addr = addr
+        return self.push_buffer_window[:length]
+
+    def _log_command_word(self, pull_addr, word):
         self.html_log.log(["", "", "", "@0x%08X: DATA: 0x%08X" % (pull_addr, word)])
 
+    def _parse_push_buffer_word(self, pull_addr):
+        # Retrieve command type from Xbox
+        word = struct.unpack("<L", self._read_push_buffer(pull_addr, 4))[0]
+
         # FIXME: Get where this command ends
         next_parser_addr, info = XboxHelper.parse_command(pull_addr, word, self.verbose)
 
@@ -754,14 +1294,6 @@ class Tracer:
             )
 
         if info:
-            method_info = {}
-            method_info["address"] = pull_addr
-            method_info["object"] = self.xbox_helper.fetch_graphics_class()
-            method_info["method"] = info.method
-            method_info["nonincreasing"] = info.non_increasing
-            method_info["subchannel"] = info.subchannel
-            method_info["method_count"] = info.method_count
-
             # Download this command from Xbox
             if not info.method_count:
                 # Halo: CE has cases where method_count is 0?!
@@ -770,17 +1302,27 @@ class Tracer:
                 )
                 data = []
             else:
-                parameters = self.xbox.read(
-                    0x80000000 | (pull_addr + 4), info.method_count * 4
+                parameters = self._read_push_buffer(
+                    pull_addr + 4, info.method_count * 4
                 )
                 data = struct.unpack("<%dL" % info.method_count, parameters)
                 assert len(data) == info.method_count
 
+            if info.method == GraphicsClassShadow.NV_SET_OBJECT and data:
+                self.graphics_classes.on_set_object(info.subchannel, data[0])
+
+            method_info = {}
+            method_info["address"] = pull_addr
+            method_info["object"] = self.graphics_classes.get(info.subchannel)
+            method_info["method"] = info.method
+            method_info["nonincreasing"] = info.non_increasing
+            method_info["subchannel"] = info.subchannel
+            method_info["method_count"] = info.method_count
             method_info["data"] = data
         else:
             method_info = None
 
-        return method_info, next_parser_addr
+        return word, method_info, next_parser_addr
 
     def _get_method_hooks(self, method_info):
 
@@ -789,6 +1331,9 @@ class Tracer:
 
         nv_obj = method_info["object"]
         method = method_info["method"]
+        if not self.method_callbacks[nv_obj]:
+            return pre_callbacks, post_callbacks
+
         for _data in method_info["data"]:
             pre_callbacks_this, post_callbacks_this = self._filter_pgraph_method(
                 nv_obj, method
@@ -806,6 +1351,17 @@ class Tracer:
     def _record_push_buffer_command(self, method_info, pre_info, post_info):
         orig_method = method_info["method"]
 
+        if self.trace_file:
+            self.trace_file.write_command(
+                self.command_count,
+                method_info["address"],
+                method_info["object"],
+                orig_method,
+                method_info["subchannel"],
+                method_info["nonincreasing"],
+                method_info["data"],
+            )
+
         self.html_log.log(["%d" % self.command_count, "%s" % method_info])
         # Handle special case from Halo: CE where there are commands with no data.
         if not method_info["data"]:
@@ -819,7 +1375,7 @@ class Tracer:
         method_info["method"] = orig_method
         self.command_count += 1
 
-    def process_push_buffer_command(self, pull_addr):
+    def _log_parsing_start(self, pull_addr):
         self.html_log.log(
             [
                 "WARNING",
@@ -828,16 +1384,30 @@ class Tracer:
             ]
         )
 
+    def process_push_buffer_command(self, pull_addr):
         if pull_addr == self.real_dma_push_addr:
+            self._log_parsing_start(pull_addr)
             unprocessed_bytes = 0
         else:
 
             # Filter commands and check where it wants to go to
-            method_info, post_addr = self._parse_push_buffer_command(pull_addr)
+            word, method_info, post_addr = self._parse_push_buffer_word(pull_addr)
 
             # We have a problem if we can't tell where to go next
             assert post_addr
 
+            # Commands rejected by the filter are neither logged nor hooked.
+            if (
+                method_info is not None
+                and self.command_filter is not None
+                and not self.command_filter.matches(method_info)
+            ):
+                self.filtered_command_count += 1
+                return post_addr, self._skip_push_buffer_command(method_info)
+
+            self._log_parsing_start(pull_addr)
+            self._log_command_word(pull_addr, word)
+
             # If we have a method, work with it
             if method_info is None:
 
@@ -864,6 +1434,12 @@ class Tracer:
                     for callback in pre_callbacks:
                         pre_info += callback(method_info["data"][0])
 
+                # Post callbacks observe the state set by this command.
+                if self.nv097_state:
+                    self.nv097_state.record_method(method_info)
+                if self.dirty_tracker:
+                    self.dirty_tracker.record_method(method_info)
+
                 # Go where we can do post-callback
                 post_info = []
                 if len(post_callbacks) > 0:
@@ -897,10 +1473,59 @@ class Tracer:
 
         return pull_addr, unprocessed_bytes
 
+    def fast_forward_push_buffer_command(self, pull_addr):
+        """Parses a command outside of the captured frames.
+
+        Nothing is logged or dumped and no hooks are run, the FIFO only has to be
+        run whenever the flush policy allows it. Flips are counted as they are
+        parsed, the hardware catches up with them before the next hook.
+        """
+        if pull_addr == self.real_dma_push_addr:
+            return pull_addr, 0
+
+        _word, method_info, post_addr = self._parse_push_buffer_word(pull_addr)
+        assert post_addr
+
+        if method_info is None:
+            return post_addr, 4
+
+        self.fast_forward_command_count += 1
+        return post_addr, self._skip_push_buffer_command(method_info)
+
+    def _skip_push_buffer_command(self, method_info):
+        """Tracks the state set by a command that is neither logged nor hooked.
+
+        Returns the number of bytes of the command.
+        """
+        if self.nv097_state:
+            self.nv097_state.record_method(method_info)
+        if self.dirty_tracker:
+            self.dirty_tracker.record_method(method_info)
+
+        data = method_info["data"]
+        if method_info["object"] == NV097State.NV097 and data:
+            method = method_info["method"]
+            if method_info["nonincreasing"]:
+                flips = len(data) if method == NV097_FLIP_STALL else 0
+            else:
+                flips = int(method <= NV097_FLIP_STALL < method + 4 * len(data))
+            for _ in range(flips):
+                self._advance_frame()
+
+        return 4 * (1 + len(data))
+
+    def _write_snapshot(self, suffix, kind, contents):
+        """Stores a register block snapshot in the trace file and/or as a raw dump."""
+        if self.trace_file:
+            self.trace_file.write_snapshot(self.command_count, kind, contents)
+        if self.export_snapshot_files or not self.trace_file:
+            self._write(suffix, contents)
+
     def _write(self, suffix, contents):
         """Writes a raw byte dump."""
         out_path = (
             os.path.join(self.output_dir, "command%d_" % self.command_count) + suffix
         )
-        with open(out_path, "wb") as dumpfile:
-            dumpfile.write(contents)
+        self._record_artifact(os.path.relpath(out_path, self.output_dir))
+        self.artifact_writer.write(out_path, contents)
+        return out_path
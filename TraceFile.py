@@ -0,0 +1,463 @@
+"""Reads and writes the binary nv2a trace file format.
+
+A trace file starts with a 16 byte header (magic, version, reserved) followed by a
+stream of records. Every record starts with a 8 byte header holding its type and
+the length of the payload that follows:
+
+  COMMAND   command index, address, object, method, subchannel, flags, data words
+  ARTIFACT  command index and path of an image or dump, relative to the trace
+  FLIP      flip index and command index of a NV097_FLIP_STALL, frames skipped
+            by fast-forwarding consist of just the FLIP record ending them
+  SNAPSHOT  command index, kind and the raw contents of a register block
+  DELTA     command index, kind and the runs of 32-bit words that changed since
+            the previous snapshot of the same kind
+  INDEX     offset of the previous INDEX and (frame, offset) pairs of the frames
+            that started since then
+
+Every `keyframe_interval`th snapshot of a kind is stored in full, the others as a
+DELTA against their predecessor. All values are little endian. INDEX records are written every
+`index_interval` frames and when the file is closed, after which a footer pointing
+at the last INDEX is appended. Readers follow the chain backwards from the footer
+to find any frame without scanning the records. Files without a footer (e.g., if
+the tracer crashed) are still readable, the frame offsets are then recovered by
+scanning the FLIP records once.
+"""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=consider-using-with
+# pylint: disable=too-many-arguments
+
+import atexit
+import bisect
+from collections import namedtuple
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b"NV2ATRC\0"
+VERSION = 1
+
+FOOTER_MAGIC = b"NV2AIDX\0"
+
+RECORD_COMMAND = 1
+RECORD_ARTIFACT = 2
+RECORD_FLIP = 3
+RECORD_SNAPSHOT = 4
+RECORD_INDEX = 5
+RECORD_DELTA = 6
+
+SNAPSHOT_PGRAPH = 0
+SNAPSHOT_PFB = 1
+SNAPSHOT_RDI_VP_INSTRUCTIONS = 2
+SNAPSHOT_RDI_VP_CONSTANTS0 = 3
+SNAPSHOT_RDI_VP_CONSTANTS1 = 4
+
+# Number of snapshots of a kind between full copies, the others are stored as deltas.
+DEFAULT_KEYFRAME_INTERVAL = 64
+
+# Unchanged words between two changes that are stored rather than starting a new
+# run, as each run costs two words of overhead.
+_MAX_RUN_GAP = 2
+
+# Number of frames between INDEX records.
+DEFAULT_INDEX_INTERVAL = 16
+
+# Size of the write buffer in bytes.
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct("<8sLL")
+_RECORD_HEADER = struct.Struct("<HHL")
+_COMMAND = struct.Struct("<lLLHBBL")
+_ARTIFACT = struct.Struct("<l")
+_FLIP = struct.Struct("<Ll")
+_SNAPSHOT = struct.Struct("<lL")
+_DELTA = struct.Struct("<lLL")
+_DELTA_RUN = struct.Struct("<LL")
+_INDEX = struct.Struct("<QL")
+_INDEX_ENTRY = struct.Struct("<LQ")
+_FOOTER = struct.Struct("<8sQ")
+
+# Marks the first INDEX record, which has no predecessor.
+_NO_INDEX = 0xFFFFFFFFFFFFFFFF
+
+_COMMAND_FLAG_NONINCREASING = 0x01
+
+CommandRecord = namedtuple(
+    "CommandRecord",
+    [
+        "offset",
+        "command_index",
+        "address",
+        "object",
+        "method",
+        "subchannel",
+        "nonincreasing",
+        "data",
+    ],
+)
+ArtifactRecord = namedtuple("ArtifactRecord", ["offset", "command_index", "path"])
+FlipRecord = namedtuple("FlipRecord", ["offset", "flip_index", "command_index"])
+SnapshotRecord = namedtuple(
+    "SnapshotRecord", ["offset", "command_index", "kind", "data"]
+)
+# `runs` is a list of (word index, bytes) tuples.
+DeltaRecord = namedtuple("DeltaRecord", ["offset", "command_index", "kind", "runs"])
+
+
+def diff_words(old: bytes, new: bytes):
+    """Returns the runs of 32-bit words in which `new` differs from `old`.
+
+    The result is a list of (word index, bytes) tuples, nearby changes are merged
+    into a single run.
+    """
+    old_words = np.frombuffer(old, dtype="<u4")
+    new_words = np.frombuffer(new, dtype="<u4")
+    changed = np.flatnonzero(old_words != new_words)
+    if not changed.size:
+        return []
+
+    # Split wherever the gap between two changed words is too large.
+    breaks = np.flatnonzero(np.diff(changed) > _MAX_RUN_GAP + 1) + 1
+    starts = np.concatenate(([changed[0]], changed[breaks]))
+    ends = np.concatenate((changed[breaks - 1], [changed[-1]])) + 1
+    return [(int(start), new[start * 4 : end * 4]) for start, end in zip(starts, ends)]
+
+
+def apply_delta(data: bytearray, runs):
+    """Applies the runs returned by diff_words to `data`."""
+    for start, words in runs:
+        data[start * 4 : start * 4 + len(words)] = words
+
+
+class TraceWriter:
+    """Appends records to a trace file as they occur."""
+
+    def __init__(
+        self,
+        path,
+        index_interval=DEFAULT_INDEX_INTERVAL,
+        keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+    ):
+        self.path = path
+        self.index_interval = index_interval
+        self.keyframe_interval = keyframe_interval
+
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._file.write(_HEADER.pack(MAGIC, VERSION, 0))
+        self.offset = _HEADER.size
+
+        self._last_index_offset = _NO_INDEX
+        self._pending_frames = []
+
+        # Maps {kind: (data, snapshots since the last keyframe)}.
+        self._snapshots = {}
+
+        atexit.register(self.close)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def _write_record(self, record_type, *parts):
+        length = sum(len(part) for part in parts)
+        self._file.write(_RECORD_HEADER.pack(record_type, 0, length))
+        for part in parts:
+            self._file.write(part)
+        self.offset += _RECORD_HEADER.size + length
+
+    def write_command(
+        self, command_index, address, obj, method, subchannel, nonincreasing, data
+    ):
+        """Appends a pushbuffer command and its data words."""
+        flags = _COMMAND_FLAG_NONINCREASING if nonincreasing else 0
+        self._write_record(
+            RECORD_COMMAND,
+            _COMMAND.pack(
+                command_index, address, obj, method, subchannel, flags, len(data)
+            ),
+            struct.pack("<%dL" % len(data), *data),
+        )
+
+    def write_artifact(self, command_index, path):
+        """Appends a reference to an image or dump written alongside the trace."""
+        self._write_record(
+            RECORD_ARTIFACT, _ARTIFACT.pack(command_index), path.encode("utf8")
+        )
+
+    def write_flip(self, flip_index, command_index):
+        """Appends a flip marker, records following it belong to frame `flip_index`."""
+        self._write_record(RECORD_FLIP, _FLIP.pack(flip_index, command_index))
+        self._pending_frames.append((flip_index, self.offset))
+        if len(self._pending_frames) >= self.index_interval:
+            self._write_index()
+
+    def write_snapshot(self, command_index, kind, data):
+        """Appends the contents of a register block, e.g., SNAPSHOT_PGRAPH.
+
+        Returns True if the snapshot was stored in full.
+        """
+        data = bytes(data)
+        previous, since_keyframe = self._snapshots.get(kind, (None, 0))
+        if (
+            previous is None
+            or since_keyframe + 1 >= self.keyframe_interval
+            or len(previous) != len(data)
+            or len(data) % 4
+        ):
+            self._write_record(
+                RECORD_SNAPSHOT, _SNAPSHOT.pack(command_index, kind), data
+            )
+            self._snapshots[kind] = (data, 0)
+            return True
+
+        runs = diff_words(previous, data)
+        self._write_record(
+            RECORD_DELTA,
+            _DELTA.pack(command_index, kind, len(runs)),
+            *(
+                part
+                for start, words in runs
+                for part in (_DELTA_RUN.pack(start, len(words) // 4), words)
+            ),
+        )
+        self._snapshots[kind] = (data, since_keyframe + 1)
+        return False
+
+    def _write_index(self):
+        index_offset = self.offset
+        self._write_record(
+            RECORD_INDEX,
+            _INDEX.pack(self._last_index_offset, len(self._pending_frames)),
+            b"".join(
+                _INDEX_ENTRY.pack(frame, offset)
+                for frame, offset in self._pending_frames
+            ),
+        )
+        self._last_index_offset = index_offset
+        self._pending_frames = []
+
+    def flush(self):
+        """Writes any buffered records to the file."""
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        """Writes the final index and footer and closes the file."""
+        if self._file.closed:
+            return
+        self._write_index()
+        self._file.write(_FOOTER.pack(FOOTER_MAGIC, self._last_index_offset))
+        self._file.close()
+
+
+class TraceReader:
+    """Lazily iterates the records of a memory-mapped trace file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, _reserved = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise Exception("%s is not an nv2a trace file" % path)
+        if self.version != VERSION:
+            self.close()
+            raise Exception(
+                "%s has unsupported trace version %d" % (path, self.version)
+            )
+
+        self._end = len(self._mmap)
+        self._last_index_offset = self._read_footer()
+        self._frame_offsets = None
+
+        # Maps {kind: ([command index], [offset])} of every snapshot and delta.
+        self._snapshot_offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def _read_footer(self):
+        """Strips the footer and returns the offset of the last INDEX record, or None."""
+        if self._end < _HEADER.size + _FOOTER.size:
+            return None
+        magic, index_offset = _FOOTER.unpack_from(self._mmap, self._end - _FOOTER.size)
+        if magic != FOOTER_MAGIC:
+            return None
+        self._end -= _FOOTER.size
+        return index_offset
+
+    def _load_frame_offsets(self):
+        if self._frame_offsets is not None:
+            return
+
+        frame_offsets = {0: _HEADER.size}
+        index_offset = self._last_index_offset
+        if index_offset is None:
+            for record in self.records():
+                if isinstance(record, FlipRecord):
+                    frame_offsets[record.flip_index] = self._next_offset(record.offset)
+        else:
+            while index_offset != _NO_INDEX:
+                payload = index_offset + _RECORD_HEADER.size
+                index_offset, count = _INDEX.unpack_from(self._mmap, payload)
+                entries = payload + _INDEX.size
+                for frame, offset in _INDEX_ENTRY.iter_unpack(
+                    self._mmap[entries : entries + count * _INDEX_ENTRY.size]
+                ):
+                    frame_offsets[frame] = offset
+        self._frame_offsets = frame_offsets
+
+    def _next_offset(self, offset):
+        _record_type, _reserved, length = _RECORD_HEADER.unpack_from(self._mmap, offset)
+        return offset + _RECORD_HEADER.size + length
+
+    @property
+    def frame_count(self):
+        """Returns the number of frames in the trace, including an incomplete last one."""
+        self._load_frame_offsets()
+        return len(self._frame_offsets)
+
+    def frame_offset(self, frame):
+        """Returns the offset of the first record of the given frame."""
+        self._load_frame_offsets()
+        offset = self._frame_offsets.get(frame)
+        if offset is None:
+            raise IndexError(
+                "Frame %d is not in the trace (%d frames)" % (frame, self.frame_count)
+            )
+        return offset
+
+    def frame_records(self, frame):
+        """Yields the records of the given frame, ending with its FLIP record."""
+        for record in self.records(self.frame_offset(frame)):
+            yield record
+            if isinstance(record, FlipRecord):
+                return
+
+    def _load_snapshot_offsets(self):
+        if self._snapshot_offsets is not None:
+            return
+
+        snapshot_offsets = {}
+        offset = _HEADER.size
+        while offset + _RECORD_HEADER.size <= self._end:
+            record_type, _reserved, length = _RECORD_HEADER.unpack_from(
+                self._mmap, offset
+            )
+            payload = offset + _RECORD_HEADER.size
+            if payload + length > self._end:
+                break
+            if record_type in (RECORD_SNAPSHOT, RECORD_DELTA):
+                command_index, kind = _SNAPSHOT.unpack_from(self._mmap, payload)
+                command_indices, offsets = snapshot_offsets.setdefault(kind, ([], []))
+                command_indices.append(command_index)
+                offsets.append(offset)
+            offset = payload + length
+        self._snapshot_offsets = snapshot_offsets
+
+    def snapshot_at(self, kind, command_index):
+        """Returns the contents of a register block as of the given command.
+
+        This is the most recent snapshot of `kind` taken at or before
+        `command_index`, or None if there is none. No snapshots are taken in
+        fast-forwarded frames, commands in them resolve to the last snapshot of the
+        preceding captured frames.
+        """
+        self._load_snapshot_offsets()
+        command_indices, offsets = self._snapshot_offsets.get(kind, ([], []))
+        last = bisect.bisect_right(command_indices, command_index) - 1
+        if last < 0:
+            return None
+
+        first = last
+        while self._record_type(offsets[first]) != RECORD_SNAPSHOT:
+            first -= 1
+
+        data = bytearray(next(self.records(offsets[first])).data)
+        for offset in offsets[first + 1 : last + 1]:
+            apply_delta(data, next(self.records(offset)).runs)
+        return bytes(data)
+
+    def _record_type(self, offset):
+        return _RECORD_HEADER.unpack_from(self._mmap, offset)[0]
+
+    def records(self, offset=_HEADER.size):
+        """Yields the records starting at `offset`, INDEX records are skipped."""
+        end = self._end
+        while offset + _RECORD_HEADER.size <= end:
+            record_type, _reserved, length = _RECORD_HEADER.unpack_from(
+                self._mmap, offset
+            )
+            payload = offset + _RECORD_HEADER.size
+            if payload + length > end:
+                # Truncated by an interrupted writer.
+                return
+
+            record = self._decode(record_type, offset, payload, length)
+            if record is not None:
+                yield record
+            offset = payload + length
+
+    def _decode(self, record_type, offset, payload, length):
+        if record_type == RECORD_COMMAND:
+            (
+                command_index,
+                address,
+                obj,
+                method,
+                subchannel,
+                flags,
+                count,
+            ) = _COMMAND.unpack_from(self._mmap, payload)
+            data = struct.unpack_from(
+                "<%dL" % count, self._mmap, payload + _COMMAND.size
+            )
+            return CommandRecord(
+                offset,
+                command_index,
+                address,
+                obj,
+                method,
+                subchannel,
+                bool(flags & _COMMAND_FLAG_NONINCREASING),
+                data,
+            )
+
+        if record_type == RECORD_ARTIFACT:
+            (command_index,) = _ARTIFACT.unpack_from(self._mmap, payload)
+            path = self._mmap[payload + _ARTIFACT.size : payload + length]
+            return ArtifactRecord(offset, command_index, path.decode("utf8"))
+
+        if record_type == RECORD_FLIP:
+            flip_index, command_index = _FLIP.unpack_from(self._mmap, payload)
+            return FlipRecord(offset, flip_index, command_index)
+
+        if record_type == RECORD_SNAPSHOT:
+            command_index, kind = _SNAPSHOT.unpack_from(self._mmap, payload)
+            data = self._mmap[payload + _SNAPSHOT.size : payload + length]
+            return SnapshotRecord(offset, command_index, kind, data)
+
+        if record_type == RECORD_DELTA:
+            command_index, kind, run_count = _DELTA.unpack_from(self._mmap, payload)
+            runs = []
+            run_offset = payload + _DELTA.size
+            for _ in range(run_count):
+                start, count = _DELTA_RUN.unpack_from(self._mmap, run_offset)
+                run_offset += _DELTA_RUN.size
+                runs.append((start, self._mmap[run_offset : run_offset + count * 4]))
+                run_offset += count * 4
+            return DeltaRecord(offset, command_index, kind, runs)
+
+        # INDEX and unknown records are skipped.
+        return None
@@ -1,10 +1,46 @@
-"""Provides a trivial wrapper around xboxpy functionality."""
+"""Provides the Xbox wrapper around xboxpy and the wrappers stacked on top of it.
+
+Every wrapper implements the same interface (read_u32, write_u32, read, write, call
+and ke), keeps the object it wraps in `xbox` and forwards its `pipelined` flag:
+
+  Xbox              trivial wrapper around xboxpy functionality
+  InstrumentedXbox  records the count, size and latency of every operation
+  CachedXbox        caches memory reads in pages until they may have changed
+
+RecordingXbox (XboxRecording.py) may sit below them, ReplayXbox (XboxRecording.py)
+and PipelinedXbox (PipelinedXbox.py) may replace Xbox at the bottom of the stack.
+`find_wrapper` locates a wrapper of a given class anywhere in the stack.
+"""
 
 # pylint: disable=invalid-name
 # pylint: disable=too-few-public-methods
+# pylint: disable=consider-using-f-string
+
+from collections import defaultdict
+import contextlib
+import json
+import struct
+import time
 
 import xboxpy
 
+import XboxHelper
+
+# Number of latency histogram buckets, bucket i counts latencies below 2**i us.
+_HISTOGRAM_BUCKETS = 24
+
+# Name of the calling site used outside of any `profile_site`.
+DEFAULT_SITE = "other"
+
+# Size of the pages cached by CachedXbox.
+CACHE_PAGE_SIZE = 0x1000
+
+# Addresses at and above this are MMIO and never cached.
+_MMIO_BASE = 0xFD000000
+
+# Windows aliasing physical memory, as (base, mask of the physical address).
+_PHYSICAL_ALIASES = [(0x80000000, 0x0FFFFFFF), (0xF0000000, 0x0FFFFFFF)]
+
 
 class Xbox:
     """Trivial wrapper around xboxpy"""
@@ -16,3 +52,432 @@ class Xbox:
         self.write = xboxpy.write
         self.call = xboxpy.api.call
         self.ke = xboxpy.ke
+
+
+def find_wrapper(xbox, wrapper_class):
+    """Returns the `wrapper_class` instance wrapping `xbox`, or None.
+
+    Wrappers keep the object they wrap in `xbox`, so any nesting order is found.
+    """
+    while xbox is not None:
+        if isinstance(xbox, wrapper_class):
+            return xbox
+        xbox = getattr(xbox, "xbox", None)
+    return None
+
+
+class _OperationStats:
+    """Accumulates the round-trips of one operation type."""
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * _HISTOGRAM_BUCKETS
+
+    def add(self, length, duration):
+        self.count += 1
+        self.bytes += length
+        self.time += duration
+        self.max_time = max(self.max_time, duration)
+        bucket = min(int(duration * 1000000).bit_length(), _HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "bytes": self.bytes,
+            "time": self.time,
+            "max_time": self.max_time,
+            "histogram_us": {
+                "<%d" % (1 << bucket): count
+                for bucket, count in enumerate(self.histogram)
+                if count
+            },
+        }
+
+
+class _InstrumentedKernel:
+    """Records the calls of xboxpy.ke functions as `ke.<name>` operations."""
+
+    def __init__(self, xbox, ke):
+        self._xbox = xbox
+        self._ke = ke
+
+    def __getattr__(self, name):
+        function = getattr(self._ke, name)
+
+        def call(*args):
+            start = time.perf_counter()
+            ret = function(*args)
+            self._xbox.record("ke." + name, 0, start)
+            return ret
+
+        return call
+
+
+class InstrumentedXbox:
+    """Wraps an Xbox, recording the count, size and latency of every operation.
+
+    Operations are attributed to the innermost active `profile_site`. Sites also
+    record the wall time spent in them, which includes host-side work such as
+    sleeps and synchronous image encoding.
+    """
+
+    def __init__(self, xbox):
+        self.xbox = xbox
+        self.ke = _InstrumentedKernel(self, xbox.ke)
+        self.pipelined = XboxHelper.is_pipelined(xbox)
+        self.start_time = time.monotonic()
+        self.site = DEFAULT_SITE
+
+        # Maps {site: {operation: _OperationStats}}.
+        self.operations = defaultdict(lambda: defaultdict(_OperationStats))
+
+        # Maps {site: [calls, wall time]}.
+        self.site_times = defaultdict(lambda: [0, 0.0])
+
+        # Totals at the previous call to `frame_summary`.
+        self._frame_round_trips = 0
+        self._frame_bytes = 0
+        self._frame_time = 0.0
+
+    def record(self, operation, length, start):
+        self.operations[self.site][operation].add(length, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def profile_site(self, name):
+        """Attributes the operations within the `with` block to `name`."""
+        previous = self.site
+        self.site = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            site_time = self.site_times[name]
+            site_time[0] += 1
+            site_time[1] += time.perf_counter() - start
+            self.site = previous
+
+    def read_u32(self, address):
+        start = time.perf_counter()
+        ret = self.xbox.read_u32(address)
+        self.record("read_u32", 4, start)
+        return ret
+
+    def read_u32_many(self, addresses):
+        addresses = list(addresses)
+        start = time.perf_counter()
+        ret = XboxHelper.read_u32_many(self.xbox, addresses)
+        self.record("read_u32_many", 4 * len(addresses), start)
+        return ret
+
+    def write_u32(self, address, value):
+        start = time.perf_counter()
+        self.xbox.write_u32(address, value)
+        self.record("write_u32", 4, start)
+
+    def read(self, address, length):
+        start = time.perf_counter()
+        ret = self.xbox.read(address, length)
+        self.record("read", length, start)
+        return ret
+
+    def read_many(self, ranges):
+        ranges = list(ranges)
+        start = time.perf_counter()
+        ret = XboxHelper.read_many(self.xbox, ranges)
+        self.record("read_many", sum(length for _, length in ranges), start)
+        return ret
+
+    def write(self, address, data):
+        start = time.perf_counter()
+        self.xbox.write(address, data)
+        self.record("write", len(data), start)
+
+    def call(self, address, stack):
+        start = time.perf_counter()
+        ret = self.xbox.call(address, stack)
+        self.record("call", len(stack), start)
+        return ret
+
+    def _totals(self):
+        round_trips = 0
+        transferred = 0
+        duration = 0.0
+        for operations in self.operations.values():
+            for stats in operations.values():
+                round_trips += stats.count
+                transferred += stats.bytes
+                duration += stats.time
+        return round_trips, transferred, duration
+
+    def frame_summary(self):
+        """Returns a line describing the round-trips since the previous call."""
+        round_trips, transferred, duration = self._totals()
+        ret = "Profile: %d round-trips, %.1f KiB, %.3f s waiting for the Xbox" % (
+            round_trips - self._frame_round_trips,
+            (transferred - self._frame_bytes) / 1024,
+            duration - self._frame_time,
+        )
+        self._frame_round_trips = round_trips
+        self._frame_bytes = transferred
+        self._frame_time = duration
+        return ret
+
+    def report(self):
+        """Returns the recorded statistics as a JSON serializable dict."""
+        round_trips, transferred, duration = self._totals()
+
+        operations = defaultdict(_OperationStats)
+        for site_operations in self.operations.values():
+            for operation, stats in site_operations.items():
+                total = operations[operation]
+                total.count += stats.count
+                total.bytes += stats.bytes
+                total.time += stats.time
+                total.max_time = max(total.max_time, stats.max_time)
+                total.histogram = [
+                    a + b for a, b in zip(total.histogram, stats.histogram)
+                ]
+
+        sites = {}
+        for site in sorted(set(self.operations) | set(self.site_times)):
+            calls, wall_time = self.site_times.get(site, (0, 0.0))
+            sites[site] = {
+                "calls": calls,
+                "wall_time": wall_time,
+                "operations": {
+                    operation: stats.to_json()
+                    for operation, stats in sorted(self.operations[site].items())
+                },
+            }
+
+        return {
+            "duration": time.monotonic() - self.start_time,
+            "round_trips": round_trips,
+            "bytes": transferred,
+            "time": duration,
+            "operations": {
+                operation: stats.to_json()
+                for operation, stats in sorted(operations.items())
+            },
+            "sites": sites,
+        }
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        print("Wrote profile to %s" % path)
+
+
+class CachedXbox:
+    """Wraps an Xbox, caching the memory it reads in pages of CACHE_PAGE_SIZE.
+
+    Pages are keyed by physical address, so the contiguous (0x80000000) and AGP
+    (0xF0000000) windows share them. Writes drop the pages they overlap, `call`s
+    and `invalidate` drop every page by starting a new epoch, as the GPU or a patch
+    may have modified any of them. The tracer invalidates the cache whenever it runs
+    the FIFO. MMIO is never cached. On pipelined transports the missing pages of
+    batched reads are fetched in a single batch.
+    """
+
+    def __init__(self, xbox):
+        self.xbox = xbox
+        self.ke = xbox.ke
+        self.pipelined = XboxHelper.is_pipelined(xbox)
+        self.epoch = 0
+
+        # Maps {(address space, page index): page contents} for the current epoch.
+        self.pages = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+
+    @staticmethod
+    def _page_key(address):
+        """Returns (address space, page index, offset within the page)."""
+        space = "virtual"
+        for base, mask in _PHYSICAL_ALIASES:
+            if address & ~mask == base:
+                space = "physical"
+                address &= mask
+                break
+        page, offset = divmod(address, CACHE_PAGE_SIZE)
+        return space, page, offset
+
+    def invalidate(self):
+        """Drops every cached page."""
+        self.epoch += 1
+        self.pages = {}
+
+    def _invalidate_range(self, address, length):
+        if not self.pages or not length or address >= _MMIO_BASE:
+            return
+        space, first, offset = self._page_key(address)
+        last = first + (offset + length - 1) // CACHE_PAGE_SIZE
+        for page in range(first, last + 1):
+            self.pages.pop((space, page), None)
+
+    def _missing_runs(self, address, length, pending):
+        """Returns the runs of pages of a range that are neither cached nor pending.
+
+        Runs are (address, address space, first page, page count) and are added to
+        `pending`. The range is counted as a hit if all its pages are cached.
+        """
+        space, first, offset = self._page_key(address)
+        last = first + (offset + length - 1) // CACHE_PAGE_SIZE
+        pages = self.pages
+
+        runs = []
+        hit = True
+        for page in range(first, last + 1):
+            key = (space, page)
+            if key in pages:
+                continue
+            hit = False
+            if key in pending:
+                continue
+            pending.add(key)
+            if runs and runs[-1][2] + runs[-1][3] == page:
+                runs[-1][3] += 1
+            else:
+                page_address = address - offset + (page - first) * CACHE_PAGE_SIZE
+                runs.append([page_address, space, page, 1])
+
+        if hit:
+            self.hits += 1
+            self.bytes_saved += length
+        else:
+            self.misses += 1
+        return runs
+
+    def _fill(self, ranges):
+        """Caches the pages of the given (address, length) ranges.
+
+        Missing pages are fetched in contiguous runs, in a single batch on pipelined
+        transports.
+        """
+        pending = set()
+        runs = []
+        for address, length in ranges:
+            runs += self._missing_runs(address, length, pending)
+        if not runs:
+            return
+
+        fetched = XboxHelper.read_many(
+            self.xbox,
+            [(address, count * CACHE_PAGE_SIZE) for address, _, _, count in runs],
+        )
+        for (_address, space, first, count), data in zip(runs, fetched):
+            self.bytes_fetched += len(data)
+            for i in range(count):
+                self.pages[(space, first + i)] = data[
+                    i * CACHE_PAGE_SIZE : (i + 1) * CACHE_PAGE_SIZE
+                ]
+
+    def _serve(self, address, length):
+        """Returns the bytes of a range whose pages are cached."""
+        space, first, offset = self._page_key(address)
+        last = first + (offset + length - 1) // CACHE_PAGE_SIZE
+        pages = self.pages
+        if first == last:
+            return pages[(space, first)][offset : offset + length]
+        data = b"".join(pages[(space, page)] for page in range(first, last + 1))
+        return data[offset : offset + length]
+
+    @staticmethod
+    def _is_cacheable(address, length):
+        return length and address + length <= _MMIO_BASE
+
+    def read_u32(self, address):
+        if not self._is_cacheable(address, 4):
+            self.bypassed += 1
+            return self.xbox.read_u32(address)
+        self._fill([(address, 4)])
+        return struct.unpack("<L", self._serve(address, 4))[0]
+
+    def read_u32_many(self, addresses):
+        addresses = list(addresses)
+        bypassed = [
+            address for address in addresses if not self._is_cacheable(address, 4)
+        ]
+        self.bypassed += len(bypassed)
+        bypassed_values = iter(XboxHelper.read_u32_many(self.xbox, bypassed))
+        self._fill(
+            [(address, 4) for address in addresses if self._is_cacheable(address, 4)]
+        )
+        return [
+            (
+                struct.unpack("<L", self._serve(address, 4))[0]
+                if self._is_cacheable(address, 4)
+                else next(bypassed_values)
+            )
+            for address in addresses
+        ]
+
+    def read(self, address, length):
+        if not self._is_cacheable(address, length):
+            self.bypassed += 1
+            return self.xbox.read(address, length)
+        self._fill([(address, length)])
+        return self._serve(address, length)
+
+    def read_many(self, ranges):
+        ranges = list(ranges)
+        bypassed = [
+            (address, length)
+            for address, length in ranges
+            if not self._is_cacheable(address, length)
+        ]
+        self.bypassed += len(bypassed)
+        bypassed_data = iter(XboxHelper.read_many(self.xbox, bypassed))
+        self._fill(
+            [
+                (address, length)
+                for address, length in ranges
+                if self._is_cacheable(address, length)
+            ]
+        )
+        return [
+            (
+                self._serve(address, length)
+                if self._is_cacheable(address, length)
+                else next(bypassed_data)
+            )
+            for address, length in ranges
+        ]
+
+    def write_u32(self, address, value):
+        self._invalidate_range(address, 4)
+        self.xbox.write_u32(address, value)
+
+    def write(self, address, data):
+        self._invalidate_range(address, len(data))
+        self.xbox.write(address, data)
+
+    def call(self, address, stack):
+        ret = self.xbox.call(address, stack)
+        self.invalidate()
+        return ret
+
+    def summary(self):
+        """Returns a line describing the cache statistics."""
+        requests = self.hits + self.misses
+        return (
+            "Read cache: %d hits, %d misses (%.1f%% hit rate), %d bypassed, "
+            "%.1f KiB saved, %.1f KiB fetched, %d epochs"
+            % (
+                self.hits,
+                self.misses,
+                100.0 * self.hits / max(requests, 1),
+                self.bypassed,
+                self.bytes_saved / 1024,
+                self.bytes_fetched / 1024,
+                self.epoch,
+            )
+        )
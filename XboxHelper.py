@@ -6,6 +6,10 @@
 
 import atexit
 from collections import namedtuple
+import struct
+from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Optional
 from typing import Tuple
 import time
@@ -53,6 +57,10 @@ def _PGRAPH(addr):
     return NV2A_MMIO_BASE + BLOCK_PGRAPH + addr
 
 
+def _PRAMIN(addr):
+    return NV2A_MMIO_BASE + BLOCK_PRAMIN + addr
+
+
 # Pushbuffer state
 NV_PFIFO_CACHE1_DMA_STATE = 0x00001228
 DMA_STATE = _PFIFO(NV_PFIFO_CACHE1_DMA_STATE)
@@ -71,6 +79,10 @@ DMA_SUBROUTINE = _PFIFO(NV_PFIFO_CACHE1_DMA_SUBROUTINE)
 NV_PFIFO_CACHE1_PUSH0 = 0x00001200
 CACHE_PUSH_MASTER_STATE = _PFIFO(NV_PFIFO_CACHE1_PUSH0)
 
+# CACHE channel ID
+NV_PFIFO_CACHE1_PUSH1 = 0x00001204
+CACHE_PUSH_CHANNEL = _PFIFO(NV_PFIFO_CACHE1_PUSH1)
+
 # CACHE write state
 NV_PFIFO_CACHE1_DMA_PUSH = 0x00001220
 CACHE_PUSH_STATE = _PFIFO(NV_PFIFO_CACHE1_DMA_PUSH)
@@ -90,7 +102,7 @@ CACHE_PULL_ADDR = _PFIFO(NV_PFIFO_CACHE1_GET)
 NV_PFIFO_CACHE1_METHOD = 0x00001800
 CACHE1_METHOD = _PFIFO(NV_PFIFO_CACHE1_METHOD)
 
-NV_PFIFO_CACHE1_DATA = 0xFD003804
+NV_PFIFO_CACHE1_DATA = 0x00001804
 CACHE1_DATA = _PFIFO(NV_PFIFO_CACHE1_DATA)
 
 NV_PFIFO_RAMHT = 0x00000210
@@ -99,6 +111,10 @@ RAM_HASHTABLE = _PFIFO(NV_PFIFO_RAMHT)
 NV_PGRAPH_CTX_SWITCH1 = 0x0000014C
 CTX_SWITCH1 = _PGRAPH(NV_PGRAPH_CTX_SWITCH1)
 
+# Per-subchannel copies of CTX_SWITCH1, indexed by subchannel * 4.
+NV_PGRAPH_CTX_CACHE1 = 0x00000160
+CTX_CACHE1 = _PGRAPH(NV_PGRAPH_CTX_CACHE1)
+
 NV_PGRAPH_FIFO = 0x00000720
 PGRAPH_STATE = _PGRAPH(NV_PGRAPH_FIFO)
 
@@ -118,6 +134,20 @@ NV_PGRAPH_TEXFMT0 = 0x00001A04
 PGRAPH_TEXFMT0 = _PGRAPH(NV_PGRAPH_TEXFMT0)
 
 
+# Number of toggles after which a shadowed register is read from hardware again.
+SHADOW_RESYNC_INTERVAL = 256
+
+# Registers whose enable bit is toggled from a shadow copy. NV_PGRAPH_FIFO only
+# holds the ACCESS bit; CACHE1_DMA_PUSH and CACHE1_PULL0 also contain status bits
+# owned by the hardware, which a stale copy would overwrite, so they are always
+# read before they are written.
+_SHADOWED_REGISTERS = {PGRAPH_STATE}
+
+
+# Maps {address: xbox} for the allocations that have not been freed yet.
+_allocations = {}
+
+
 def _free_allocation(xbox, address):
     print("_free_allocation: Free'ing 0x%08X" % address)
     xbox.ke.MmFreeContiguousMemory(address)
@@ -126,17 +156,167 @@ def _free_allocation(xbox, address):
     print("_free_allocation: Freed")
 
 
+def _free_allocations():
+    for address, xbox in reversed(list(_allocations.items())):
+        free_allocation(xbox, address)
+
+
+def allocate(xbox, size):
+    """Allocates a contiguous memory block on the xbox, which is freed at exit."""
+    address = xbox.ke.MmAllocateContiguousMemory(size)
+    print("allocate: Allocated %d bytes at 0x%08X" % (size, address))
+
+    # Registered on first use, so that the allocations are freed before the
+    # transports created earlier are closed.
+    if not _allocations:
+        atexit.register(_free_allocations)
+    _allocations[address] = xbox
+    return address
+
+
+def free_allocation(xbox, address):
+    """Frees a block returned by `allocate` or `load_binary` before exit."""
+    if _allocations.pop(address, None) is not None:
+        _free_allocation(xbox, address)
+
+
 def load_binary(xbox, data):
     """Loads arbitrary data into a new contiguous memory block on the xbox."""
-    data_len = len(data)
-    code_addr = xbox.ke.MmAllocateContiguousMemory(data_len)
-    print("load_binary: Allocated %d bytes at 0x%08X" % (data_len, code_addr))
-
-    atexit.register(_free_allocation, xbox, code_addr)
+    code_addr = allocate(xbox, len(data))
     xbox.write(code_addr, data)
     return code_addr
 
 
+def is_pipelined(xbox) -> bool:
+    """Returns True if `xbox` keeps batched reads in flight at once."""
+    return getattr(xbox, "pipelined", False)
+
+
+def read_u32_many(xbox, addresses: Iterable[int]) -> List[int]:
+    """Reads the given addresses in order.
+
+    Pipelined transports keep the reads in flight at once, others read them one at a
+    time. Transports and the wrappers around them set `pipelined` to True if they
+    implement `read_u32_many` and `read_many`.
+    """
+    if is_pipelined(xbox):
+        return xbox.read_u32_many(list(addresses))
+    return [xbox.read_u32(address) for address in addresses]
+
+
+def read_many(xbox, ranges: Iterable[Tuple[int, int]]) -> List[bytes]:
+    """Reads the given (address, length) ranges in order, see `read_u32_many`."""
+    if is_pipelined(xbox):
+        return xbox.read_many(list(ranges))
+    return [xbox.read(address, length) for address, length in ranges]
+
+
+class _RegisterReader:
+    """Manages the read_registers.asm patch.
+
+    Address lists are uploaded into one of several slots and reused for as long as
+    the same list is requested again, so repeated reads of a fixed register set
+    cost a single `call` and a single `read`. Pipelined transports read the list in
+    a single round-trip without the patch.
+    """
+
+    # Maximum number of addresses read by a single call.
+    MAX_REGISTERS = 256
+
+    # Number of address lists kept resident on the xbox.
+    LIST_SLOTS = 8
+
+    # Lists shorter than this are cheaper to read one register at a time.
+    MIN_BATCH_SIZE = 3
+
+    def __init__(self, verbose=True):
+        self.method_addr = None
+        self.list_addr = None
+        self.values_addr = None
+        self.verbose = verbose
+        self.enabled = True
+        self._slots = {}
+        self._next_slot = 0
+
+    def _install_reader(self, xbox):
+        if self.method_addr is not None:
+            return
+
+        with open("read_registers", "rb") as patch_file:
+            data = patch_file.read()
+
+        self.method_addr = load_binary(xbox, data)
+        self.list_addr = load_binary(
+            xbox, bytes(self.LIST_SLOTS * self.MAX_REGISTERS * 4)
+        )
+        self.values_addr = load_binary(xbox, bytes(self.MAX_REGISTERS * 4))
+        if self.verbose:
+            print("read_registers installed at 0x%08X" % self.method_addr)
+
+    def _upload_list(self, xbox, addresses) -> int:
+        """Returns the address of a slot containing the given address list."""
+        slot_addr = self._slots.get(addresses)
+        if slot_addr is not None:
+            return slot_addr
+
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.LIST_SLOTS
+        slot_addr = self.list_addr + slot * self.MAX_REGISTERS * 4
+
+        self._slots = {
+            key: value for key, value in self._slots.items() if value != slot_addr
+        }
+        xbox.write(slot_addr, struct.pack("<%dL" % len(addresses), *addresses))
+        self._slots[addresses] = slot_addr
+        return slot_addr
+
+    def _read_batch(self, xbox, addresses) -> Tuple[int, ...]:
+        slot_addr = self._upload_list(xbox, addresses)
+        count = len(addresses)
+        xbox.call(
+            self.method_addr,
+            struct.pack("<LLL", slot_addr, count, self.values_addr),
+        )
+        return struct.unpack("<%dL" % count, xbox.read(self.values_addr, count * 4))
+
+    def read(self, xbox, addresses) -> Dict[int, int]:
+        """Reads the given addresses, in order, and returns a dict of their values."""
+        addresses = tuple(addresses)
+        if (
+            not self.enabled
+            or len(addresses) < self.MIN_BATCH_SIZE
+            or getattr(xbox, "call", None) is None
+            or is_pipelined(xbox)
+        ):
+            return dict(zip(addresses, read_u32_many(xbox, addresses)))
+
+        self._install_reader(xbox)
+
+        ret = {}
+        for start in range(0, len(addresses), self.MAX_REGISTERS):
+            chunk = addresses[start : start + self.MAX_REGISTERS]
+            ret.update(zip(chunk, self._read_batch(xbox, chunk)))
+        return ret
+
+
+_register_reader = _RegisterReader()
+
+
+def read_registers(xbox, addresses: Iterable[int]) -> Dict[int, int]:
+    """Returns a dict mapping each of the given addresses to its 32-bit value.
+
+    The reads are performed on the xbox by an uploaded stub, in the given order, so
+    the cost is independent of the number of registers. Transports without `call`
+    fall back to individual `read_u32`s, pipelined transports to `read_u32_many`.
+    """
+    return _register_reader.read(xbox, addresses)
+
+
+def set_batched_register_reads(enabled: bool):
+    """Enables or disables the read_registers.asm patch (e.g., for benchmarking)."""
+    _register_reader.enabled = enabled
+
+
 def parse_command(addr, word, display=False) -> Tuple[int, Optional[Method]]:
 
     prefix = "0x%08X: Opcode: 0x%08X" % (addr, word)
@@ -197,12 +377,50 @@ def parse_command(addr, word, display=False) -> Tuple[int, Optional[Method]]:
 
 
 class XboxHelper:
-    """Provides various functions for interaction with XBOX"""
+    """Provides various functions for interaction with XBOX
+
+    The enable bit of PGRAPH_STATE is toggled with a single write based on a shadow
+    copy of the register, which is read from hardware on first use, every
+    SHADOW_RESYNC_INTERVAL toggles and after `resync_register_shadows`. A re-read
+    that differs from the shadow in any other bit is reported.
+    """
 
-    def __init__(self, xbox):
+    def __init__(self, xbox, enable_register_shadows=True):
         self.xbox = xbox
         self.ramht_offset = 0
         self.ramht_size = 0
+        self.ramht_channel_id = 0
+        self.enable_register_shadows = enable_register_shadows
+
+        # Maps {register: [value, toggles since it was read from hardware]}.
+        self._register_shadows = {}
+
+    def resync_register_shadows(self):
+        """Reads the shadowed registers from hardware before their next toggle."""
+        for shadow in self._register_shadows.values():
+            shadow[1] = SHADOW_RESYNC_INTERVAL
+
+    def _set_enable_bit(self, register, enabled):
+        if not self.enable_register_shadows or register not in _SHADOWED_REGISTERS:
+            state = self.xbox.read_u32(register)
+            self.xbox.write_u32(register, (state & 0xFFFFFFFE) | int(enabled))
+            return
+
+        shadow = self._register_shadows.get(register)
+        if shadow is None or shadow[1] >= SHADOW_RESYNC_INTERVAL:
+            state = self.xbox.read_u32(register)
+            # Bit 0 is also toggled by the on-target patches.
+            if shadow is not None and (state ^ shadow[0]) & 0xFFFFFFFE:
+                print(
+                    "Warning: 0x%08X was 0x%08X, expected 0x%08X from its shadow"
+                    % (register, state, shadow[0])
+                )
+            shadow = [state, 0]
+            self._register_shadows[register] = shadow
+
+        shadow[0] = (shadow[0] & 0xFFFFFFFE) | int(enabled)
+        shadow[1] += 1
+        self.xbox.write_u32(register, shadow[0])
 
     def delay(self):
         # FIXME: if this returns `True`, the functions below should have their own
@@ -211,33 +429,26 @@ class XboxHelper:
         return False
 
     def disable_pgraph_fifo(self):
-        state = self.xbox.read_u32(PGRAPH_STATE)
-        self.xbox.write_u32(PGRAPH_STATE, state & 0xFFFFFFFE)
+        self._set_enable_bit(PGRAPH_STATE, False)
 
     def wait_until_pgraph_idle(self):
         while self.xbox.read_u32(PGRAPH_STATUS) & 0x00000001:
             time.sleep(0.001)
 
     def enable_pgraph_fifo(self):
-        state = self.xbox.read_u32(PGRAPH_STATE)
-        self.xbox.write_u32(PGRAPH_STATE, state | 0x00000001)
+        self._set_enable_bit(PGRAPH_STATE, True)
         if self.delay():
             pass
 
     def pause_fifo_puller(self):
         """Disable the PFIFO puller"""
-        state_s1 = self.xbox.read_u32(CACHE_PULL_STATE)
-        self.xbox.write_u32(CACHE_PULL_STATE, state_s1 & 0xFFFFFFFE)
+        self._set_enable_bit(CACHE_PULL_STATE, False)
         if self.delay():
             pass
-        # print("Puller State was 0x" + format(state_s1, '08X'))
 
     def resume_fifo_puller(self):
         """Enable the PFIFO puller"""
-        state_s2 = self.xbox.read_u32(CACHE_PULL_STATE)
-        self.xbox.write_u32(
-            CACHE_PULL_STATE, (state_s2 & 0xFFFFFFFE) | 1
-        )  # Recover puller state
+        self._set_enable_bit(CACHE_PULL_STATE, True)  # Recover puller state
         if self.delay():
             pass
 
@@ -249,18 +460,14 @@ class XboxHelper:
     def pause_fifo_pusher(self):
         """Disable the PFIFO pusher"""
         # Must be kept in sync with method used in kick_fifo.asm
-        state = self.xbox.read_u32(CACHE_PUSH_STATE)
-        self.xbox.write_u32(CACHE_PUSH_STATE, state & 0xFFFFFFFE)
+        self._set_enable_bit(CACHE_PUSH_STATE, False)
         if self.delay():
             pass
 
     def resume_fifo_pusher(self):
         """Enable the PFIFO pusher"""
         # Must be kept in sync with method used in kick_fifo.asm
-        state = self.xbox.read_u32(CACHE_PUSH_STATE)
-        self.xbox.write_u32(
-            CACHE_PUSH_STATE, (state & 0xFFFFFFFE) | 1
-        )  # Recover pusher state
+        self._set_enable_bit(CACHE_PUSH_STATE, True)  # Recover pusher state
         if self.delay():
             pass
 
@@ -305,12 +512,28 @@ class XboxHelper:
         self._dump_pb(dma_pull_addr, dma_push_addr)
         print()
 
+    def read_registers(self, addresses: Iterable[int]) -> Dict[int, int]:
+        return read_registers(self.xbox, addresses)
+
     def print_cache_state(self, print_contents=False):
-        pull_addr = self.xbox.read_u32(CACHE_PULL_ADDR)
-        push_addr = self.xbox.read_u32(CACHE_PUSH_ADDR)
+        registers = [
+            CACHE_PULL_ADDR,
+            CACHE_PUSH_ADDR,
+            CACHE_PULL_STATE,
+            CACHE_PUSH_STATE,
+        ]
+        if print_contents:
+            # JFR: The CACHE is intentionally read one register at a time as behavior
+            # is dependent on the implementation of xboxpy's `read`.
+            for i in range(128):
+                registers += [CACHE1_METHOD + i * 8, CACHE1_DATA + i * 8]
+        values = self.read_registers(registers)
+
+        pull_addr = values[CACHE_PULL_ADDR]
+        push_addr = values[CACHE_PUSH_ADDR]
 
-        pull_state = self.xbox.read_u32(CACHE_PULL_STATE)
-        push_state = self.xbox.read_u32(CACHE_PUSH_STATE)
+        pull_state = values[CACHE_PULL_STATE]
+        push_state = values[CACHE_PUSH_STATE]
 
         print("CACHE-State: PULL: 0x%X  PUSH: 0x%X" % (pull_addr, push_addr))
 
@@ -319,12 +542,10 @@ class XboxHelper:
 
         if print_contents:
             print("Cache:")
-            # JFR: This is intentionally read in a loop as behavior is dependent on the
-            # implementation of xboxpy's `read`.
             for i in range(128):
 
-                cache1_method = self.xbox.read_u32(CACHE1_METHOD + i * 8)
-                cache1_data = self.xbox.read_u32(CACHE1_DATA + i * 8)
+                cache1_method = values[CACHE1_METHOD + i * 8]
+                cache1_data = values[CACHE1_DATA + i * 8]
 
                 output = "  [0x%02X] 0x%04X (0x%08X)" % (i, cache1_method, cache1_data)
                 pull_offset = i * 8 - pull_addr
@@ -357,18 +578,81 @@ class XboxHelper:
         NV_PFIFO_RAMHT_BASE_ADDRESS = 0x000001F0
         NV_PFIFO_RAMHT_SIZE = 0x00030000
 
-        offset = (ht & NV_PFIFO_RAMHT_BASE_ADDRESS) << 12
+        # The base address field holds bits 12+ of the offset into RAMIN.
+        offset = (ht & NV_PFIFO_RAMHT_BASE_ADDRESS) << 8
         size = 1 << (((ht & NV_PFIFO_RAMHT_SIZE) >> 16) + 12)
 
         self.ramht_offset = offset
         self.ramht_size = size
+        self.ramht_channel_id = self.xbox.read_u32(CACHE_PUSH_CHANNEL) & 0x1F
         print("RAMHT: 0x%X - Base addr 0x%X size: %d" % (ht, offset, size))
 
+    def _ramht_hash(self, handle):
+        # See xemu's ramht_hash.
+        bits = self.ramht_size.bit_length() - 2
+        ret = 0
+        while handle:
+            ret ^= handle & ((1 << bits) - 1)
+            handle >>= bits
+        ret ^= self.ramht_channel_id << (bits - 4)
+        return ret
+
+    def _lookup_ramht_instance(self, handle) -> Optional[int]:
+        """Returns the RAMIN offset of the object bound to `handle` in RAMHT."""
+        if not self.ramht_size:
+            self.fetch_ramht()
+
+        NV_RAMHT_INSTANCE = 0x0000FFFF
+        NV_RAMHT_STATUS = 0x80000000
+
+        entry_addr = _PRAMIN(self.ramht_offset + self._ramht_hash(handle) * 8)
+        entry_handle, context = struct.unpack("<LL", self.xbox.read(entry_addr, 8))
+        if entry_handle != handle or not context & NV_RAMHT_STATUS:
+            return None
+
+        return (context & NV_RAMHT_INSTANCE) << 4
+
+    def lookup_object_class(self, handle) -> Optional[int]:
+        """Returns the graphics class of the object bound to `handle` in RAMHT.
+
+        Returns None if RAMHT has no valid entry for the handle.
+        """
+        instance = self._lookup_ramht_instance(handle)
+        if instance is None:
+            return None
+        return self.xbox.read_u32(_PRAMIN(instance)) & 0xFF
+
+    def lookup_dma_object_address(self, handle) -> Optional[int]:
+        """Returns the base address of the DMA object bound to `handle` in RAMHT.
+
+        Returns None if RAMHT has no valid entry for the handle.
+        """
+        instance = self._lookup_ramht_instance(handle)
+        if instance is None:
+            return None
+
+        NV_DMA_ADJUST = 0xFFF00000
+        NV_DMA_ADDRESS = 0xFFFFF000
+
+        flags, _limit, frame = struct.unpack(
+            "<LLL", self.xbox.read(_PRAMIN(instance), 12)
+        )
+        return (frame & NV_DMA_ADDRESS) | ((flags & NV_DMA_ADJUST) >> 20)
+
     def fetch_graphics_class(self):
         """Returns the target graphics class."""
         ctx_switch_1 = self.xbox.read_u32(CTX_SWITCH1)
         return ctx_switch_1 & 0xFF
 
+    def fetch_subchannel_classes(self) -> Dict[int, int]:
+        """Returns {subchannel: graphics class} for the objects bound in PGRAPH."""
+        registers = [CTX_CACHE1 + subchannel * 4 for subchannel in range(8)]
+        values = self.read_registers(registers)
+        return {
+            subchannel: values[register] & 0xFF
+            for subchannel, register in enumerate(registers)
+        }
+
     def parse_dma_state(self):
         dma_state = self.xbox.read_u32(DMA_STATE)
         ret = DMAState(
@@ -0,0 +1,354 @@
+"""Records the requests made to an Xbox and replays them offline.
+
+A recording is a gzip compressed stream of records, one per request, in the order
+they were made. Every record starts with a 9 byte header (op, address, length)
+followed by a payload that depends on the op:
+
+  READ_U32   value read
+  WRITE_U32  value written (stored in the length field)
+  READ       the `length` bytes read
+  WRITE      the `length` bytes written
+  CALL       the `length` bytes of the stack and the returned eax
+  KE         `length` bytes of the function name, `address` arguments and
+             whether a value was returned followed by the value
+  ABORT      marks the first check of the abort flag that returned True
+
+Batched reads (`read_u32_many` and `read_many`) are recorded as one READ_U32 or
+READ record per address. The header stores whether the recorded transport was
+pipelined, a replay of a pipelined recording is pipelined as well, so the tracer
+takes the same paths. All values are little endian.
+
+Replaying a recording requires the tracer to make exactly the same requests, so it
+must be run with the same options. Sampling dumps by rate depends on the host clock
+and is therefore not deterministic.
+"""
+
+# pylint: disable=consider-using-f-string
+# pylint: disable=consider-using-with
+
+import atexit
+import gzip
+import struct
+
+import XboxHelper
+
+MAGIC = b"NV2AREC\0"
+VERSION = 2
+
+# Header flag set if the recorded transport was pipelined.
+FLAG_PIPELINED = 0x00000001
+
+OP_READ_U32 = 1
+OP_WRITE_U32 = 2
+OP_READ = 3
+OP_WRITE = 4
+OP_CALL = 5
+OP_KE = 6
+OP_ABORT = 7
+
+_HEADER = struct.Struct("<8sLL")
+_RECORD = struct.Struct("<BLL")
+_U32 = struct.Struct("<L")
+_KE_RESULT = struct.Struct("<BL")
+
+# Compression level of recordings, higher levels slow down the capture.
+_COMPRESS_LEVEL = 1
+
+
+class ReplayDivergence(Exception):
+    """Raised when the replayed requests differ from the recorded ones."""
+
+
+def _describe(op, address, length, payload):
+    """Returns a human readable description of a request."""
+    if op == OP_READ_U32:
+        return "read_u32(0x%08X)" % address
+    if op == OP_WRITE_U32:
+        return "write_u32(0x%08X, 0x%08X)" % (address, length)
+    if op == OP_READ:
+        return "read(0x%08X, %d)" % (address, length)
+    if op == OP_WRITE:
+        return "write(0x%08X, %d bytes)" % (address, length)
+    if op == OP_CALL:
+        return "call(0x%08X, %s)" % (address, payload.hex())
+    if op == OP_KE:
+        name = payload[:length].decode("ascii")
+        args = struct.unpack_from("<%dL" % address, payload, length)
+        return "ke.%s(%s)" % (name, ", ".join("0x%X" % arg for arg in args))
+    if op == OP_ABORT:
+        return "abort"
+    return "unknown op %d" % op
+
+
+class _RecordingKernel:
+    """Records the calls of xboxpy.ke functions as KE requests."""
+
+    def __init__(self, xbox, ke):
+        self._xbox = xbox
+        self._ke = ke
+
+    def __getattr__(self, name):
+        function = getattr(self._ke, name)
+
+        def call(*args):
+            ret = function(*args)
+            self._xbox.record_ke(name, args, ret)
+            return ret
+
+        return call
+
+
+class _RecordingAbortFlag:
+    """Wraps an AbortFlag, recording when an abort is first observed."""
+
+    def __init__(self, xbox, abort_flag):
+        self._xbox = xbox
+        self._abort_flag = abort_flag
+
+    def abort(self):
+        self._abort_flag.abort()
+
+    @property
+    def should_abort(self):
+        ret = self._abort_flag.should_abort
+        if ret:
+            self._xbox.record_abort()
+        return ret
+
+
+class RecordingXbox:
+    """Wraps an Xbox, recording every request and its response to `path`.
+
+    Abort flags passed to the tracer must be wrapped by `wrap_abort_flag`, so that a
+    replay observes the abort between the same two requests.
+    """
+
+    def __init__(self, xbox, path):
+        self.xbox = xbox
+        self.ke = _RecordingKernel(self, xbox.ke)
+        self.pipelined = XboxHelper.is_pipelined(xbox)
+        self.path = path
+        self.aborted = False
+        self.request_count = 0
+
+        self.file = gzip.open(path, "wb", compresslevel=_COMPRESS_LEVEL)
+        self.file.write(
+            _HEADER.pack(MAGIC, VERSION, FLAG_PIPELINED if self.pipelined else 0)
+        )
+        atexit.register(self.close)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            print("Recorded %d requests to %s" % (self.request_count, self.path))
+
+    def wrap_abort_flag(self, abort_flag):
+        return _RecordingAbortFlag(self, abort_flag)
+
+    def record_abort(self):
+        if self.file and not self.aborted:
+            self.aborted = True
+            self.file.write(_RECORD.pack(OP_ABORT, 0, 0))
+
+    def _record(self, op, address, length, *payload):
+        if not self.file:
+            return
+        self.request_count += 1
+        self.file.write(_RECORD.pack(op, address, length))
+        for data in payload:
+            self.file.write(data)
+
+    def record_ke(self, name, args, ret):
+        name = name.encode("ascii")
+        self._record(
+            OP_KE,
+            len(args),
+            len(name),
+            name,
+            struct.pack("<%dL" % len(args), *args),
+            _KE_RESULT.pack(ret is not None, ret or 0),
+        )
+
+    def read_u32(self, address):
+        ret = self.xbox.read_u32(address)
+        self._record(OP_READ_U32, address, 0, _U32.pack(ret))
+        return ret
+
+    def read_u32_many(self, addresses):
+        addresses = list(addresses)
+        ret = XboxHelper.read_u32_many(self.xbox, addresses)
+        for address, value in zip(addresses, ret):
+            self._record(OP_READ_U32, address, 0, _U32.pack(value))
+        return ret
+
+    def write_u32(self, address, value):
+        self.xbox.write_u32(address, value)
+        self._record(OP_WRITE_U32, address, value)
+
+    def read(self, address, length):
+        ret = self.xbox.read(address, length)
+        self._record(OP_READ, address, length, ret)
+        return ret
+
+    def read_many(self, ranges):
+        ranges = list(ranges)
+        ret = XboxHelper.read_many(self.xbox, ranges)
+        for (address, length), data in zip(ranges, ret):
+            self._record(OP_READ, address, length, data)
+        return ret
+
+    def write(self, address, data):
+        self.xbox.write(address, data)
+        self._record(OP_WRITE, address, len(data), data)
+
+    def call(self, address, stack):
+        ret = self.xbox.call(address, stack)
+        self._record(OP_CALL, address, len(stack), stack, _U32.pack(ret["eax"]))
+        return ret
+
+
+class _ReplayKernel:
+    """Serves the calls of xboxpy.ke functions from KE records."""
+
+    def __init__(self, xbox):
+        self._xbox = xbox
+
+    def __getattr__(self, name):
+        def call(*args):
+            return self._xbox.replay_ke(name, args)
+
+        return call
+
+
+class _ReplayAbortFlag:
+    """Wraps an AbortFlag, which is also set where the recording observed it."""
+
+    def __init__(self, xbox, abort_flag):
+        self._xbox = xbox
+        self._abort_flag = abort_flag
+
+    def abort(self):
+        self._abort_flag.abort()
+
+    @property
+    def should_abort(self):
+        if self._xbox.replay_abort():
+            self._abort_flag.abort()
+        return self._abort_flag.should_abort
+
+
+class ReplayXbox:
+    """Implements the Xbox wrapper interface by replaying a recording.
+
+    Every request is compared against the next recorded one and answered with the
+    recorded response. The first mismatch raises ReplayDivergence, which names the
+    index of the request and both requests; every later request raises it again.
+    """
+
+    def __init__(self, path):
+        self.ke = _ReplayKernel(self)
+        self.path = path
+        self.request_count = 0
+        self.divergence = None
+
+        self.file = gzip.open(path, "rb")
+        magic, version, flags = _HEADER.unpack(self.file.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a recording of version %d" % (path, VERSION))
+        self.pipelined = bool(flags & FLAG_PIPELINED)
+
+    def _read_exactly(self, length):
+        data = self.file.read(length)
+        if len(data) != length:
+            raise ReplayDivergence("Truncated recording %s" % self.path)
+        return data
+
+    def _diverge(self, message):
+        self.divergence = "Replay diverged at request %d: %s" % (
+            self.request_count,
+            message,
+        )
+        raise ReplayDivergence(self.divergence)
+
+    def wrap_abort_flag(self, abort_flag):
+        return _ReplayAbortFlag(self, abort_flag)
+
+    def replay_abort(self):
+        """Returns True if the recording observed an abort at this point."""
+        if self.divergence or self.file.peek(1)[:1] != bytes([OP_ABORT]):
+            return False
+        self.file.read(_RECORD.size)
+        return True
+
+    def _next(self, op, address, length, payload=b""):
+        """Consumes the next record, which must match the given request."""
+        if self.divergence:
+            raise ReplayDivergence(self.divergence)
+
+        header = self.file.read(_RECORD.size)
+        if len(header) != _RECORD.size:
+            self._diverge(
+                "end of recording, got %s" % _describe(op, address, length, payload)
+            )
+
+        recorded_op, recorded_address, recorded_length = _RECORD.unpack(header)
+        recorded_payload = b""
+        if recorded_op in (OP_WRITE, OP_CALL):
+            recorded_payload = self._read_exactly(recorded_length)
+        elif recorded_op == OP_KE:
+            recorded_payload = self._read_exactly(
+                recorded_length + 4 * recorded_address
+            )
+
+        if (recorded_op, recorded_address, recorded_length, recorded_payload) != (
+            op,
+            address,
+            length,
+            payload,
+        ):
+            self._diverge(
+                "expected %s, got %s"
+                % (
+                    _describe(
+                        recorded_op,
+                        recorded_address,
+                        recorded_length,
+                        recorded_payload,
+                    ),
+                    _describe(op, address, length, payload),
+                )
+            )
+        self.request_count += 1
+
+    def replay_ke(self, name, args):
+        name = name.encode("ascii")
+        self._next(
+            OP_KE, len(args), len(name), name + struct.pack("<%dL" % len(args), *args)
+        )
+        has_result, ret = _KE_RESULT.unpack(self._read_exactly(_KE_RESULT.size))
+        return ret if has_result else None
+
+    def read_u32(self, address):
+        self._next(OP_READ_U32, address, 0)
+        return _U32.unpack(self._read_exactly(_U32.size))[0]
+
+    def read_u32_many(self, addresses):
+        return [self.read_u32(address) for address in addresses]
+
+    def write_u32(self, address, value):
+        self._next(OP_WRITE_U32, address, value)
+
+    def read(self, address, length):
+        self._next(OP_READ, address, length)
+        return self._read_exactly(length)
+
+    def read_many(self, ranges):
+        return [self.read(address, length) for address, length in ranges]
+
+    def write(self, address, data):
+        self._next(OP_WRITE, address, len(data), bytes(data))
+
+    def call(self, address, stack):
+        self._next(OP_CALL, address, len(stack), bytes(stack))
+        return {"eax": _U32.unpack(self._read_exactly(_U32.size))[0]}
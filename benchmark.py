@@ -0,0 +1,1180 @@
+#!/usr/bin/env python3
+
+"""Micro-benchmarks for host-side nv2a-trace code paths."""
+
+# pylint: disable=missing-function-docstring
+# pylint: disable=consider-using-f-string
+
+import argparse
+import atexit
+import builtins
+import contextlib
+import io
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import timeit
+
+from xboxpy import nv2a
+
+from PIL import Image
+
+from AbortFlag import AbortFlag
+import ArtifactWriter
+from CommandFilter import CommandFilter
+import DumpDirtyTracker
+from DumpSampler import DumpSampler
+from HTMLLog import HTMLLog
+from NV2ALog import NV2ALog
+import PipelinedXbox
+from SimulatedXbox import SimulatedXbox
+import NV097State
+import Texture
+import RegisterDiff
+import Trace
+from Xbox import CachedXbox
+import TraceFile
+import XboxHelper
+import XboxRecording
+
+# Physical address at which synthetic pushbuffers are placed.
+PUSH_BUFFER_BASE = 0x00100000
+
+# Offsets of the textures alternated between by synthetic draws.
+TEXTURE_OFFSETS = [0x00C00000, 0x00C40000]
+
+# Maximum number of data words of a single pushbuffer command.
+MAX_METHOD_COUNT = 0x7FF
+
+# Synthetic workloads of the trace benchmark as (draws per frame, vertex words per
+# draw, draws per texture change).
+TRACE_SCENARIOS = {
+    "draws": (50, 36, 10),
+    "inline": (4, 6000, 1),
+}
+
+# Tracer configurations compared by the trace benchmark, mapped to a function
+# returning the Tracer kwargs for a trace of the given number of frames.
+TRACE_CONFIGS = {
+    "default": lambda frames: {},
+    "no-dumps": lambda frames: {
+        "enable_texture_dumping": False,
+        "enable_surface_dumping": False,
+    },
+    "no-dirty-tracking": lambda frames: {"enable_dirty_tracking": False},
+    "sampled": lambda frames: {"dump_sampler": DumpSampler("every:8")},
+    "filtered": lambda frames: {"command_filter": CommandFilter("draw=0")},
+    "last-frame": lambda frames: {
+        "capture_frames": Trace.FrameRanges([(frames - 1, None)])
+    },
+    "host-fifo": lambda frames: {"enable_fifo_stepper": False},
+    "host-fifo-only": lambda frames: {
+        "enable_fifo_stepper": False,
+        "enable_texture_dumping": False,
+        "enable_surface_dumping": False,
+    },
+}
+
+
+def _time(func, repeat):
+    """Returns the best time in seconds of `repeat` calls to `func`."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def benchmark_unswizzle(args):
+    """Compares Texture.unswizzle against xboxpy's nv2a.Unswizzle."""
+    bits_per_pixel = args.bpp
+    bytes_per_pixel = bits_per_pixel // 8
+
+    print(
+        "%-12s %14s %14s %14s %10s"
+        % ("size", "xboxpy (ms)", "cold (ms)", "cached (ms)", "speedup")
+    )
+    for size in args.sizes:
+        pitch = size * bytes_per_pixel
+        data = os.urandom(pitch * size)
+
+        expected = nv2a.Unswizzle(data, bits_per_pixel, (size, size), pitch)
+        actual = Texture.unswizzle(data, bits_per_pixel, (size, size))
+        assert actual.tobytes() == expected, "Unswizzle mismatch at %d" % size
+
+        reference = _time(
+            lambda: nv2a.Unswizzle(data, bits_per_pixel, (size, size), pitch),
+            args.reference_repeat,
+        )
+
+        def cold():
+            # pylint: disable=protected-access
+            Texture._get_unswizzle_table.cache_clear()
+            Texture.unswizzle(data, bits_per_pixel, (size, size))
+
+        cold_time = _time(cold, args.repeat)
+        cached_time = _time(
+            lambda: Texture.unswizzle(data, bits_per_pixel, (size, size)),
+            args.repeat,
+        )
+
+        print(
+            "%-12s %14.3f %14.3f %14.3f %9.0fx"
+            % (
+                "%dx%d" % (size, size),
+                reference * 1000,
+                cold_time * 1000,
+                cached_time * 1000,
+                reference / cached_time,
+            )
+        )
+
+
+def make_push_buffer(command_count, max_method_count=8, seed=0):
+    """Returns a synthetic pushbuffer of increasing NV097 methods."""
+    rng = random.Random(seed)
+    words = []
+    for _ in range(command_count):
+        method_count = rng.randint(1, max_method_count)
+        method = rng.randrange(0x0100, 0x1800, 4)
+        words.append((method_count << 18) | method)
+        words.extend(rng.getrandbits(32) for _ in range(method_count))
+    return struct.pack("<%dL" % len(words), *words)
+
+
+def _make_output_dir():
+    """Returns a temporary directory which is removed after the logs are closed."""
+    path = tempfile.mkdtemp(prefix="nv2a-trace-benchmark-")
+    # atexit handlers run in reverse order, so this runs after the log finalizers.
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+
+def _make_tracer(
+    xbox,
+    output_dir,
+    dma_pull_addr,
+    dma_push_addr,
+    abort_flag=None,
+    register_shadows=True,
+    **kwargs,
+):
+    return Trace.Tracer(
+        dma_pull_addr,
+        dma_push_addr,
+        xbox,
+        XboxHelper.XboxHelper(xbox, enable_register_shadows=register_shadows),
+        abort_flag or AbortFlag(),
+        output_dir=output_dir,
+        **kwargs,
+    )
+
+
+def benchmark_pushbuffer(args):
+    """Measures pushbuffer parsing throughput for various prefetch window sizes."""
+    push_buffer = make_push_buffer(args.commands)
+    dma_push_addr = PUSH_BUFFER_BASE + len(push_buffer)
+
+    print("%-12s %16s %18s" % ("window", "commands / s", "round-trips / cmd"))
+    # Patches are installed once per process, so the same xbox is used throughout.
+    xbox = SimulatedXbox(latency=args.latency)
+    xbox.ram[PUSH_BUFFER_BASE:dma_push_addr] = push_buffer
+    for window_size in args.window_sizes:
+
+        tracer = _make_tracer(
+            xbox,
+            _make_output_dir(),
+            PUSH_BUFFER_BASE,
+            dma_push_addr,
+            push_buffer_window_size=window_size,
+        )
+        xbox.reset_statistics()
+
+        # pylint: disable=protected-access
+        start = time.perf_counter()
+        pull_addr = PUSH_BUFFER_BASE
+        commands = 0
+        while pull_addr != dma_push_addr:
+            _word, _method_info, pull_addr = tracer._parse_push_buffer_word(pull_addr)
+            commands += 1
+        duration = time.perf_counter() - start
+
+        print(
+            "%-12s %16.1f %18.2f"
+            % (
+                "%d" % window_size if window_size else "off",
+                commands / duration,
+                xbox.total_round_trips / commands,
+            )
+        )
+
+
+def _setup_draw_state(xbox, width, height):
+    """Configures an ARGB8888 color surface and a swizzled ARGB8888 texture."""
+    pitch = width * 4
+    xbox.write_mmio(0xFD400858, pitch)
+    xbox.write_mmio(0xFD400840, 0x00800000)
+    xbox.write_mmio(0xFD4019B4, width << 16)
+    xbox.write_mmio(0xFD4019B8, height << 16)
+    xbox.write_mmio(0xFD400804, 0xC << 12)
+    xbox.write_mmio(0xFD400710, 0x1)
+
+    xbox.write_mmio(XboxHelper.PGRAPH_TEXCTL0_0, 1 << 30)
+    xbox.write_mmio(XboxHelper.PGRAPH_TEXOFFSET0, 0x00C00000)
+    xbox.write_mmio(
+        XboxHelper.PGRAPH_TEXFMT0,
+        (0x6 << 8)
+        | ((width.bit_length() - 1) << 20)
+        | ((height.bit_length() - 1) << 24),
+    )
+
+    rng = random.Random(0)
+    for offset, count in [
+        (0x100000, 136 * 4),
+        (0x170000, 192 * 4),
+        (0xCC0000, 192 * 4),
+    ]:
+        for i in range(count):
+            xbox.rdi[offset + i] = rng.getrandbits(32)
+
+
+def _make_draw_methods():
+    """Returns the BEGIN, vertex data and END commands of a triangle."""
+    ret = []
+    for method, data in [
+        (DumpDirtyTracker.NV097_SET_BEGIN_END, [5]),
+        (0x1818, [0] * 12),
+        (DumpDirtyTracker.NV097_SET_BEGIN_END, [0]),
+    ]:
+        ret.append(
+            {
+                "object": 0x97,
+                "method": method,
+                "nonincreasing": True,
+                "data": data,
+            }
+        )
+    return ret
+
+
+def _pack_command(words, method, data, nonincreasing=False):
+    """Appends an NV097 command on subchannel 0, split into several if necessary."""
+    for start in range(0, len(data), MAX_METHOD_COUNT):
+        chunk = data[start : start + MAX_METHOD_COUNT]
+        words.append((0x40000000 if nonincreasing else 0) | (len(chunk) << 18) | method)
+        words.extend(chunk)
+        if not nonincreasing:
+            method += 4 * len(chunk)
+
+
+def make_frame_push_buffer(frames, draws_per_frame, vertex_words, texture_interval):
+    """Returns a synthetic pushbuffer of cleared frames of inline array draws.
+
+    Returns (pushbuffer, number of commands).
+    """
+    rng = random.Random(0)
+    words = []
+    for _ in range(frames):
+        _pack_command(words, DumpDirtyTracker.NV097_CLEAR_SURFACE, [0xF0])
+        for draw in range(draws_per_frame):
+            texture = TEXTURE_OFFSETS[(draw // texture_interval) % len(TEXTURE_OFFSETS)]
+            _pack_command(words, NV097State.NV097_SET_TEXTURE_OFFSET, [texture])
+            _pack_command(words, DumpDirtyTracker.NV097_SET_BEGIN_END, [5])
+            _pack_command(
+                words,
+                0x1818,
+                [rng.getrandbits(32) for _ in range(vertex_words)],
+                nonincreasing=True,
+            )
+            _pack_command(words, DumpDirtyTracker.NV097_SET_BEGIN_END, [0])
+        _pack_command(words, Trace.NV097_FLIP_STALL, [0])
+
+    commands_per_draw = 3 + -(-vertex_words // MAX_METHOD_COUNT)
+    command_count = frames * (2 + draws_per_frame * commands_per_draw)
+    return struct.pack("<%dL" % len(words), *words), command_count
+
+
+def _make_trace_xbox(size, latency):
+    """Returns a simulated Xbox whose END methods modify the color surface."""
+    xbox = SimulatedXbox(latency=latency)
+    _setup_draw_state(xbox, size, size)
+    xbox.write_mmio(XboxHelper.CTX_CACHE1, NV097State.NV097)
+
+    def render(_subchannel, data):
+        if not data:
+            color_offset = xbox.read_mmio(Texture.PGRAPH_COLOR_BASE) + xbox.read_mmio(
+                Texture.PGRAPH_COLOR_OFFSET
+            )
+            xbox.poke_u32(color_offset, xbox.executed_method_count)
+
+    xbox.method_handlers[DumpDirtyTracker.NV097_SET_BEGIN_END] = render
+    for offset in TEXTURE_OFFSETS:
+        xbox.ram[offset : offset + size * size * 4] = os.urandom(size * size * 4)
+    return xbox
+
+
+def _load_trace_scenario(xbox, scenario, frames):
+    """Places the pushbuffer of a scenario in RAM.
+
+    Returns (DMA_PUSH_ADDR of the end of the pushbuffer, number of commands).
+    """
+    push_buffer, command_count = make_frame_push_buffer(
+        frames, *TRACE_SCENARIOS[scenario]
+    )
+    dma_push_addr = PUSH_BUFFER_BASE + len(push_buffer)
+    xbox.ram[PUSH_BUFFER_BASE:dma_push_addr] = push_buffer
+    return dma_push_addr, command_count
+
+
+def _run_trace(
+    xbox, dma_push_addr, frames, config, abort_flag=None, register_shadows=True
+):
+    """Runs a tracer over the pushbuffer until the last frame has been flipped.
+
+    Returns the tracer and the duration of the trace in seconds.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer = _make_tracer(
+            xbox,
+            _make_output_dir(),
+            PUSH_BUFFER_BASE,
+            dma_push_addr,
+            abort_flag,
+            register_shadows=register_shadows,
+            max_frames=frames,
+            **TRACE_CONFIGS[config](frames),
+        )
+
+        start = time.perf_counter()
+        tracer.run()
+        tracer.finish_artifacts()
+        duration = time.perf_counter() - start
+
+    assert tracer.recorded_flip_stall_count == frames, "%s stopped at frame %d" % (
+        config,
+        tracer.recorded_flip_stall_count,
+    )
+    return tracer, duration
+
+
+def benchmark_trace(args):
+    """Traces synthetic pushbuffers end to end on a simulated Xbox.
+
+    Every configuration runs Tracer.run over the same pushbuffer, including FIFO
+    stepping, hooks, dumps and logging, until the last frame has been flipped.
+    Each END writes the draw count into the color surface, so every draw changes
+    its contents. With --read-cache the tracer reads through a CachedXbox.
+    """
+    # Patches are installed once per process, so the same xbox is used throughout.
+    xbox = _make_trace_xbox(args.size, args.latency)
+
+    print(
+        "%-8s %-18s %14s %18s %14s %10s"
+        % (
+            "scenario",
+            "config",
+            "commands / s",
+            "round-trips / cmd",
+            "artifacts / s",
+            "artifacts",
+        )
+    )
+    for scenario in args.scenarios:
+        dma_push_addr, command_count = _load_trace_scenario(xbox, scenario, args.frames)
+
+        for config in args.configs:
+            xbox.reset_pfifo(PUSH_BUFFER_BASE)
+            xbox.executed_method_count = 0
+            xbox.reset_statistics()
+            traced_xbox = CachedXbox(xbox) if args.read_cache else xbox
+            tracer, duration = _run_trace(
+                traced_xbox, dma_push_addr, args.frames, config
+            )
+
+            print(
+                "%-8s %-18s %14.1f %18.2f %14.1f %10d"
+                % (
+                    scenario,
+                    config,
+                    command_count / duration,
+                    xbox.total_round_trips / command_count,
+                    tracer.recorded_artifact_count / duration,
+                    tracer.recorded_artifact_count,
+                )
+            )
+            if args.read_cache:
+                print("  %s" % traced_xbox.summary())
+
+
+def benchmark_replay(args):
+    """Records a trace of a simulated Xbox and replays it offline.
+
+    The replay must make exactly the requests of the recorded trace, so it also
+    checks that the tracer is deterministic.
+    """
+    # Patches are installed once per process, so the same xbox is used throughout.
+    xbox = _make_trace_xbox(args.size, args.latency)
+    dma_push_addr, command_count = _load_trace_scenario(
+        xbox, args.scenario, args.frames
+    )
+
+    # Install the patches, neither the recording nor the replay may do it.
+    xbox.reset_pfifo(PUSH_BUFFER_BASE)
+    _run_trace(xbox, dma_push_addr, args.frames, args.config)
+
+    path = os.path.join(_make_output_dir(), "recording.bin.gz")
+    xbox.reset_pfifo(PUSH_BUFFER_BASE)
+    recording = XboxRecording.RecordingXbox(xbox, path)
+    _tracer, record_time = _run_trace(
+        recording,
+        dma_push_addr,
+        args.frames,
+        args.config,
+        recording.wrap_abort_flag(AbortFlag()),
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        recording.close()
+
+    replay = XboxRecording.ReplayXbox(path)
+    _tracer, replay_time = _run_trace(
+        replay,
+        dma_push_addr,
+        args.frames,
+        args.config,
+        replay.wrap_abort_flag(AbortFlag()),
+    )
+    assert not replay.divergence, replay.divergence
+    assert replay.request_count == recording.request_count, "Replay ended early"
+
+    print(
+        "%d requests, %.1f KiB recording"
+        % (recording.request_count, os.path.getsize(path) / 1024)
+    )
+    print("recording:  %10.1f commands / s" % (command_count / record_time))
+    print("replay:     %10.1f commands / s" % (command_count / replay_time))
+
+
+def benchmark_pipeline(args):
+    """Measures read throughput of the pipelined transport for various depths."""
+    xbox = SimulatedXbox()
+    rng = random.Random(0)
+    for offset in range(0, 0x2000, 4):
+        xbox.write_mmio(0xFD400000 + offset, rng.getrandbits(32))
+    addresses = [0xFD400000 + (i * 4) % 0x2000 for i in range(args.reads)]
+    expected = [xbox.read_mmio(address) for address in addresses]
+
+    server = PipelinedXbox.StandInServer(xbox, latency=args.latency)
+    port = server.start_in_thread()
+
+    print("%-12s %14s %10s" % ("depth", "reads / s", "speedup"))
+    client = PipelinedXbox.PipelinedXbox("127.0.0.1", port, depth=1)
+    start = time.perf_counter()
+    values = [client.read_u32(address) for address in addresses]
+    blocking = time.perf_counter() - start
+    client.close()
+    assert values == expected, "Blocking read mismatch"
+    print("%-12s %14.1f %9.1fx" % ("blocking", args.reads / blocking, 1.0))
+
+    for depth in args.depths:
+        client = PipelinedXbox.PipelinedXbox("127.0.0.1", port, depth=depth)
+        start = time.perf_counter()
+        values = client.read_u32_many(addresses)
+        duration = time.perf_counter() - start
+        client.close()
+        assert values == expected, "Pipelined read mismatch at depth %d" % depth
+        print(
+            "%-12d %14.1f %9.1fx" % (depth, args.reads / duration, blocking / duration)
+        )
+
+    server.stop_thread()
+
+
+def _check_register_status_bits(xbox):
+    """Asserts that toggles keep the status bits the hardware changed in between."""
+    helper = XboxHelper.XboxHelper(xbox)
+    toggles = [
+        (
+            XboxHelper.CACHE_PUSH_STATE,
+            helper.pause_fifo_pusher,
+            helper.resume_fifo_pusher,
+        ),
+        (
+            XboxHelper.CACHE_PULL_STATE,
+            helper.pause_fifo_puller,
+            helper.resume_fifo_puller,
+        ),
+    ]
+    status_bit = 0x00001000
+    for register, pause, resume in toggles:
+        pause()
+        for set_status in (True, False):
+            state = xbox.read_mmio(register)
+            xbox.write_mmio(
+                register, state | status_bit if set_status else state & ~status_bit
+            )
+            resume()
+            pause()
+            assert bool(xbox.read_mmio(register) & status_bit) == set_status, (
+                "Toggling 0x%08X overwrote its status" % register
+            )
+        resume()
+
+
+def benchmark_registers(args):
+    """Counts the round-trips of the host FIFO loop with and without shadowing.
+
+    Without shadow copies every toggle of PGRAPH_STATE, CACHE_PUSH_STATE and
+    CACHE_PULL_STATE reads the register before writing it. Only PGRAPH_STATE is
+    shadowed, the others contain status bits, which is checked at the end.
+    """
+    # Patches are installed once per process, so the same xbox is used throughout.
+    xbox = _make_trace_xbox(args.size, args.latency)
+    dma_push_addr, _command_count = _load_trace_scenario(
+        xbox, args.scenario, args.frames
+    )
+
+    print(
+        "%-10s %12s %12s %12s %14s"
+        % ("shadows", "run_fifo", "read_u32", "write_u32", "round-trips")
+    )
+    for register_shadows in (False, True):
+        xbox.reset_pfifo(PUSH_BUFFER_BASE)
+        xbox.reset_statistics()
+        tracer, _duration = _run_trace(
+            xbox,
+            dma_push_addr,
+            args.frames,
+            args.config,
+            register_shadows=register_shadows,
+        )
+        flushes = max(tracer.flush_count, 1)
+        print(
+            "%-10s %12d %12.2f %12.2f %14.2f"
+            % (
+                "on" if register_shadows else "off",
+                tracer.flush_count,
+                xbox.round_trips["read_u32"] / flushes,
+                xbox.round_trips["write_u32"] / flushes,
+                xbox.total_round_trips / flushes,
+            )
+        )
+
+    _check_register_status_bits(xbox)
+
+
+def benchmark_draw(args):
+    """Measures the round-trips needed to dump the state of a traced draw.
+
+    The first draw includes uploading the patches and verifying the RDI reader.
+    """
+    print("%-12s %18s %18s" % ("mode", "first draw", "subsequent draws"))
+    # Patches are installed once per process, so the same xbox is used throughout.
+    xbox = SimulatedXbox()
+    _setup_draw_state(xbox, args.size, args.size)
+    for mode, batched, shadowed, tracked in [
+        ("mmio", False, False, False),
+        ("batched", True, False, False),
+        ("shadowed", True, True, False),
+        ("tracked", True, True, True),
+    ]:
+        XboxHelper.set_batched_register_reads(batched)
+        tracer = _make_tracer(
+            xbox,
+            _make_output_dir(),
+            PUSH_BUFFER_BASE,
+            PUSH_BUFFER_BASE,
+            enable_texture_dumping=True,
+            enable_surface_dumping=True,
+            enable_rdi=args.rdi,
+            enable_rdi_stub=batched,
+            enable_state_shadow=shadowed,
+            enable_dirty_tracking=tracked,
+            verbose=False,
+        )
+
+        round_trips = []
+        for _ in range(args.draws):
+            xbox.reset_statistics()
+            tracer.dump_textures(None)
+            if tracked:
+                # The same texture is used by every draw, but each one is drawn.
+                for method_info in _make_draw_methods():
+                    tracer.dirty_tracker.record_method(method_info)
+            tracer.dump_surfaces(None)
+            tracer.command_count += 1
+            round_trips.append(xbox.total_round_trips)
+
+        print(
+            "%-12s %18d %18.1f"
+            % (
+                mode,
+                round_trips[0],
+                sum(round_trips[1:]) / max(1, len(round_trips) - 1),
+            )
+        )
+
+    XboxHelper.set_batched_register_reads(True)
+
+
+def _make_method_stream(method_count, seed=0):
+    """Returns a list of (method_info, data) tuples as logged by the tracer."""
+    rng = random.Random(seed)
+    ret = []
+    for i in range(method_count):
+        method_info = {
+            "address": PUSH_BUFFER_BASE + i * 8,
+            "object": 0x97,
+            "method": rng.randrange(0x0100, 0x1800, 4),
+            "nonincreasing": False,
+            "subchannel": 0,
+            "method_count": 1,
+            "data": [rng.getrandbits(32)],
+        }
+        ret.append((method_info, method_info["data"][0]))
+    return ret
+
+
+def _log_methods(html_log, nv2a_log, stream):
+    for index, (method_info, data) in enumerate(stream):
+        nv2a_log.log_method(method_info, data, None, None)
+        html_log.log(["%d" % index, "%s" % method_info])
+
+
+class _ReopeningLog:
+    """Reproduces the previous loggers, which reopened the file for every row."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, text):
+        with open(self.path, "a", encoding="utf8") as logfile:
+            logfile.write(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def closed(self):
+        return False
+
+
+def _read_syscall_writes():
+    """Returns the number of write syscalls issued by this process, if available."""
+    try:
+        with open("/proc/self/io", encoding="utf8") as io_stats:
+            for line in io_stats:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class _OpenCounter:
+    """Counts calls to `open` while active."""
+
+    def __init__(self):
+        self.count = 0
+        self._open = builtins.open
+
+    def _counting_open(self, *args, **kwargs):
+        self.count += 1
+        return self._open(*args, **kwargs)
+
+    def __enter__(self):
+        builtins.open = self._counting_open
+        return self
+
+    def __exit__(self, *_args):
+        builtins.open = self._open
+
+
+def benchmark_logs(args):
+    """Compares the buffered loggers against reopening the log for every row."""
+    stream = _make_method_stream(args.methods)
+    output_dir = _make_output_dir()
+
+    print("%-12s %12s %14s %14s" % ("loggers", "time (s)", "write calls", "open calls"))
+    results = {}
+    for name in ["reopening", "buffered"]:
+        html_path = os.path.join(output_dir, "%s.html" % name)
+        nv2a_path = os.path.join(output_dir, "%s.txt" % name)
+
+        writes = _read_syscall_writes()
+        with _OpenCounter() as opens:
+            start = time.perf_counter()
+
+            html_log = HTMLLog(html_path)
+            nv2a_log = NV2ALog(nv2a_path)
+            if name == "reopening":
+                for log in [html_log, nv2a_log]:
+                    log.logfile.close()
+                    log.logfile = _ReopeningLog(log.path)
+
+            _log_methods(html_log, nv2a_log, stream)
+            html_log.flush()
+            nv2a_log.flush()
+
+            duration = time.perf_counter() - start
+        if writes is not None:
+            writes = _read_syscall_writes() - writes
+
+        print(
+            "%-12s %12.2f %14s %14d"
+            % (
+                name,
+                duration,
+                "%d" % writes if writes is not None else "n/a",
+                opens.count,
+            )
+        )
+
+        results[name] = []
+        for path in [html_path, nv2a_path]:
+            with open(path, "rb") as log_file:
+                results[name].append(log_file.read())
+
+    assert results["reopening"] == results["buffered"], "Log contents differ"
+
+
+def benchmark_artifacts(args):
+    """Measures how long saving surface images blocks the tracing thread."""
+    img = Image.frombytes(
+        "RGBA", (args.width, args.height), os.urandom(args.width * args.height * 4)
+    )
+    output_dir = _make_output_dir()
+
+    print("%-12s %16s %16s" % ("workers", "blocking (ms)", "total (ms)"))
+    for workers in args.workers:
+        writer = ArtifactWriter.ArtifactWriter(workers)
+        start = time.perf_counter()
+        for i in range(args.images):
+            writer.save_image(
+                img,
+                os.path.join(output_dir, "%d_%d.png" % (workers, i)),
+                os.path.join(output_dir, "%d_%d-a.png" % (workers, i)),
+            )
+        blocking = time.perf_counter() - start
+        writer.close()
+        total = time.perf_counter() - start
+
+        print(
+            "%-12d %16.1f %16.1f"
+            % (workers, blocking * 1000 / args.images, total * 1000 / args.images)
+        )
+
+
+def benchmark_trace_file(args):
+    """Measures writing a trace file and seeking within it."""
+    stream = _make_method_stream(args.commands)
+    path = os.path.join(_make_output_dir(), Trace.TRACE_FILE_NAME)
+
+    start = time.perf_counter()
+    writer = TraceFile.TraceWriter(path)
+    flips = 0
+    for index, (method_info, _data) in enumerate(stream):
+        writer.write_command(
+            index,
+            method_info["address"],
+            method_info["object"],
+            method_info["method"],
+            method_info["subchannel"],
+            method_info["nonincreasing"],
+            method_info["data"],
+        )
+        if (index + 1) % args.frame_commands == 0:
+            flips += 1
+            writer.write_flip(flips, index + 1)
+    writer.close()
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with TraceFile.TraceReader(path) as reader:
+        last_frame = reader.frame_count - 1
+        first = next(reader.frame_records(last_frame // 2))
+        seek_time = time.perf_counter() - start
+        assert first.command_index == (last_frame // 2) * args.frame_commands
+
+        start = time.perf_counter()
+        record_count = sum(1 for _ in reader.records())
+        read_time = time.perf_counter() - start
+
+    print(
+        "%d commands in %d frames, %.1f MiB"
+        % (args.commands, flips, os.path.getsize(path) / (1024 * 1024))
+    )
+    print("write:            %10.0f commands / s" % (args.commands / write_time))
+    print("open + seek:      %10.2f ms" % (seek_time * 1000))
+    print("iterate:          %10.0f records / s" % (record_count / read_time))
+
+
+def benchmark_snapshots(args):
+    """Compares delta-encoded snapshots against storing every snapshot in full."""
+    rng = random.Random(0)
+    pgraph = bytearray(rng.getrandbits(8) for _ in range(0x2000))
+    path = os.path.join(_make_output_dir(), Trace.TRACE_FILE_NAME)
+
+    start = time.perf_counter()
+    writer = TraceFile.TraceWriter(path)
+    for command_index in range(args.dumps):
+        for _ in range(args.changes):
+            offset = rng.randrange(0, len(pgraph), 4)
+            pgraph[offset : offset + 4] = struct.pack("<L", rng.getrandbits(32))
+        writer.write_snapshot(command_index, TraceFile.SNAPSHOT_PGRAPH, pgraph)
+    writer.close()
+    write_time = time.perf_counter() - start
+
+    with TraceFile.TraceReader(path) as reader:
+        start = time.perf_counter()
+        reconstructed = reader.snapshot_at(TraceFile.SNAPSHOT_PGRAPH, args.dumps)
+        lookup_time = time.perf_counter() - start
+    assert reconstructed == pgraph, "Reconstructed snapshot differs"
+
+    full_size = args.dumps * len(pgraph)
+    delta_size = os.path.getsize(path)
+    print(
+        "%d dumps of %d bytes with %d changed words each"
+        % (args.dumps, len(pgraph), args.changes)
+    )
+    print("full:             %10.1f MiB" % (full_size / (1024 * 1024)))
+    print(
+        "delta-encoded:    %10.1f MiB (%.1fx smaller)"
+        % (delta_size / (1024 * 1024), full_size / delta_size)
+    )
+    print("write:            %10.0f snapshots / s" % (args.dumps / write_time))
+    print("reconstruct last: %10.2f ms" % (lookup_time * 1000))
+
+
+def _reference_pgraph_diff(before, after):
+    """Returns the changes found by the previous per-word comparison."""
+    ret = []
+    for i in range(len(before) // 4):
+        off = RegisterDiff.PGRAPH_BASE + i * 4
+        if off in RegisterDiff.PGRAPH_VOLATILE_REGISTERS:
+            continue
+        word = struct.unpack_from("<L", before, i * 4)[0]
+        new_word = struct.unpack_from("<L", after, i * 4)[0]
+        if new_word != word:
+            ret.append((off, word, new_word))
+    return ret
+
+
+def benchmark_diff(args):
+    """Compares RegisterDiff against the previous per-word PGRAPH comparison."""
+    rng = random.Random(0)
+    before = bytes(rng.getrandbits(8) for _ in range(RegisterDiff.PGRAPH_SIZE))
+    after = bytearray(before)
+    for _ in range(args.changes):
+        offset = rng.randrange(0, len(after), 4)
+        after[offset : offset + 4] = struct.pack("<L", rng.getrandbits(32))
+    after = bytes(after)
+
+    diff = RegisterDiff.RegisterDiff(
+        RegisterDiff.PGRAPH_BASE,
+        RegisterDiff.PGRAPH_SIZE,
+        RegisterDiff.PGRAPH_VOLATILE_REGISTERS,
+    )
+    expected = _reference_pgraph_diff(before, after)
+    actual = list(zip(*(array.tolist() for array in diff.compare(before, after))))
+    assert actual == expected, "RegisterDiff mismatch"
+
+    reference = _time(lambda: _reference_pgraph_diff(before, after), args.repeat)
+    vectorized = _time(lambda: diff.compare(before, after), args.repeat)
+    print("%d changed registers" % len(expected))
+    print("per-word:   %10.3f ms" % (reference * 1000))
+    print(
+        "RegisterDiff: %8.3f ms (%.0fx)" % (vectorized * 1000, reference / vectorized)
+    )
+
+
+def main(args):
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+
+    def _parse_args():
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(required=True)
+
+        unswizzle = subparsers.add_parser(
+            "unswizzle", help="Compare cached unswizzling against xboxpy."
+        )
+        unswizzle.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[64, 128, 256, 512],
+            help="Square texture sizes to benchmark.",
+        )
+        unswizzle.add_argument(
+            "--bpp",
+            type=int,
+            default=32,
+            choices=[8, 16, 32],
+            help="Bits per pixel.",
+        )
+        unswizzle.add_argument(
+            "--repeat", type=int, default=20, help="Number of timed runs."
+        )
+        unswizzle.add_argument(
+            "--reference-repeat",
+            type=int,
+            default=1,
+            help="Number of timed runs of the (slow) xboxpy implementation.",
+        )
+        unswizzle.set_defaults(func=benchmark_unswizzle)
+
+        pushbuffer = subparsers.add_parser(
+            "pushbuffer",
+            help="Measure pushbuffer parsing against a simulated Xbox.",
+        )
+        pushbuffer.add_argument(
+            "--commands",
+            type=int,
+            default=5000,
+            help="Number of commands in the synthetic pushbuffer.",
+        )
+        pushbuffer.add_argument(
+            "--window-sizes",
+            nargs="+",
+            type=int,
+            default=[0, 0x1000, 0x4000, 0x10000],
+            help="Prefetch window sizes to compare, 0 disables prefetching.",
+        )
+        pushbuffer.add_argument(
+            "--latency",
+            type=float,
+            default=0.0002,
+            help="Simulated round-trip latency in seconds.",
+        )
+        pushbuffer.set_defaults(func=benchmark_pushbuffer)
+
+        draw = subparsers.add_parser(
+            "draw",
+            help="Count the round-trips needed to dump a draw on a simulated Xbox.",
+        )
+        draw.add_argument(
+            "--draws", type=int, default=10, help="Number of draws to dump."
+        )
+        draw.add_argument(
+            "--size",
+            type=int,
+            default=64,
+            help="Width and height of the surface and texture.",
+        )
+        draw.add_argument(
+            "--rdi", action="store_true", help="Include the PGRAPH RDI dump."
+        )
+        draw.set_defaults(func=benchmark_draw)
+
+        trace = subparsers.add_parser(
+            "trace",
+            help="Trace synthetic pushbuffers end to end on a simulated Xbox.",
+        )
+        trace.add_argument(
+            "--frames", type=int, default=3, help="Number of frames to trace."
+        )
+        trace.add_argument(
+            "--scenarios",
+            nargs="+",
+            choices=sorted(TRACE_SCENARIOS),
+            default=sorted(TRACE_SCENARIOS),
+            help="Synthetic workloads to trace.",
+        )
+        trace.add_argument(
+            "--configs",
+            nargs="+",
+            choices=list(TRACE_CONFIGS),
+            default=list(TRACE_CONFIGS),
+            help="Tracer configurations to compare.",
+        )
+        trace.add_argument(
+            "--size",
+            type=int,
+            default=64,
+            help="Width and height of the surface and textures.",
+        )
+        trace.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Simulated round-trip latency in seconds.",
+        )
+        trace.add_argument(
+            "--read-cache",
+            action="store_true",
+            help="Read through a page cache and print its statistics.",
+        )
+        trace.set_defaults(func=benchmark_trace)
+
+        replay = subparsers.add_parser(
+            "replay",
+            help="Record a trace of a simulated Xbox and replay it offline.",
+        )
+        replay.add_argument(
+            "--frames", type=int, default=3, help="Number of frames to trace."
+        )
+        replay.add_argument(
+            "--scenario",
+            choices=sorted(TRACE_SCENARIOS),
+            default="draws",
+            help="Synthetic workload to trace.",
+        )
+        replay.add_argument(
+            "--config",
+            choices=list(TRACE_CONFIGS),
+            default="default",
+            help="Tracer configuration.",
+        )
+        replay.add_argument(
+            "--size",
+            type=int,
+            default=64,
+            help="Width and height of the surface and textures.",
+        )
+        replay.add_argument(
+            "--latency",
+            type=float,
+            default=0.0002,
+            help="Simulated round-trip latency in seconds while recording.",
+        )
+        replay.set_defaults(func=benchmark_replay)
+
+        pipeline = subparsers.add_parser(
+            "pipeline",
+            help="Measure pipelined reads from a stand-in server with injected latency.",
+        )
+        pipeline.add_argument(
+            "--reads", type=int, default=1000, help="Number of registers to read."
+        )
+        pipeline.add_argument(
+            "--depths",
+            nargs="+",
+            type=int,
+            default=[1, 4, 16, 64, 256],
+            help="Pipeline depths to compare.",
+        )
+        pipeline.add_argument(
+            "--latency",
+            type=float,
+            default=0.001,
+            help="Round-trip latency injected by the server in seconds.",
+        )
+        pipeline.set_defaults(func=benchmark_pipeline)
+
+        registers = subparsers.add_parser(
+            "registers",
+            help="Count the round-trips of the host FIFO loop with and without register shadowing.",
+        )
+        registers.add_argument(
+            "--frames", type=int, default=3, help="Number of frames to trace."
+        )
+        registers.add_argument(
+            "--scenario",
+            choices=sorted(TRACE_SCENARIOS),
+            default="draws",
+            help="Synthetic workload to trace.",
+        )
+        registers.add_argument(
+            "--config",
+            choices=list(TRACE_CONFIGS),
+            default="host-fifo-only",
+            help="Tracer configuration.",
+        )
+        registers.add_argument(
+            "--size",
+            type=int,
+            default=64,
+            help="Width and height of the surface and textures.",
+        )
+        registers.add_argument(
+            "--latency",
+            type=float,
+            default=0.0,
+            help="Simulated round-trip latency in seconds.",
+        )
+        registers.set_defaults(func=benchmark_registers)
+
+        logs = subparsers.add_parser(
+            "logs", help="Compare the buffered loggers against reopening the log."
+        )
+        logs.add_argument(
+            "--methods",
+            type=int,
+            default=1000000,
+            help="Number of methods in the synthetic stream.",
+        )
+        logs.set_defaults(func=benchmark_logs)
+
+        artifacts = subparsers.add_parser(
+            "artifacts",
+            help="Measure how long image saving blocks the tracer.",
+        )
+        artifacts.add_argument(
+            "--images", type=int, default=20, help="Number of images to save."
+        )
+        artifacts.add_argument("--width", type=int, default=640, help="Image width.")
+        artifacts.add_argument("--height", type=int, default=480, help="Image height.")
+        artifacts.add_argument(
+            "--workers",
+            nargs="+",
+            type=int,
+            default=[0, 1, 2, 4],
+            help="Worker counts to compare, 0 saves synchronously.",
+        )
+        artifacts.set_defaults(func=benchmark_artifacts)
+
+        trace_file = subparsers.add_parser(
+            "tracefile", help="Measure writing and seeking within a trace file."
+        )
+        trace_file.add_argument(
+            "--commands",
+            type=int,
+            default=1000000,
+            help="Number of commands in the synthetic trace.",
+        )
+        trace_file.add_argument(
+            "--frame-commands",
+            type=int,
+            default=1000,
+            help="Number of commands per frame.",
+        )
+        trace_file.set_defaults(func=benchmark_trace_file)
+
+        snapshots = subparsers.add_parser(
+            "snapshots",
+            help="Compare delta-encoded snapshots against full copies.",
+        )
+        snapshots.add_argument(
+            "--dumps", type=int, default=5000, help="Number of PGRAPH snapshots."
+        )
+        snapshots.add_argument(
+            "--changes",
+            type=int,
+            default=8,
+            help="Number of words modified between snapshots.",
+        )
+        snapshots.set_defaults(func=benchmark_snapshots)
+
+        diff = subparsers.add_parser(
+            "diff", help="Compare RegisterDiff against per-word PGRAPH comparison."
+        )
+        diff.add_argument(
+            "--changes",
+            type=int,
+            default=32,
+            help="Number of words modified between the dumps.",
+        )
+        diff.add_argument(
+            "--repeat", type=int, default=20, help="Number of timed runs."
+        )
+        diff.set_defaults(func=benchmark_diff)
+
+        return parser.parse_args()
+
+    sys.exit(main(_parse_args()))
@@ -0,0 +1,64 @@
+; Construct binary using `nasm checksum_memory.asm`
+
+bits 32
+
+; Computes the CRC32 (as implemented by zlib.crc32) of `length` bytes at `address`.
+; Arguments: address, length
+
+checksum_memory:
+
+push ebx
+push esi
+push edi
+push ebp
+
+; Build the lookup table on the stack
+sub esp, 0x400
+xor ecx, ecx
+
+build_table:
+mov eax, ecx
+mov edx, 8
+
+build_entry:
+shr eax, 1
+jnc build_entry_next
+xor eax, 0xEDB88320
+
+build_entry_next:
+dec edx
+jnz build_entry
+
+mov dword [esp+ecx*4], eax
+inc ecx
+cmp ecx, 0x100
+jne build_table
+
+; address
+mov esi, dword [esp+0x414]
+
+; length
+mov ecx, dword [esp+0x418]
+
+mov eax, 0xFFFFFFFF
+test ecx, ecx
+jz done
+
+checksum_byte:
+movzx ebx, byte [esi]
+xor bl, al
+shr eax, 8
+xor eax, dword [esp+ebx*4]
+inc esi
+dec ecx
+jnz checksum_byte
+
+done:
+not eax
+
+add esp, 0x400
+pop ebp
+pop edi
+pop esi
+pop ebx
+ret 0x8
@@ -8,14 +8,24 @@
 # pylint: disable=too-many-locals
 
 import argparse
+import atexit
 import os
 import signal
 import sys
 import time
 
 from AbortFlag import AbortFlag
+import ArtifactWriter
+import CommandFilter
+import DumpDirtyTracker
+import DumpSampler
+import GraphicsClassShadow
+import PipelinedXbox
+from Xbox import CachedXbox
+from Xbox import InstrumentedXbox
 from Xbox import Xbox
 import XboxHelper
+import XboxRecording
 import Trace
 
 # pylint: disable=invalid-name
@@ -23,6 +33,9 @@ import Trace
 _enable_experimental_disable_z_compression_and_tiling = False
 # pylint: enable=invalid-name
 
+# Name of the profile report written to the output directory with --profile.
+PROFILE_REPORT_NAME = "profile.json"
+
 
 def _wait_for_stable_push_buffer_state(
     xbox_helper: XboxHelper.XboxHelper, abort_flag: AbortFlag, verbose: bool = False
@@ -88,6 +101,7 @@ def _wait_for_stable_push_buffer_state(
                 "  Pushbuffer not empty - PULL (0x%08X) != PUSH (0x%08X)"
                 % (dma_pull_addr_check, dma_push_addr_check)
             )
+            xbox_helper.resync_register_shadows()
             continue
 
         # Ensure that we are at the correct offset
@@ -96,6 +110,7 @@ def _wait_for_stable_push_buffer_state(
                 "Oops PUT was modified; got 0x%08X but expected 0x%08X!"
                 % (dma_push_addr_check, dma_push_addr_target)
             )
+            xbox_helper.resync_register_shadows()
             continue
 
         break
@@ -156,15 +171,35 @@ def main(args):
 
     os.makedirs(args.out, exist_ok=True)
 
-    xbox = Xbox()
-    xbox_helper = XboxHelper.XboxHelper(xbox)
+    signal_abort_flag = AbortFlag()
+    abort_flag = signal_abort_flag
 
-    abort_flag = AbortFlag()
+    if args.replay:
+        xbox = XboxRecording.ReplayXbox(args.replay)
+        abort_flag = xbox.wrap_abort_flag(abort_flag)
+    else:
+        if args.stand_in:
+            xbox = PipelinedXbox.PipelinedXbox(*args.stand_in)
+        else:
+            xbox = Xbox()
+        if args.record:
+            xbox = XboxRecording.RecordingXbox(xbox, args.record)
+            abort_flag = xbox.wrap_abort_flag(abort_flag)
+    replay_xbox = xbox if args.replay else None
+    if args.profile:
+        xbox = InstrumentedXbox(xbox)
+        atexit.register(xbox.write_report, os.path.join(args.out, PROFILE_REPORT_NAME))
+    read_cache = None
+    if args.read_cache:
+        xbox = read_cache = CachedXbox(xbox)
+    xbox_helper = XboxHelper.XboxHelper(
+        xbox, enable_register_shadows=not args.no_register_shadows
+    )
 
     def signal_handler(_signal, _frame):
-        if not abort_flag.should_abort:
+        if not signal_abort_flag.should_abort:
             print("Got first SIGINT! Aborting..")
-            abort_flag.abort()
+            signal_abort_flag.abort()
         else:
             print("Got second SIGINT! Forcing exit")
             sys.exit(0)
@@ -196,6 +231,11 @@ def main(args):
     enable_surface_dumping = pixel_dumping and not args.no_surface
     enable_raw_pixel_dumping = not args.no_raw_pixel
     enable_rdi = pixel_dumping and not args.no_rdi
+    enable_dump_cache = not args.no_dump_cache
+
+    capture_frames = args.frames
+    if args.start_flip:
+        capture_frames = Trace.FrameRanges([(args.start_flip, None)])
 
     if args.alpha_mode == "both":
         alpha_mode = Trace.Tracer.ALPHA_MODE_BOTH
@@ -216,17 +256,42 @@ def main(args):
         enable_surface_dumping=enable_surface_dumping,
         enable_raw_pixel_dumping=enable_raw_pixel_dumping,
         enable_rdi=enable_rdi,
+        enable_rdi_stub=not args.no_rdi_stub,
+        enable_dump_cache=enable_dump_cache,
+        push_buffer_window_size=args.pb_window_size,
+        max_flush_distance=args.max_flush_distance,
+        enable_fifo_stepper=not args.no_fifo_stepper,
+        class_validation_interval=args.class_validation_interval,
+        background_log_flush=args.background_log_flush,
+        artifact_workers=args.artifact_workers,
+        enable_trace_file=not args.no_trace_file,
+        export_snapshot_files=args.export_snapshot_files,
+        enable_state_shadow=not args.no_state_shadow,
+        verify_state_shadow=args.verify_state_shadow,
+        enable_dirty_tracking=not args.no_dirty_tracking,
+        texture_content_policy=args.texture_content_policy,
         verbose=args.verbose,
         max_frames=args.max_flip,
+        capture_frames=capture_frames,
+        command_filter=args.filter,
+        dump_sampler=args.sample_dumps,
     )
 
+    for method in args.diff_pgraph_method or []:
+        trace.diff_pgraph_around(0x97, method)
+
     # Dump the initial state
-    trace.command_count = -1
-    trace.dump_surfaces(xbox, None)
-    trace.command_count = 0
+    if trace.capturing:
+        trace.command_count = -1
+        trace.dump_surfaces(xbox, None)
+        trace.command_count = 0
 
     trace.run()
 
+    if replay_xbox and replay_xbox.divergence:
+        print(replay_xbox.divergence)
+        return 1
+
     # Recover the real address
     xbox.write_u32(XboxHelper.DMA_PUSH_ADDR, trace.real_dma_push_addr)
 
@@ -235,14 +300,53 @@ def main(args):
     # We can continue the cache updates now.
     xbox_helper.resume_fifo_pusher()
 
+    # The Xbox is running again, so any remaining encoding no longer stalls it.
+    trace.finish_artifacts()
+    trace.close_trace_file()
+
     # Finish measuring time
     end_time = time.monotonic()
     duration = end_time - begin_time
 
     command_count = trace.recorded_command_count
+    flip_stall_count = trace.recorded_flip_stall_count
+    fast_forward_count = trace.fast_forwarded_command_count
+    fast_forward_duration = trace.fast_forward_duration
     print(
         "Recorded %d flip stalls and %d PB commands (%.2f commands / second)"
-        % (trace.recorded_flip_stall_count, command_count, command_count / duration)
+        % (
+            flip_stall_count,
+            command_count,
+            command_count / max(duration - fast_forward_duration, 1e-6),
+        )
+    )
+    if args.filter:
+        print(
+            "Skipped %d PB commands not matching the filter"
+            % trace.recorded_filtered_command_count
+        )
+    if args.sample_dumps:
+        print(
+            "Skipped %d dumps with sampling policy %s"
+            % (trace.skipped_dump_count, args.sample_dumps)
+        )
+    if read_cache:
+        print(read_cache.summary())
+    if fast_forward_count:
+        print(
+            "Fast-forwarded %d PB commands in %.2f seconds (%.2f commands / second)"
+            % (
+                fast_forward_count,
+                fast_forward_duration,
+                fast_forward_count / max(fast_forward_duration, 1e-6),
+            )
+        )
+    print(
+        "Ran the FIFO %d times (%.2f flushes / frame)"
+        % (
+            trace.recorded_flush_count,
+            trace.recorded_flush_count / max(flip_stall_count, 1),
+        )
     )
 
 
@@ -285,6 +389,131 @@ if __name__ == "__main__":
             action="store_true",
         )
 
+        parser.add_argument(
+            "--no-rdi-stub",
+            help="Read RDI one word at a time from the host instead of using an on-target reader.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--no-dump-cache",
+            help="Always transfer graphical resources, even if their contents are unchanged since the previous dump.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--pb-window-size",
+            metavar="bytes",
+            default=Trace.DEFAULT_PUSH_BUFFER_WINDOW_SIZE,
+            type=int,
+            help="Number of pushbuffer bytes to prefetch with a single read, 0 disables prefetching.",
+        )
+
+        parser.add_argument(
+            "--max-flush-distance",
+            metavar="bytes",
+            default=Trace.DEFAULT_MAX_FLUSH_DISTANCE,
+            type=int,
+            help="Maximum number of unhooked command bytes to queue before running the FIFO. The distance adapts between %d and this value depending on whether the game modifies PUT."
+            % Trace.MIN_FLUSH_DISTANCE,
+        )
+
+        parser.add_argument(
+            "--class-validation-interval",
+            metavar="commands",
+            default=GraphicsClassShadow.DEFAULT_VALIDATION_INTERVAL,
+            type=int,
+            help="Number of commands after which the locally tracked graphics classes are compared against PGRAPH, 0 disables the comparison.",
+        )
+
+        parser.add_argument(
+            "--background-log-flush",
+            help="Flush the buffered logs from a background thread so that they stay current while the trace is stalled.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--artifact-workers",
+            metavar="threads",
+            default=ArtifactWriter.DEFAULT_WORKERS,
+            type=int,
+            help="Number of threads encoding images and writing dumps in the background, 0 writes them while the Xbox is halted.",
+        )
+
+        parser.add_argument(
+            "--no-trace-file",
+            help="Disable writing the binary trace file (%s)." % Trace.TRACE_FILE_NAME,
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--export-snapshot-files",
+            help="Also write the PGRAPH, PFB and RDI snapshots stored in the trace file as per-command .bin files. They are always written if the trace file is disabled.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--no-state-shadow",
+            help="Read the surface and texture state from PGRAPH at every dump instead of tracking it from the NV097 methods.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--verify-state-shadow",
+            help="Compare the tracked surface and texture state against PGRAPH at every dump and log any mismatch.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--no-dirty-tracking",
+            help="Dump the textures at every BEGIN and the color surface at every END, even if their bindings are unchanged and nothing was drawn. With --no-dump-cache, textures modified by the CPU while their binding is unchanged are only dumped with this option.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--texture-content-policy",
+            default=DumpDirtyTracker.DEFAULT_CONTENT_POLICY,
+            choices=DumpDirtyTracker.CONTENT_POLICIES,
+            help=(
+                "Define when a texture stage with an unchanged binding is dumped again.\n"
+                "  binding: Never\n"
+                "  render-target: When its texture has been drawn to\n"
+            ),
+        )
+
+        parser.add_argument(
+            "--diff-pgraph-method",
+            metavar="method",
+            type=lambda value: int(value, 0),
+            action="append",
+            help="Log the PGRAPH registers modified by every call of the given NV097 method (e.g., 0x17FC). May be given multiple times.",
+        )
+
+        parser.add_argument(
+            "--no-fifo-stepper",
+            help="Run the FIFO from the host instead of using the on-target stepper.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--no-register-shadows",
+            help="Read PGRAPH_FIFO from the Xbox before every toggle instead of using a shadow copy.",
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--profile",
+            help="Record the count, size and latency of every Xbox operation per calling site, print a summary at every flip and write %s to the output directory at exit."
+            % PROFILE_REPORT_NAME,
+            action="store_true",
+        )
+
+        parser.add_argument(
+            "--read-cache",
+            help="Cache the memory read from the Xbox in 4 KiB pages until it is written, the FIFO runs or a patch is called, and print the hit statistics at exit.",
+            action="store_true",
+        )
+
         parser.add_argument(
             "--alpha-mode",
             default="drop",
@@ -312,6 +541,95 @@ if __name__ == "__main__":
             help="Exit tracing after the given number of frame swaps.",
         )
 
-        return parser.parse_args()
+        def _frame_ranges(value):
+            try:
+                return Trace.parse_frame_ranges(value)
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(str(err)) from err
+
+        def _command_filter(value):
+            try:
+                return CommandFilter.CommandFilter(value)
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(str(err)) from err
+
+        parser.add_argument(
+            "--filter",
+            metavar="expression",
+            type=_command_filter,
+            help=(
+                'Only log and dump the commands matching all of the given space separated key=ranges terms, e.g. "class=0x97 method=0x1800-0x1A00,0x17FC draw=10-20".\n'
+                "  method: Any method written by the command\n"
+                "  class: Graphics class of the command\n"
+                "  draw: Index of the draw within the frame\n"
+                "  address: Address of the command in the pushbuffer\n"
+            ),
+        )
+
+        def _dump_sampler(value):
+            try:
+                return DumpSampler.DumpSampler(value)
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(str(err)) from err
+
+        parser.add_argument(
+            "--sample-dumps",
+            metavar="policy",
+            type=_dump_sampler,
+            help=(
+                "Only dump some of the draws, clears and semaphore releases. All commands are still logged.\n"
+                "  every:N: Dump every Nth one\n"
+                "  frame: Dump the first one of each frame and the surface at the flip\n"
+                "  rate:X: Dump at most X per second\n"
+            ),
+        )
+
+        recording = parser.add_mutually_exclusive_group()
+        recording.add_argument(
+            "--record",
+            metavar="path",
+            help="Record every request made to the Xbox and its response to the given file, so the capture can be replayed with --replay.",
+        )
+        recording.add_argument(
+            "--replay",
+            metavar="path",
+            help="Trace offline by serving the requests from a file written by --record instead of an Xbox. The other options must match the recorded capture, the first differing request is reported.",
+        )
+
+        def _server_address(value):
+            host, _separator, port = value.rpartition(":")
+            try:
+                return host or "127.0.0.1", int(port)
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(
+                    "Invalid server address %s, expected host:port" % value
+                ) from err
+
+        parser.add_argument(
+            "--stand-in",
+            metavar="host:port",
+            type=_server_address,
+            help="Connect to a debug server speaking the pipelined protocol of PipelinedXbox.py (e.g., its stand-in server) instead of using xboxpy.",
+        )
+
+        capture_window = parser.add_mutually_exclusive_group()
+        capture_window.add_argument(
+            "--start-flip",
+            metavar="frame",
+            default=0,
+            type=int,
+            help="Fast-forward without logging or dumping until the given number of frame swaps, then trace.",
+        )
+        capture_window.add_argument(
+            "--frames",
+            metavar="ranges",
+            type=_frame_ranges,
+            help="Only trace the given frames (e.g., 100-110,500-) and fast-forward without logging or dumping in between. Tracing stops after the last range.",
+        )
+
+        args = parser.parse_args()
+        if args.stand_in and args.replay:
+            parser.error("--stand-in and --replay are mutually exclusive")
+        return args
 
     sys.exit(main(_parse_args()))
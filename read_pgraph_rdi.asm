@@ -0,0 +1,41 @@
+; Construct binary using `nasm read_pgraph_rdi.asm`
+
+bits 32
+
+%define NV10_PGRAPH_RDI_INDEX       0xFD400750
+%define NV10_PGRAPH_RDI_DATA        0xFD400754
+
+; Sets the RDI index to `offset` and reads `count` words from the RDI data register
+; into `buffer`, exactly as a sequence of individual DATA reads would.
+; Arguments: offset, count, buffer
+
+read_pgraph_rdi:
+
+push edi
+
+; offset
+mov eax, dword [esp+8]
+
+; count
+mov ecx, dword [esp+12]
+
+; buffer
+mov edi, dword [esp+16]
+
+mov dword [NV10_PGRAPH_RDI_INDEX], eax
+
+mov eax, ecx
+test ecx, ecx
+jz done
+
+read_next:
+mov edx, dword [NV10_PGRAPH_RDI_DATA]
+mov dword [edi], edx
+add edi, 4
+dec ecx
+jnz read_next
+
+done:
+
+pop edi
+ret 0xC
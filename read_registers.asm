@@ -0,0 +1,40 @@
+; Construct binary using `nasm read_registers.asm`
+
+bits 32
+
+; Reads `count` 32-bit values from the addresses in `address_list` into `values`, in
+; order.
+; Arguments: address_list, count, values
+
+read_registers:
+
+push esi
+push edi
+
+; address_list
+mov esi, dword [esp+12]
+
+; count
+mov ecx, dword [esp+16]
+
+; values
+mov edi, dword [esp+20]
+
+mov eax, ecx
+test ecx, ecx
+jz done
+
+read_next:
+mov edx, dword [esi]
+mov edx, dword [edx]
+mov dword [edi], edx
+add esi, 4
+add edi, 4
+dec ecx
+jnz read_next
+
+done:
+
+pop edi
+pop esi
+ret 0xC
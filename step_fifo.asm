@@ -0,0 +1,154 @@
+; Construct binary using `nasm step_fifo.asm`
+
+bits 32
+
+%define CACHE_PUSH_ADDR             0xFD003210
+%define CACHE_PUSH_STATE            0xFD003220
+%define DMA_PUSH_ADDR               0xFD003240
+%define DMA_PULL_ADDR               0xFD003244
+%define CACHE_PULL_ADDR             0xFD003270
+%define PGRAPH_STATUS               0xFD400700
+%define PGRAPH_STATE                0xFD400720
+
+%define STATE_OK                    0x1337C0DE
+%define STATE_BUSY                  0x32555359
+%define STATE_INVALID_READ_PUSH_ADDR        0xBAD0000
+%define STATE_INVALID_PUSH_MODIFIED_IN_CALL 0xBADBAD
+
+; Runs the PFIFO until DMA_PULL_ADDR reaches `target`, performing the same steps as
+; Tracer.run_fifo for every chunk that fits into CACHE.
+;
+; Arguments: target, expected_push, result, max_iterations
+;
+; `result` receives DMA_PULL_ADDR, DMA_PUSH_ADDR and the value of DMA_PUSH_ADDR that
+; was replaced by `target`.
+
+step_fifo:
+
+push ebx
+push esi
+push edi
+push ebp
+
+; target
+mov edi, dword [esp+20]
+
+; expected_push
+mov esi, dword [esp+24]
+
+; result
+mov ebp, dword [esp+28]
+
+step:
+
+; disable_pgraph_fifo(xbox):
+and dword [PGRAPH_STATE], 0xFFFFFFFE
+
+; wait_until_pgraph_idle(xbox):
+mov ecx, 0x10000
+
+wait_pgraph_idle:
+
+test dword [PGRAPH_STATUS], 0x00000001
+jz pgraph_idle
+dec ecx
+jnz wait_pgraph_idle
+
+mov eax, STATE_BUSY
+jmp abort
+
+pgraph_idle:
+
+; Avoid any other CPU stuff overwriting stuff in this risky section
+cli
+
+; Mark the pushbuffer as empty by setting the push address to the target.
+mov eax, edi
+xchg dword [DMA_PUSH_ADDR], eax
+mov dword [ebp+8], eax
+cmp eax, esi
+je push_addr_valid
+
+sti
+mov eax, STATE_INVALID_READ_PUSH_ADDR
+jmp abort
+
+push_addr_valid:
+
+; PUT must remain at the target for the remaining iterations.
+mov esi, edi
+
+; The kick below must be kept in sync with kick_fifo.asm.
+
+; resume_fifo_pusher(xbox):
+or dword [CACHE_PUSH_STATE], 0x00000001
+
+mov ecx, 0x2000
+
+wait_push_idle:
+
+dec ecx
+jz pause_pusher
+
+mov ebx, dword [CACHE_PUSH_STATE]
+test ebx, 0x100
+jnz wait_push_idle
+
+pause_pusher:
+mov ebx, dword [CACHE_PUSH_STATE]
+and ebx, 0xFFFFFFFE
+mov dword [CACHE_PUSH_STATE], ebx
+
+cmp edi, dword [DMA_PUSH_ADDR]
+je kicked
+
+sti
+mov eax, STATE_INVALID_PUSH_MODIFIED_IN_CALL
+jmp abort
+
+kicked:
+
+sti
+
+; enable_pgraph_fifo(xbox):
+or dword [PGRAPH_STATE], 0x00000001
+
+; Give PGRAPH a chance to drain the CACHE.
+mov ecx, 0x10000
+
+wait_cache_empty:
+
+mov eax, dword [CACHE_PULL_ADDR]
+cmp eax, dword [CACHE_PUSH_ADDR]
+je cache_empty
+dec ecx
+jnz wait_cache_empty
+
+cache_empty:
+
+mov eax, STATE_OK
+cmp edi, dword [DMA_PULL_ADDR]
+je done
+
+dec dword [esp+32]
+jnz step
+
+mov eax, STATE_BUSY
+
+abort:
+
+; Never return with the PGRAPH FIFO disabled, the host may not step it again.
+or dword [PGRAPH_STATE], 0x00000001
+
+done:
+
+mov ecx, dword [DMA_PULL_ADDR]
+mov dword [ebp], ecx
+mov ecx, dword [DMA_PUSH_ADDR]
+mov dword [ebp+4], ecx
+
+pop ebp
+pop edi
+pop esi
+pop ebx
+ret 0x10